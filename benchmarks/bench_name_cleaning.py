@@ -0,0 +1,178 @@
+'''
+Micro-benchmark of the lipid name cleanup before parsing, prepare_for_parsing and character_exchange_df
+against the previous row-wise implementation and the pandas .str alternative, on synthetic names
+
+Run from the repository root:
+
+    python benchmarks/bench_name_cleaning.py [n_names]
+
+The outputs of all implementations are compared first, the timings are the best of 5 runs.
+'''
+
+import os
+import re
+import sys
+import timeit
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+from utils.common_functions import CHARACTER_EXCHANGE_PATTERN, character_exchange_df, prepare_for_parsing
+
+
+N_NAMES = 100000
+REPEATS = 5
+
+
+
+## previous row-wise implementation
+
+def old_character_exchange(lipid_name):
+    try:
+        position =  re.search(r';\d+O$', lipid_name).span()
+        object = lipid_name[position[0]:position[1]]
+        number = re.findall(r"\d+", object)
+        new_lipid_name = lipid_name[:position[0]+1] + lipid_name[position[0]+2] + number[0]
+        return new_lipid_name
+    except:
+        return lipid_name
+
+
+def old_character_exchange_df(df):
+    lipids = []
+    try:
+        for row in df.iloc[:, 0]:
+            row = old_character_exchange(str(row))
+            lipids.append(row)
+    except:
+        print('Character_exchange_df cant be executed.')
+    df2 = pd.DataFrame(lipids)
+    return df2
+
+
+def old_separate_lipids(string):
+    try:
+        string = string.split('|')
+        new_string = string[1]
+        return new_string
+    except:
+        return string[0]
+
+
+def old_prepare_for_parsing(df):
+    df = df.iloc[:, 0].dropna()
+    df  = df.apply(lambda x: old_separate_lipids(x)).reset_index(drop=True)
+    df = df.drop(df[df == ''].index)
+    df = df.drop(df[df == 'Original name'].index)
+    df = df.reset_index(drop=True)
+    df = df.to_frame()
+    return df
+
+
+
+## pandas .str alternative, one compiled regex over the names containing ; and a vectorised split
+
+def exchange(match):
+    return ';' + match.string[match.start()+2] + match.group(1)
+
+
+def str_character_exchange_df(df):
+    names = df.iloc[:, 0].astype(str)
+    mask = names.str.contains(';', regex=False)
+    names[mask] = names[mask].str.replace(CHARACTER_EXCHANGE_PATTERN, exchange, regex=True)
+    return pd.DataFrame(names.tolist())
+
+
+def str_prepare_for_parsing(df):
+    df = df.iloc[:, 0].dropna()
+    # the second field as split('|')[1], split('|', n=1).str[-1] would keep the rest of the name
+    df = df.str.split('|', n=2).str[1].fillna(df)
+    df = df[~df.isin(['', 'Original name'])]
+    df = df.reset_index(drop=True)
+    df = df.to_frame()
+    return df
+
+
+
+def synthetic_names(n, seed=0):
+
+    '''
+    Lipid names as found in uploaded files: misdefined hydroxyls (;2O), '|' separated
+    species and molecular species, empty rows, repeated headers and missing values
+
+    Param
+    -------
+    n: int
+    seed: int
+
+    Returns
+    -------
+    df: dataframe
+        one column of names
+    '''
+
+    rng = np.random.default_rng(seed)
+
+    classes = np.array(['PC', 'PE', 'PI', 'PS', 'TG', 'DG', 'Cer', 'SM', 'HexCer', 'CAR', 'LPC', 'FA'])
+    suffixes = np.array(['', '', '', ';2O', ';3O', ';O2', ';12O', ';OH'])
+
+    lipid_class = rng.choice(classes, n)
+    carbons = rng.integers(12, 60, n).astype(str)
+    double_bonds = rng.integers(0, 12, n).astype(str)
+    suffix = rng.choice(suffixes, n)
+
+    species = np.char.add(np.char.add(np.char.add(np.char.add(lipid_class, ' '), carbons), ':'), double_bonds)
+    names = np.char.add(species, suffix).astype(object)
+
+    molecular = rng.random(n) < 0.3
+    names[molecular] = [name + '|' + name.replace(':', '-', 1) for name in names[molecular]]
+
+    kind = rng.random(n)
+    names[kind < 0.01] = ''
+    names[(kind >= 0.01) & (kind < 0.015)] = 'Original name'
+    names[(kind >= 0.015) & (kind < 0.02)] = None
+
+    return pd.DataFrame({'Lipid': names})
+
+
+
+def check_equivalence(df):
+
+    '''
+    Assert that all implementations give the same frames, alone and chained as in the app
+    '''
+
+    pd.testing.assert_frame_equal(prepare_for_parsing(df), old_prepare_for_parsing(df))
+    pd.testing.assert_frame_equal(character_exchange_df(df), old_character_exchange_df(df))
+    pd.testing.assert_frame_equal(character_exchange_df(prepare_for_parsing(df)), old_character_exchange_df(old_prepare_for_parsing(df)))
+
+    pd.testing.assert_frame_equal(str_prepare_for_parsing(df), old_prepare_for_parsing(df))
+    pd.testing.assert_frame_equal(str_character_exchange_df(df), old_character_exchange_df(df))
+
+
+
+def best_of(function, df):
+    return min(timeit.repeat(lambda: function(df), number=1, repeat=REPEATS))
+
+
+
+if __name__ == '__main__':
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else N_NAMES
+    df = synthetic_names(n)
+
+    check_equivalence(df)
+    check_equivalence(df.iloc[:0])
+    print(f'outputs identical on {n} synthetic names and an empty frame')
+
+    cases = [
+        ('prepare_for_parsing', old_prepare_for_parsing, prepare_for_parsing, str_prepare_for_parsing),
+        ('character_exchange_df', old_character_exchange_df, character_exchange_df, str_character_exchange_df),
+        ('both chained', lambda x: old_character_exchange_df(old_prepare_for_parsing(x)), lambda x: character_exchange_df(prepare_for_parsing(x)), lambda x: str_character_exchange_df(str_prepare_for_parsing(x))),
+    ]
+
+    print(f'{"":<24}{"row-wise":>11}{"current":>11}{".str":>11}')
+    for name, old, new, vectorised in cases:
+        print(f'{name:<24}' + ''.join(f'{best_of(function, df)*1000:8.0f} ms' for function in (old, new, vectorised)))
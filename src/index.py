@@ -25,15 +25,19 @@ cyto.load_extra_layouts()
 from utils.common_functions import *
 from utils.statistics_fisher import *
 from utils.statistics_hypergeom import *
-from utils.convert_batch import convert_table
+from utils.enrichment_planner import run_enrichment
+from utils.statistics_permutation import PERMUTATION_TEST, PERMUTATION_ITERATIONS
+from utils.batch_enrichment import split_query_set, parse_query_set, run_batch_enrichment
+from utils.convert_batch import convert_tables, get_parser_backend
 from utils.graph_functions import get_elements, get_abbr
-from utils.upset_chart import plotly_upset_plot_pivot, plotly_upset_figure
+from utils.upset_chart import UPSET_MAX_TERMS, UPSET_TOP_K, UPSET_TABLE_PAGE_SIZE, plotly_upset_plot_pivot, plotly_upset_figure, upset_page_count
 from utils.reverse_table_upset import table_for_upset
 from pages.layout import header, footer, table_header, table_body
 from pages.manual import manual_layout
 from utils.phylo_tree import *
 from utils.reporter import *
 from utils.cleaning import clear_old_assets_and_cache
+from utils.session_store import SESSION_EXPIRED_MESSAGE, store_table, load_table, table_available
 
 app = dash.Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP, "https://cdnjs.cloudflare.com/ajax/libs/animate.css/4.1.1/animate.min.css"], title='LORA')
 server = app.server
@@ -64,6 +68,12 @@ config={
 
 cache = Cache(app.server, config=config)
 
+# start the parser before the first upload arrives
+try:
+    get_parser_backend().warm_up('LIPID')
+except Exception as e:
+    print('Lipid name parser not started:', e)
+
 @server.before_request
 def set_session_id():
     if 'session_id' not in flask.session:
@@ -142,6 +152,8 @@ app_layout = html.Div([
                 ], style={'width':'25%'}),
                 dbc.Tooltip('All parsers use jgoslin-cli.'
                             ' Universal lipid parser uses multiple grammars to parse lipid names, to use specific grammar use the remaining parsers.', target='parser-dropdown'),
+                html.Div(id='parse-progress', style={'margin-top':'.5em'}),
+                dcc.Interval(id='parse-progress-interval', interval=500, disabled=True),
                 
                 dbc.Row(children=[
                     ### upload query file
@@ -853,9 +865,16 @@ app_layout = html.Div([
                                 html.H4('Enrichment Analysis'),
                                 html.Div([
                                     html.H6('Enrichment test:'),
-                                    dcc.Dropdown(['Fisher exact test', 'Hypergeometric'], 'Fisher exact test', id='statistical-test-dropdown')
+                                    dcc.Dropdown(['Fisher exact test', 'Hypergeometric', PERMUTATION_TEST], 'Fisher exact test', id='statistical-test-dropdown')
                                 ], style={'margin':'5px 0 5px 0'}),
 
+                                html.Div([
+                                    html.H6('Permutations:'),
+                                    dbc.Input(value=PERMUTATION_ITERATIONS, id='permutation-iterations-input', type='number', min=100, step=100, size='sm'),
+                                    html.H6('Seed:', style={'margin-top':'5px'}),
+                                    dbc.Input(id='permutation-seed-input', type='number', min=0, step=1, placeholder='random', size='sm'),
+                                ], id='permutation-options', style={'display':'none'}),
+
                                 html.Div([    
                                     dcc.RadioItems([{'label':html.Div(['greater'], id='target-greater', style={'display':'inline-block'}), 'value':'greater'},
                                                     {'label':html.Div(['less'], id='target-less', style={'display':'inline-block'}), 'value':'less',},
@@ -884,16 +903,21 @@ app_layout = html.Div([
                                 html.Hr(style={'color':'#0053b5', 'height':'2px'}),
 
                                 html.H6('Parameters to test within subset:'),
-                            
-                                html.P('Select subset:', style={'font-style': 'italic', 'margin':'8px 0 0 0'}),
-                                dcc.Checklist([
-                                                {'label':'Lipid Maps Category', 'value': 'Lipid Maps Category'}, 
-                                                {'label':'Lipid Maps Main Class or Sub Class', 'value': 'Lipid Maps Main Class'}, 
-                                        ], ['Lipid Maps Category', 'Lipid Maps Main Class'], id='enrichment-checklist-subset', labelStyle={"margin-right": "1rem", 'display':'block'}, inputStyle={"margin-right": "5px"}),
-                                
-                                html.P('Select parameters:', style={'font-style': 'italic', 'margin':'8px 0 0 2rem'}),
-                                
-                                dcc.Checklist(id='parameters-checklist', labelStyle={"margin-right": "1rem", 'display':'block'}, inputStyle={"margin-right": "5px"}, style={'margin-left':'2rem'}),
+
+                                html.P('Not available for the permutation test.', id='within-subset-message', style={'display':'none'}),
+
+                                # greyed out and not clickable while the permutation test is selected
+                                html.Div(children=[
+                                    html.P('Select subset:', style={'font-style': 'italic', 'margin':'8px 0 0 0'}),
+                                    dcc.Checklist([
+                                                    {'label':'Lipid Maps Category', 'value': 'Lipid Maps Category'}, 
+                                                    {'label':'Lipid Maps Main Class or Sub Class', 'value': 'Lipid Maps Main Class'}, 
+                                            ], ['Lipid Maps Category', 'Lipid Maps Main Class'], id='enrichment-checklist-subset', labelStyle={"margin-right": "1rem", 'display':'block'}, inputStyle={"margin-right": "5px"}),
+                                    
+                                    html.P('Select parameters:', style={'font-style': 'italic', 'margin':'8px 0 0 2rem'}),
+                                    
+                                    dcc.Checklist(id='parameters-checklist', labelStyle={"margin-right": "1rem", 'display':'block'}, inputStyle={"margin-right": "5px"}, style={'margin-left':'2rem'}),
+                                ], id='within-subset-options'),
                                 
                                 html.Hr(style={'color':'#0053b5', 'height':'2px'}),
 
@@ -919,6 +943,8 @@ app_layout = html.Div([
                                                 }
                                             ],
                                             'fdr_bh', id='statistical-method-dropdown'),
+                                        dcc.Checklist(options=[{'label': 'Correct all term levels jointly', 'value':'joint'}], value=[], id='joint-correction-checklist',
+                                                      inputStyle={"margin-right": "5px"}, style={'margin-top':'5px'}),
                                     ], style={'padding':'0'}),
 
                                 ], style={'margin':'20px 0'}),
@@ -948,6 +974,40 @@ app_layout = html.Div([
 
                                 html.Div(id='output-select-message'),
 
+                                html.Hr(style={'color':'#0053b5', 'height':'2px'}),
+
+                                html.Div([
+                                    html.H6('Batch of queries:'),
+                                    dcc.Upload(
+                                        id='upload-batch-query-data',
+                                        children=html.Div([
+                                            'Drag and Drop or ',
+                                            html.A('Select Files')
+                                        ]),
+                                        style={
+                                            'width': '100%',
+                                            'height': '40px',
+                                            'lineHeight': '40px',
+                                            'borderWidth': '1px',
+                                            'borderStyle': 'dashed',
+                                            'borderColor':'#0053b5',
+                                            'borderRadius': '5px',
+                                            'textAlign': 'center',
+                                        },
+                                        multiple=True
+                                    ),
+                                    dbc.Tooltip('Every column of every file is one query, all queries are tested against the reference lipidome with the parameters above.', target='upload-batch-query-data'),
+                                    html.P('Multiple hypothesis testing within:', style={'font-style': 'italic', 'margin':'8px 0 0 0'}),
+                                    dcc.RadioItems([{'label':'term levels', 'value':'level'},
+                                                    {'label':'queries', 'value':'query'},
+                                                    {'label':'batch', 'value':'batch'}
+                                                    ], 'level', id='batch-correction-radio',
+                                                    inline=True, labelStyle={"margin-right": "1rem"}, inputStyle={"margin-right": "5px"}),
+                                    dbc.Button(id='batch-enrichment-button', children="Process batch", style={'margin':'10px auto 10px auto', 'width':'auto'}, color="secondary"),
+                                    dcc.Loading(children=[html.Div(id='batch-enrichment-message')], type="dot"),
+                                    dcc.Download(id='download-batch-enrichment'),
+                                ]),
+
                             ], style={'background-color':'#eeeeee', 'border': '1px solid rgba(0,0,0,.125)', 'border-radius': '.25rem', 'margin-left':'14px', 'margin-top':'10px', 'padding-right':'8px', 'padding-left':'8px'}),
 
                     ], width='auto', style={'width':'20%', 'padding':0, 'margin-bottom':'5em'}),
@@ -965,7 +1025,21 @@ app_layout = html.Div([
                                 html.Div(id='vil-table-container'),
 
                                 html.H4('UpSet plot for term intersection visualization', style={'margin-top':'4rem'}),
+                                dbc.Row(children=[
+                                    dbc.Col(children=[
+                                        dcc.RadioItems(options=[{'label': 'Top {} significant terms'.format(UPSET_MAX_TERMS), 'value': 'terms'},
+                                                                {'label': 'Largest intersections', 'value': 'size'},
+                                                                {'label': 'Most significant intersections', 'value': 'p-value'}],
+                                                       value='terms', id='upset-mode-radio', inline=True, labelStyle={"margin-right": "1rem"}, inputStyle={"margin-right": "5px"}),
+                                    ]),
+                                    dbc.Col(children=[
+                                        html.H6('Intersections per page:'),
+                                        dbc.Input(value=UPSET_TOP_K, id='upset-top-k-input', type='number', min=1, step=1, size='sm'),
+                                    ], width=3),
+                                ], style={'margin':'10px 0'}),
                                 dcc.Graph(id='basic-interactions'),
+                                dbc.Pagination(id='upset-pagination', max_value=1, active_page=1, fully_expanded=False, previous_next=True),
+                                dcc.Store(id='upset-session'),
                                 dcc.Store(id='basic-interactions-session'),
                                 dcc.Store(id='VIL_table_session'),
                                 dcc.Store(id='all_results_session'),
@@ -1040,7 +1114,7 @@ app_layout = html.Div([
                                                 html.B("Acyls [MOLECULAR_SPECIES]: 12:0 ", style={'display':'contents'}),
                                                 html.P("(both significantly enriched) overlap at lipid TG 12:0_18:2_18:3.", style={'display':'contents'})], className="card-text", style={'margin':'0 0 8px 0'}),
                                             html.Li(html.P("Lipid(s) that are present in most over-represented terms are defined as VIL(s). Corrected p-values of the specific lipid(s) are reported for each over-represented term in the VIL table."), className="card-text", style={'margin':'0 0 8px 0'}),
-                                            html.Li(html.P("Calculation costs of all possible term intersections grow exponentially. Therefore, the upper limit is 13 terms. If more than 13 terms resulted from the analysis, tighten the statistical parameters to get only highly significant terms and the VIL report."), className="card-text", style={'margin':'0 0 8px 0'}),
+                                            html.Li(html.P("The VIL report is calculated from the 13 most significant terms. If more than 13 terms resulted from the analysis, tighten the statistical parameters to get only highly significant terms and the VIL report."), className="card-text", style={'margin':'0 0 8px 0'}),
                                         ]),
                                     ],
                                     style={'padding':'12px'}),
@@ -1074,8 +1148,8 @@ app_layout = html.Div([
                                                 html.P(" terms). The bar graph at the bottom shows how many lipids fit within the specified term.", style={'display':'contents'})
                                             ]), className="card-text", style={'margin':'0 0 8px 0'}),
                                             html.Li(html.P("The UpSet plot is sorted by the number of overlaps and the size of the term overlap. Empty groups are omitted to reduce the size of the plot."), className="card-text", style={'margin':'0 0 8px 0'}),
-                                            html.Li(html.P("The plot is interactive. Click on the bar in the Cardinality Bar Plot to generate a table of lipids belonging to that particular term intersection."), className="card-text", style={'margin':'0 0 8px 0'}),
-                                            html.Li(html.P("The computation limit is set to 13 terms as above for the VIL table."), className="card-text", style={'margin':'0 0 8px 0'}),
+                                            html.Li(html.P("The plot is interactive. Click on the bar in the Cardinality Bar Plot, or on the dots and p-values of its row, to generate a table of lipids belonging to that particular term intersection."), className="card-text", style={'margin':'0 0 8px 0'}),
+                                            html.Li(html.P("By default, all intersections of the 13 most significant terms are plotted, as for the VIL table. The largest or the most significant intersections among all significant terms can be browsed page by page instead."), className="card-text", style={'margin':'0 0 8px 0'}),
                                         ]),
                                     ],
                                     style={'padding':'12px'}),
@@ -1453,6 +1527,11 @@ def update_query_and_universe_output(demo_button_1, demo_button_2, demo_button_3
     report_path = create_dir(session_id)
     cache.set('report_path'+session_id, report_path)
 
+    def parse_progress(parsed, total):
+        cache.set(session_id+'_parse_progress', (parsed, total))
+
+    parse_progress(0, 0)
+
     if (triggered_id == 'demo-button-1' or 
         triggered_id == 'demo-button-2' or 
         triggered_id == 'demo-button-3' or 
@@ -1498,8 +1577,7 @@ def update_query_and_universe_output(demo_button_1, demo_button_2, demo_button_3
         content_query_exchanged = content_query_exchanged.iloc[:, 0].str.rstrip(' ')
         content_universe_exchanged = content_universe_exchanged.iloc[:, 0].str.rstrip(' ')
 
-        parsed_names_query = convert_table(content_query_exchanged, parser_dropdown, report_path)
-        parsed_names_universe = convert_table(content_universe_exchanged, parser_dropdown, report_path)
+        parsed_names_query, parsed_names_universe = convert_tables([content_query_exchanged, content_universe_exchanged], parser_dropdown, report_path, parse_progress)
 
         df_lipid_parsed_query = parsed_names_query[['Original Name', 'Normalized Name']].fillna('').astype('str')
         df_lipid_parsed_universe = parsed_names_universe[['Original Name', 'Normalized Name']].fillna('').astype('str')
@@ -1541,7 +1619,7 @@ def update_query_and_universe_output(demo_button_1, demo_button_2, demo_button_3
                 html.P('Total number of rows is: ' + str(len(df_lipid_prepared_universe.index)), style={'margin':0})
             ], style={'borderColor':'rgba(0,0,0,.125)',}, color='#EEEEEE')
 
-        return table_query, table_universe, alert_query, alert_universe, df_lipid_parsed_query_data.to_dict('records'), df_lipid_parsed_universe_data.to_dict('records'), original_data
+        return table_query, table_universe, alert_query, alert_universe, store_table(session_id, 'query', df_lipid_parsed_query_data), store_table(session_id, 'universe', df_lipid_parsed_universe_data), original_data
 
     if contents_query is not None and contents_universe is not None and parser_dropdown == 'LIPID':        
         
@@ -1559,8 +1637,7 @@ def update_query_and_universe_output(demo_button_1, demo_button_2, demo_button_3
         content_query_exchanged = content_query_exchanged.iloc[:, 0].str.rstrip(' ') 
         content_universe_exchanged = content_universe_exchanged.iloc[:, 0].str.rstrip(' ')
 
-        parsed_names_query = convert_table(content_query_exchanged, parser_dropdown, report_path)
-        parsed_names_universe = convert_table(content_universe_exchanged, parser_dropdown, report_path)
+        parsed_names_query, parsed_names_universe = convert_tables([content_query_exchanged, content_universe_exchanged], parser_dropdown, report_path, parse_progress)
 
         df_lipid_parsed_query = parsed_names_query[['Original Name', 'Normalized Name']].fillna('').astype('str')
         df_lipid_parsed_universe = parsed_names_universe[['Original Name', 'Normalized Name']].fillna('').astype('str')
@@ -1604,7 +1681,7 @@ def update_query_and_universe_output(demo_button_1, demo_button_2, demo_button_3
                 html.P('Total number of rows is: ' + str(len(df_lipid_prepared_universe.index)), style={'margin':0})
             ], style={'borderColor':'rgba(0,0,0,.125)',}, color='#EEEEEE')
 
-        return table_query, table_universe, alert_query, alert_universe, df_lipid_parsed_query_data.to_dict('records'), df_lipid_parsed_universe_data.to_dict('records'), original_data
+        return table_query, table_universe, alert_query, alert_universe, store_table(session_id, 'query', df_lipid_parsed_query_data), store_table(session_id, 'universe', df_lipid_parsed_universe_data), original_data
 
     if (triggered_id == 'demo-button-1' or 
         triggered_id == 'demo-button-2' or 
@@ -1654,8 +1731,7 @@ def update_query_and_universe_output(demo_button_1, demo_button_2, demo_button_3
         content_query_exchanged = content_query_exchanged.iloc[:, 0].str.rstrip(' ')
         content_universe_exchanged = content_universe_exchanged.iloc[:, 0].str.rstrip(' ')
 
-        parsed_names_query = convert_table(content_query_exchanged, parser_dropdown, report_path)
-        parsed_names_universe = convert_table(content_universe_exchanged, parser_dropdown, report_path)
+        parsed_names_query, parsed_names_universe = convert_tables([content_query_exchanged, content_universe_exchanged], parser_dropdown, report_path, parse_progress)
 
 
         df_lipid_parsed_query = parsed_names_query[['Original Name', 'Normalized Name']].fillna('').astype('str')
@@ -1700,7 +1776,7 @@ def update_query_and_universe_output(demo_button_1, demo_button_2, demo_button_3
                 html.P('Total number of rows is: ' + str(len(df_lipid_prepared_universe.index)), style={'margin':0})
             ], style={'borderColor':'rgba(0,0,0,.125)',}, color='#EEEEEE')
 
-        return table_query, table_universe, alert_query, alert_universe, df_lipid_parsed_query_data.to_dict('records'), df_lipid_parsed_universe_data.to_dict('records'), original_data
+        return table_query, table_universe, alert_query, alert_universe, store_table(session_id, 'query', df_lipid_parsed_query_data), store_table(session_id, 'universe', df_lipid_parsed_universe_data), original_data
 
     if contents_query is not None and contents_universe is not None and (parser_dropdown == 'GOSLIN' or 
                                                                          parser_dropdown == 'SHORTHAND2020' or
@@ -1722,8 +1798,7 @@ def update_query_and_universe_output(demo_button_1, demo_button_2, demo_button_3
         content_query_exchanged = content_query_exchanged.iloc[:, 0].str.rstrip(' ') 
         content_universe_exchanged = content_universe_exchanged.iloc[:, 0].str.rstrip(' ')
 
-        parsed_names_query = convert_table(content_query_exchanged, parser_dropdown, report_path)
-        parsed_names_universe = convert_table(content_universe_exchanged, parser_dropdown, report_path)
+        parsed_names_query, parsed_names_universe = convert_tables([content_query_exchanged, content_universe_exchanged], parser_dropdown, report_path, parse_progress)
 
         df_lipid_parsed_query = parsed_names_query[['Original Name', 'Normalized Name']].fillna('').astype('str')
         df_lipid_parsed_universe = parsed_names_universe[['Original Name', 'Normalized Name']].fillna('').astype('str')
@@ -1767,13 +1842,47 @@ def update_query_and_universe_output(demo_button_1, demo_button_2, demo_button_3
                 html.P('Total number of rows is: ' + str(len(df_lipid_prepared_universe.index)), style={'margin':0})
             ], style={'borderColor':'rgba(0,0,0,.125)',}, color='#EEEEEE')
 
-        return table_query, table_universe, alert_query, alert_universe, df_lipid_parsed_query_data.to_dict('records'), df_lipid_parsed_universe_data.to_dict('records'), original_data
+        return table_query, table_universe, alert_query, alert_universe, store_table(session_id, 'query', df_lipid_parsed_query_data), store_table(session_id, 'universe', df_lipid_parsed_universe_data), original_data
 
     else:
+        cache.delete(session_id+'_parse_progress')
         raise PreventUpdate
 
 
 
+### progress of parsing the lipid names
+@app.callback(Output('parse-progress', 'children'),
+              Output('parse-progress-interval', 'disabled'),
+              Input('parse-progress-interval', 'n_intervals'),
+              Input('demo-button-1', 'n_clicks'),
+              Input('demo-button-2', 'n_clicks'),
+              Input('demo-button-3', 'n_clicks'),
+              Input('demo-button-4', 'n_clicks'),
+              Input('parser-dropdown', 'value'),
+              Input('upload-query-data', 'contents'),
+              Input('upload-universe-data', 'contents'),
+              prevent_initial_call=True)
+def display_parse_progress(n_intervals, demo_button_1, demo_button_2, demo_button_3, demo_button_4, parser_dropdown, contents_query, contents_universe):
+
+    session_id = flask.session['session_id']
+
+    if ctx.triggered_id != 'parse-progress-interval':
+        return 'Parsing lipid names...', False
+
+    progress = cache.get(session_id+'_parse_progress')
+
+    if progress is None or (progress[1] > 0 and progress[0] >= progress[1]):
+        return '', True
+
+    parsed, total = progress
+
+    if total == 0:
+        return 'Parsing lipid names...', False
+
+    return f'Parsing lipid names: {parsed} / {total}', False
+
+
+
 ## query jgoslin table checklist without synchronisation
 @app.callback(Output('checklist-query-jgoslin', 'options'),
               Input('datatable-query-session', 'data'),
@@ -1791,8 +1900,7 @@ def create_jgoslin_checklist(data, n_clicks):
     
     if input_id == 'process-button':
 
-        df = pd.DataFrame(data)
-        df = separate_db_position_geometry(df)
+        df = load_table(data, separate_db_position_geometry)
 
         df_columns = df.columns
         columns_to_drop = [x for x in df_columns if x.startswith('Lipid Shorthand')]
@@ -1824,8 +1932,7 @@ def create_jgoslin_checklist(data, n_clicks):
     
     if input_id == 'process-button':
 
-        df = pd.DataFrame(data)
-        df = separate_db_position_geometry(df)
+        df = load_table(data, separate_db_position_geometry)
 
         df_columns = df.columns
         columns_to_drop = [x for x in df_columns if x.startswith('Lipid Shorthand')]
@@ -1847,12 +1954,15 @@ def create_jgoslin_checklist(data, n_clicks):
               Input('tab-2', 'value'),
 )
 def display_message(data_query, data_universe, value):
+    if value == 'tab-2' and not (table_available(data_query) and table_available(data_universe)):
+        return dbc.Alert(html.H6(SESSION_EXPIRED_MESSAGE, style={'color':'#b50800', 'margin':0}), style={'borderColor':'rgba(0,0,0,.125)',}, color='#EEEEEE')
+
     if value == 'tab-2':
-        df_query = pd.DataFrame(data_query)
-        df_universe = pd.DataFrame(data_universe)
+        rows_query = data_query['rows'] if data_query is not None else 0
+        rows_universe = data_universe['rows'] if data_universe is not None else 0
 
         message = [
-            html.B('The number of lipids to parse is ' + str(len(df_query.index)) + ' for query and ' + str(len(df_universe.index)) + ' for reference lipidome. ', style={'margin-bottom':0}),
+            html.B('The number of lipids to parse is ' + str(rows_query) + ' for query and ' + str(rows_universe) + ' for reference lipidome. ', style={'margin-bottom':0}),
             html.P([
                 html.P('For further processing, please click on the ', style={'display':'contents'}),
                 html.B('Process', style={'display':'contents'}),
@@ -1943,8 +2053,7 @@ def create_jgoslin_table(n_clicks, data_query):
         raise PreventUpdate 
 
     else:
-        df_final_query = pd.DataFrame(data_query)
-        df_final_query = separate_db_position_geometry(df_final_query)
+        df_final_query = load_table(data_query, separate_db_position_geometry)
 
         df_columns = df_final_query.columns
         columns_to_drop = [x for x in df_columns if x.startswith('Lipid Shorthand')]
@@ -2010,8 +2119,7 @@ def create_jgoslin_table(n_clicks, data_universe):
         raise PreventUpdate 
 
     else:
-        df_final_universe = pd.DataFrame(data_universe)
-        df_final_universe = separate_db_position_geometry(df_final_universe)
+        df_final_universe = load_table(data_universe, separate_db_position_geometry)
 
         #df_final_universe = df_final_universe.loc[:, df_final_universe.columns.isin(checklist_value_universe)]
 
@@ -2063,13 +2171,19 @@ def create_jgoslin_table(n_clicks, data_universe):
 ### RadioItems disable/enable while performing action
 @app.callback(
     Output('radioitems-alternative', 'style'),
+    Output('permutation-options', 'style'),
+    Output('within-subset-options', 'style'),
+    Output('within-subset-message', 'style'),
     Input('statistical-test-dropdown', 'value'),
 )
 def disabled_radioitems(value):
     if value == 'Fisher exact test':
-        return {'display':'block'}
+        return {'display':'block'}, {'display':'none'}, {}, {'display':'none'}
     if value == 'Hypergeometric':
-        return {'display':'none'}
+        return {'display':'none'}, {'display':'none'}, {}, {'display':'none'}
+    if value == PERMUTATION_TEST:
+        # within-subset terms have no permutation null, their selections are disabled instead of ignored
+        return {'display':'block'}, {'display':'block', 'margin':'5px 0 5px 0'}, {'opacity':0.5, 'pointer-events':'none'}, {'font-style': 'italic', 'color':'#b3b3b3', 'margin':'8px 0 0 0'}
 
 
 
@@ -2077,10 +2191,21 @@ def disabled_radioitems(value):
 @app.callback(
     Output('output-select-message', 'children'),
     Input('enrichment-button', 'n_clicks'),
+    State('datatable-query-session', 'data'),
+    State('datatable-universe-session', 'data'),
+    State('statistical-test-dropdown', 'value'),
+    State('enrichment-checklist', 'value'),
+    State('enrichment-checklist-subset', 'value'),
+    State('parameters-checklist', 'value'),
 )
-def display_select_message(n_clicks):
+def display_select_message(n_clicks, data_query, data_universe, statistical_test, checklist, checklist_subset, param_checklist):
+    if not (table_available(data_query) and table_available(data_universe)):
+        return dbc.Alert(html.H6(SESSION_EXPIRED_MESSAGE, style={'color':'#b50800', 'margin':0}), style={'borderColor':'rgba(0,0,0,.125)',}, color='#EEEEEE')
     if n_clicks is None:
         return html.P('Select the required parameters and submit', style={'color':'#b3b3b3', 'padding-bottom':'1rem'})
+    if statistical_test == PERMUTATION_TEST and not checklist:
+        # the within-subset checklists are disabled for the permutation test, only the general parameters count
+        return html.P('The permutation test is available for the general enrichment only, select parameters to test.', style={'color':'#b50800', 'padding-bottom':'1rem'})
     if n_clicks is not None:
         return []
 
@@ -2116,10 +2241,10 @@ def generate_param_checklist(data):
 @app.callback(
     Output('enrichment-container', 'children'),
     Output('enrichment-container-session', 'data'),
-    Output('basic-interactions', 'figure'),
+    Output('upset-session', 'data'),
     Output('enrichment-analysis-column-container', 'style'),
     Output('vil-table-container', 'children'),
-    Output('basic-interactions-session', 'data'),
+    Output('upset-pagination', 'active_page'),
     Output('enrichment-button', 'n_clicks'),
     Output('VIL_table_session', 'data'),
     Output('all_results_session', 'data'),
@@ -2135,41 +2260,34 @@ def generate_param_checklist(data):
     State('statistical-test-dropdown', 'value'),
     State('filter-enrichment', 'value'),
     State('filter-count', 'value'),
+    State('permutation-iterations-input', 'value'),
+    State('permutation-seed-input', 'value'),
+    State('joint-correction-checklist', 'value'),
 )
-def create_table_statistics(checklist, checklist_subset, data_query, data_universe, n_clicks, radio_item, param_checklist, statistical_method, alpha_level, statistical_test, filter, filter_count):
+def create_table_statistics(checklist, checklist_subset, data_query, data_universe, n_clicks, radio_item, param_checklist, statistical_method, alpha_level, statistical_test, filter, filter_count, iterations, seed, joint_correction):
 
     ctx = callback_context
     input_id = ctx.triggered[0]["prop_id"].split(".")[0]
 
     session_id = flask.session['session_id']
 
-    carbon_options = ['acyls containing less than 16 carbon atoms', 'acyls containing 16-18 carbon atoms', 'acyls containing more than 18 carbon atoms']
-    double_bond_options = ['acyls containing 0 double bonds (saturated)', 'acyls containing 1 double bonds (monounsaturated)', 'acyls containing 2 or more double bonds (polyunsaturated)']
-
     if n_clicks is None:
         raise PreventUpdate
     
     elif input_id == 'datatable-query-session':
-        return [], {}, {}, {'display':'none'}, [], {}, None, {}
+        return [], {}, None, {'display':'none'}, [], 1, None, {}, {}
 
-    elif input_id == 'enrichment-button' and len(checklist) != 0 and len(checklist_subset) == 0 and len(param_checklist) == 0 and statistical_test == 'Fisher exact test':
+    elif input_id == 'enrichment-button' and ((statistical_test in ['Fisher exact test', 'Hypergeometric'] and ((len(checklist) != 0 and len(checklist_subset) == 0 and len(param_checklist) == 0) or (len(checklist_subset) != 0 and len(param_checklist) != 0))) or (statistical_test == PERMUTATION_TEST and len(checklist) != 0)):
 
-        df_query_final = separate_db_position_geometry(pd.DataFrame(data_query))
-        df_universe_final = separate_db_position_geometry(pd.DataFrame(data_universe))
+        if statistical_test == PERMUTATION_TEST:
+            # the within-subset checklists are disabled for the permutation test, their kept values are not used
+            checklist_subset, param_checklist = [], []
 
-        # Calculate enrichment using Fisher's exact test
-        if checklist == ['Acyls']:
-            df = calculate_enrichment_fisher(checklist, get_FA_df(df_query_final), get_FA_df(df_universe_final), radio_item, statistical_method, alpha_level, filter_count)
-
-        elif 'Acyls' in checklist:
-            excluded_list = [item for item in checklist if item != 'Acyls']
-            dfs_to_concat = []
-            dfs_to_concat.append(calculate_enrichment_fisher(excluded_list, df_query_final, df_universe_final, radio_item, statistical_method, alpha_level, filter_count))
-            dfs_to_concat.append(calculate_enrichment_fisher(['Acyls'], get_FA_df(df_query_final), get_FA_df(df_universe_final), radio_item, statistical_method, alpha_level, filter_count))
-            df = pd.concat(dfs_to_concat)
-
-        elif 'Acyls' not in checklist:    
-            df = calculate_enrichment_fisher(checklist, df_query_final, df_universe_final, radio_item, statistical_method, alpha_level, filter_count)
+        # every term family of the selections, the shared frames are prepared once
+        df, frames = run_enrichment(load_table(data_query, separate_db_position_geometry), load_table(data_universe, separate_db_position_geometry), checklist, checklist_subset, param_checklist, statistical_test, radio_item, statistical_method, alpha_level, filter_count, prepared=True,
+                                    iterations=int(iterations or PERMUTATION_ITERATIONS), seed=None if seed is None else int(seed), universe_fingerprint=data_universe['fingerprint'],
+                                    correction='joint' if joint_correction and 'joint' in joint_correction else 'level')
+        df_query_final = frames.get('query')
 
         # Clean up data and apply filters
         df['p-value'] = df['p-value'].apply(lambda x: edit_pval(x))
@@ -2193,574 +2311,125 @@ def create_table_statistics(checklist, checklist_subset, data_query, data_univer
         # Create upset plot
         upset_df = table_for_upset(df_get_sig, df_query_final)
 
-        if len(df.index) < 2:
-            fig = go.Figure()
-            fig.add_annotation(
-                text="Not enough data to plot a figure, the condition needs to be loosen.",
-                font={"size": 16},
-                showarrow=False
-            )
-            fig_dict = {}
-            VIL = pd.DataFrame()
-
-        if len(df.index) >= 2 and len(df.index) < 13:
-            original_df, df_to_plot, subsets, fig_dict, VIL = plotly_upset_plot_pivot(upset_df, LIM_MAX)
-            fig = plotly_upset_figure(df_to_plot, original_df, subsets, LIM_MAX) 
-            fig.update_layout(clickmode='event+select')
-
-        if len(df.index) >= 13:    
+        if len(df.index) >= 2:
             original_df, df_to_plot, subsets, fig_dict, VIL = plotly_upset_plot_pivot(upset_df, LIM_MAX)
-            fig = plotly_upset_figure(df_to_plot, original_df, subsets, LIM_MAX) 
-            fig.update_layout(clickmode='event+select')
-        
-        cache.set('upset_fig_'+session_id, fig)
-
-        table = table_create_table_statistics(df)
-
-        VIL_table = vil_table(VIL)
-
-        return table, df.to_dict('records'), fig, {'visibility':'visible', 'display':'block'}, VIL_table, fig_dict, n_clicks, VIL, df_all_results.to_dict('records')
-
-    elif input_id == 'enrichment-button' and len(checklist) == 0 and len(checklist_subset) != 0 and len(param_checklist) != 0 and statistical_test == 'Fisher exact test':
-
-        df_query_final = separate_db_position_geometry(pd.DataFrame(data_query))
-        df_universe_final = separate_db_position_geometry(pd.DataFrame(data_universe))
-
-        if param_checklist == ['Acyls']:
-            df = calculate_enrichment_within_subset_fisher(checklist_subset, ['Acyls'], get_FA_df(df_query_final), get_FA_df(df_universe_final), radio_item, statistical_method, alpha_level, filter_count)
-
-        elif 'Acyls' in param_checklist:
-            excluded_list = [item for item in param_checklist if item != 'Acyls']
-            dfs_to_concat = []
-
-            if 'Total #C' not in excluded_list and 'Total #DB' not in excluded_list:
-                dfs_to_concat.append(calculate_enrichment_within_subset_fisher(checklist_subset, excluded_list, df_query_final, df_universe_final, radio_item, statistical_method, alpha_level, filter_count))
-                dfs_to_concat.append(calculate_enrichment_within_subset_fisher(checklist_subset, ['Acyls'], get_FA_df(df_query_final), get_FA_df(df_universe_final), radio_item, statistical_method, alpha_level, filter_count))
-
-            if 'Total #C' not in excluded_list and 'Total #DB' in excluded_list:
-                dfs_to_concat.append(calculate_enrichment_within_subset_fisher(checklist_subset, excluded_list, df_query_final, df_universe_final, radio_item, statistical_method, alpha_level, filter_count))
-                dfs_to_concat.append(calculate_enrichment_within_subset_fisher(checklist_subset, ['Acyls'], get_FA_df(df_query_final), get_FA_df(df_universe_final), radio_item, statistical_method, alpha_level, filter_count))
-                df_list = [calculate_enrichment_fisher_advanced(checklist_subset, df_query_final, df_universe_final, radio_item, 'DOUBLE BONDS', double_bond_option, statistical_method, alpha_level, filter_count) for double_bond_option in double_bond_options]
-                dfs_to_concat.extend(df_list)
-
-            if 'Total #DB' not in excluded_list and 'Total #C' in excluded_list:
-                dfs_to_concat.append(calculate_enrichment_within_subset_fisher(checklist_subset, excluded_list, df_query_final, df_universe_final, radio_item, statistical_method, alpha_level, filter_count))
-                dfs_to_concat.append(calculate_enrichment_within_subset_fisher(checklist_subset, ['Acyls'], get_FA_df(df_query_final), get_FA_df(df_universe_final), radio_item, statistical_method, alpha_level, filter_count))
-                df_list = [calculate_enrichment_fisher_advanced(checklist_subset, df_query_final, df_universe_final, radio_item, 'CARBONS', carbon_option, statistical_method, alpha_level, filter_count) for carbon_option in carbon_options]
-                dfs_to_concat.extend(df_list)
-            
-            if 'Total #C' in excluded_list and 'Total #DB' in excluded_list:
-                dfs_to_concat.append(calculate_enrichment_within_subset_fisher(checklist_subset, excluded_list, df_query_final, df_universe_final, radio_item, statistical_method, alpha_level, filter_count))
-                dfs_to_concat.append(calculate_enrichment_within_subset_fisher(checklist_subset, ['Acyls'], get_FA_df(df_query_final), get_FA_df(df_universe_final), radio_item, statistical_method, alpha_level, filter_count))
-                df_list_carbons = [calculate_enrichment_fisher_advanced(checklist_subset, df_query_final, df_universe_final, radio_item, 'CARBONS', carbon_option, statistical_method, alpha_level, filter_count) for carbon_option in carbon_options]
-                dfs_to_concat.extend(df_list_carbons)
-                df_list_db = [calculate_enrichment_fisher_advanced(checklist_subset, df_query_final, df_universe_final, radio_item, 'DOUBLE BONDS', double_bond_option, statistical_method, alpha_level, filter_count) for double_bond_option in double_bond_options]
-                dfs_to_concat.extend(df_list_db)
-            
-            df = pd.concat(dfs_to_concat)
-
         else:
-            dfs_to_concat = []
-
-            if 'Total #C' not in param_checklist and 'Total #DB' not in param_checklist:
-                df = calculate_enrichment_within_subset_fisher(checklist_subset, param_checklist, df_query_final, df_universe_final, radio_item, statistical_method, alpha_level, filter_count)
-
-            if 'Total #C' not in param_checklist and 'Total #DB' in param_checklist:
-                dfs_to_concat.append(calculate_enrichment_within_subset_fisher(checklist_subset, param_checklist, df_query_final, df_universe_final, radio_item, statistical_method, alpha_level, filter_count))
-                df_list = [calculate_enrichment_fisher_advanced(checklist_subset, df_query_final, df_universe_final, radio_item, 'DOUBLE BONDS', double_bond_option, statistical_method, alpha_level, filter_count) for double_bond_option in double_bond_options]
-                dfs_to_concat.extend(df_list)
-
-            if 'Total #DB' not in param_checklist and 'Total #C' in param_checklist:
-                dfs_to_concat.append(calculate_enrichment_within_subset_fisher(checklist_subset, param_checklist, df_query_final, df_universe_final, radio_item, statistical_method, alpha_level, filter_count))            
-                df_list = [calculate_enrichment_fisher_advanced(checklist_subset, df_query_final, df_universe_final, radio_item, 'CARBONS', carbon_option, statistical_method, alpha_level, filter_count) for carbon_option in carbon_options]
-                dfs_to_concat.extend(df_list)
-            
-            if 'Total #C' in param_checklist and 'Total #DB' in param_checklist:
-                dfs_to_concat.append(calculate_enrichment_within_subset_fisher(checklist_subset, param_checklist, df_query_final, df_universe_final, radio_item, statistical_method, alpha_level, filter_count))
-                df_list_carbons = [calculate_enrichment_fisher_advanced(checklist_subset, df_query_final, df_universe_final, radio_item, 'CARBONS', carbon_option, statistical_method, alpha_level, filter_count) for carbon_option in carbon_options]
-                dfs_to_concat.extend(df_list_carbons)
-                df_list_db = [calculate_enrichment_fisher_advanced(checklist_subset, df_query_final, df_universe_final, radio_item, 'DOUBLE BONDS', double_bond_option, statistical_method, alpha_level, filter_count) for double_bond_option in double_bond_options]
-                dfs_to_concat.extend(df_list_db)
-
-            df = pd.concat(dfs_to_concat)
-
-        df['p-value'] = df['p-value'].apply(lambda x: edit_pval(x))
-        df['Term (Classifier)'] = df['Term (Classifier)'].apply(lambda x: int(x) if isinstance(x, float) else x)
-        df['Term (Classifier)'] = df['Term (Classifier)'].astype(str)
-
-        df_all_results = df
-
-        if filter == ['Filter statistically significant results']:
-            try:
-                df = df[df['Hypothesis Correction Result'] == True]
-            except Exception as e:
-                print(f'Error when filtering statically significant values: {e}')
-
-        df_get_sig = df[df['Hypothesis Correction Result'] == True].copy()
-        df_get_sig['p-value'] = pd.to_numeric(df_get_sig['p-value'], errors='ignore', downcast='float')
-
-        LIM_MAX = df_get_sig['p-value'].max()
-
-        upset_df = table_for_upset(df_get_sig, df_query_final)
-
-        if len(df.index) < 2:
-            fig = go.Figure()
-            fig.add_annotation(
-                text="Not enough data to plot a figure, the condition needs to be loosen.",
-                font={"size": 16},
-                showarrow=False
-            )
-            fig_dict = {}
             VIL = pd.DataFrame()
-        
-        if len(df.index) >= 2 and len(df.index) < 13:
-            original_df, df_to_plot, subsets, fig_dict, VIL = plotly_upset_plot_pivot(upset_df, LIM_MAX)
-            fig = plotly_upset_figure(df_to_plot, original_df, subsets, LIM_MAX) 
-            fig.update_layout(clickmode='event+select')
 
-        if len(df.index) >= 13:    
-            original_df, df_to_plot, subsets, fig_dict, VIL = plotly_upset_plot_pivot(upset_df, LIM_MAX)
-            fig = plotly_upset_figure(df_to_plot, original_df, subsets, LIM_MAX) 
-            fig.update_layout(clickmode='event+select')
-
-        cache.set('upset_fig_'+session_id, fig)    
+        # the figure itself is drawn by update_upset_figure, in the selected mode and page; the pivot above is
+        # memoised on the content of upset_df and reused there for the 'terms' mode
+        cache.set('upset_df_'+session_id, upset_df)
+        upset_session = {'limit': float(LIM_MAX), 'plot': len(df.index) >= 2, 'n_clicks': n_clicks}
 
         table = table_create_table_statistics(df)
 
         VIL_table = vil_table(VIL)
 
-        return table, df.to_dict('records'), fig, {'visibility':'visible', 'display':'block'}, VIL_table, fig_dict, n_clicks, VIL, df_all_results.to_dict('records')
-
-    elif input_id == 'enrichment-button' and len(checklist) != 0 and len(checklist_subset) != 0 and len(param_checklist) != 0 and statistical_test == 'Fisher exact test':
-
-        df_query_final = separate_db_position_geometry(pd.DataFrame(data_query))
-        df_universe_final = separate_db_position_geometry(pd.DataFrame(data_universe))
-
-        if checklist == ['Acyls']:
-            df_general = calculate_enrichment_fisher(checklist, get_FA_df(df_query_final), get_FA_df(df_universe_final), radio_item, statistical_method, alpha_level, filter_count)
-        
-        elif 'Acyls' in checklist:
-            excluded_list = [item for item in checklist if item != 'Acyls']
-            dfs_general_to_concat = []
-            dfs_general_to_concat.append(calculate_enrichment_fisher(excluded_list, df_query_final, df_universe_final, radio_item, statistical_method, alpha_level, filter_count))
-            dfs_general_to_concat.append(calculate_enrichment_fisher(['Acyls'], get_FA_df(df_query_final), get_FA_df(df_universe_final), radio_item, statistical_method, alpha_level, filter_count))
-            df_general = pd.concat(dfs_general_to_concat)
-
-        else:
-            df_general = calculate_enrichment_fisher(checklist, df_query_final, df_universe_final, radio_item, statistical_method, alpha_level, filter_count)
-
-
-        if param_checklist == ['Acyls']:
-            df_subset = calculate_enrichment_within_subset_fisher(checklist_subset, ['Acyls'], get_FA_df(df_query_final), get_FA_df(df_universe_final), radio_item, statistical_method, alpha_level, filter_count)
-
-        elif 'Acyls' in param_checklist:
-            excluded_list = [item for item in param_checklist if item != 'Acyls']
-            dfs_subset_to_concat = []
-
-            if 'Total #C' not in excluded_list and 'Total #DB' not in excluded_list:
-                dfs_subset_to_concat.append(calculate_enrichment_within_subset_fisher(checklist_subset, excluded_list, df_query_final, df_universe_final, radio_item, statistical_method, alpha_level, filter_count))
-                dfs_subset_to_concat.append(calculate_enrichment_within_subset_fisher(checklist_subset, ['Acyls'], get_FA_df(df_query_final), get_FA_df(df_universe_final), radio_item, statistical_method, alpha_level, filter_count))
-
-            elif 'Total #C' not in excluded_list and 'Total #DB' in excluded_list:
-                dfs_subset_to_concat.append(calculate_enrichment_within_subset_fisher(checklist_subset, excluded_list, df_query_final, df_universe_final, radio_item, statistical_method, alpha_level, filter_count))
-                dfs_subset_to_concat.append(calculate_enrichment_within_subset_fisher(checklist_subset, ['Acyls'], get_FA_df(df_query_final), get_FA_df(df_universe_final), radio_item, statistical_method, alpha_level, filter_count))
-                df_list = [calculate_enrichment_fisher_advanced(checklist_subset, df_query_final, df_universe_final, radio_item, 'DOUBLE BONDS', double_bond_option, statistical_method, alpha_level, filter_count) for double_bond_option in double_bond_options]
-                dfs_subset_to_concat.extend(df_list)
-
-            elif 'Total #DB' not in excluded_list and 'Total #C' in excluded_list:
-                dfs_subset_to_concat.append(calculate_enrichment_within_subset_fisher(checklist_subset, excluded_list, df_query_final, df_universe_final, radio_item, statistical_method, alpha_level, filter_count))
-                dfs_subset_to_concat.append(calculate_enrichment_within_subset_fisher(checklist_subset, ['Acyls'], get_FA_df(df_query_final), get_FA_df(df_universe_final), radio_item, statistical_method, alpha_level, filter_count))
-                df_list = [calculate_enrichment_fisher_advanced(checklist_subset, df_query_final, df_universe_final, radio_item, 'CARBONS', carbon_option, statistical_method, alpha_level, filter_count) for carbon_option in carbon_options]
-                dfs_subset_to_concat.extend(df_list)
-            
-            elif 'Total #C' in excluded_list and 'Total #DB' in excluded_list:
-                dfs_subset_to_concat.append(calculate_enrichment_within_subset_fisher(checklist_subset, excluded_list, df_query_final, df_universe_final, radio_item, statistical_method, alpha_level, filter_count))
-                dfs_subset_to_concat.append(calculate_enrichment_within_subset_fisher(checklist_subset, ['Acyls'], get_FA_df(df_query_final), get_FA_df(df_universe_final), radio_item, statistical_method, alpha_level, filter_count))
-                df_list_carbons = [calculate_enrichment_fisher_advanced(checklist_subset, df_query_final, df_universe_final, radio_item, 'CARBONS', carbon_option, statistical_method, alpha_level, filter_count) for carbon_option in carbon_options]
-                dfs_subset_to_concat.extend(df_list_carbons)
-                df_list_db = [calculate_enrichment_fisher_advanced(checklist_subset, df_query_final, df_universe_final, radio_item, 'DOUBLE BONDS', double_bond_option, statistical_method, alpha_level, filter_count) for double_bond_option in double_bond_options]
-                dfs_subset_to_concat.extend(df_list_db)
-            
-            df_subset = pd.concat(dfs_subset_to_concat)
-
-        else:
-            dfs_subset_to_concat = []
-
-            if 'Total #C' not in param_checklist and 'Total #DB' not in param_checklist:
-                df_subset = calculate_enrichment_within_subset_fisher(checklist_subset, param_checklist, df_query_final, df_universe_final, radio_item, statistical_method, alpha_level, filter_count)
-
-            elif 'Total #C' not in param_checklist and 'Total #DB' in param_checklist:
-                dfs_subset_to_concat.append(calculate_enrichment_within_subset_fisher(checklist_subset, param_checklist, df_query_final, df_universe_final, radio_item, statistical_method, alpha_level, filter_count))
-                df_list = [calculate_enrichment_fisher_advanced(checklist_subset, df_query_final, df_universe_final, radio_item, 'DOUBLE BONDS', double_bond_option, statistical_method, alpha_level, filter_count) for double_bond_option in double_bond_options]
-                dfs_subset_to_concat.extend(df_list)
-
-            elif 'Total #DB' not in param_checklist and 'Total #C' in param_checklist:
-                dfs_subset_to_concat.append(calculate_enrichment_within_subset_fisher(checklist_subset, param_checklist, df_query_final, df_universe_final, radio_item, statistical_method, alpha_level, filter_count))
-                df_list = [calculate_enrichment_fisher_advanced(checklist_subset, df_query_final, df_universe_final, radio_item, 'CARBONS', carbon_option, statistical_method, alpha_level, filter_count) for carbon_option in carbon_options]
-                dfs_subset_to_concat.extend(df_list)
-            
-            elif 'Total #C' in param_checklist and 'Total #DB' in param_checklist:
-                dfs_subset_to_concat.append(calculate_enrichment_within_subset_fisher(checklist_subset, param_checklist, df_query_final, df_universe_final, radio_item, statistical_method, alpha_level, filter_count))
-                df_list_carbons = [calculate_enrichment_fisher_advanced(checklist_subset, df_query_final, df_universe_final, radio_item, 'CARBONS', carbon_option, statistical_method, alpha_level, filter_count) for carbon_option in carbon_options]
-                dfs_subset_to_concat.extend(df_list_carbons)
-                df_list_db = [calculate_enrichment_fisher_advanced(checklist_subset, df_query_final, df_universe_final, radio_item, 'DOUBLE BONDS', double_bond_option, statistical_method, alpha_level, filter_count) for double_bond_option in double_bond_options]
-                dfs_subset_to_concat.extend(df_list_db)
-                
-            df_subset = pd.concat(dfs_subset_to_concat)
-
-        df = pd.concat([df_general, df_subset])
-
-        df['p-value'] = df['p-value'].apply(lambda x: edit_pval(x))
-        df['Term (Classifier)'] = df['Term (Classifier)'].apply(lambda x: int(x) if isinstance(x, float) else x)
-        df['Term (Classifier)'] = df['Term (Classifier)'].astype(str)
-
-        df_all_results = df
-            
-        if filter == ['Filter statistically significant results']:
-            try:
-                df = df[df['Hypothesis Correction Result'] == True]
-            except Exception as e:
-                print(f'Error when filtering statically significant values: {e}')
-
-        df_get_sig = df[df['Hypothesis Correction Result'] == True].copy()
-        df_get_sig['p-value'] = pd.to_numeric(df_get_sig['p-value'], errors='ignore', downcast='float')
-
-        LIM_MAX = df_get_sig['p-value'].max()
-
-        upset_df = table_for_upset(df_get_sig, df_query_final)
-
-        if len(df.index) < 2:
-            fig = go.Figure()
-            fig.add_annotation(
-                text="Not enough data to plot a figure, the condition needs to be loosen.",
-                font={"size": 16},
-                showarrow=False
-            )
-            fig_dict = {}
-            VIL = pd.DataFrame()
+        return table, df.to_dict('records'), upset_session, {'visibility':'visible', 'display':'block'}, VIL_table, 1, n_clicks, VIL, df_all_results.to_dict('records')
 
-        if len(df.index) >= 2 and len(df.index) < 13:
-            original_df, df_to_plot, subsets, fig_dict, VIL = plotly_upset_plot_pivot(upset_df, LIM_MAX)
-            fig = plotly_upset_figure(df_to_plot, original_df, subsets, LIM_MAX) 
-            fig.update_layout(clickmode='event+select')
-
-        if len(df.index) >= 13:    
-            original_df, df_to_plot, subsets, fig_dict, VIL = plotly_upset_plot_pivot(upset_df, LIM_MAX)
-            fig = plotly_upset_figure(df_to_plot, original_df, subsets, LIM_MAX) 
-            fig.update_layout(clickmode='event+select')
-
-        cache.set('upset_fig_'+session_id, fig)
-
-        table = table_create_table_statistics(df)
-
-        VIL_table = vil_table(VIL)
-
-        return table, df.to_dict('records'), fig, {'visibility':'visible', 'display':'block'}, VIL_table, fig_dict, n_clicks, VIL, df_all_results.to_dict('records')
-    
-    elif input_id == 'enrichment-button' and len(checklist) !=0 and len(checklist_subset) == 0 and len(param_checklist) == 0 and statistical_test == 'Hypergeometric':
-        
-        df_query_final = separate_db_position_geometry(pd.DataFrame(data_query))
-        df_universe_final = separate_db_position_geometry(pd.DataFrame(data_universe))
-
-        if checklist == ['Acyls']:
-            df = calculate_enrichment_hypergeom(checklist, get_FA_df(df_query_final), get_FA_df(df_universe_final), statistical_method, alpha_level, filter_count)
-
-        elif 'Acyls' in checklist:
-            excluded_list = [item for item in checklist if item != 'Acyls']
-            dfs_to_concat = []
-            dfs_to_concat.append(calculate_enrichment_hypergeom(excluded_list, df_query_final, df_universe_final, statistical_method, alpha_level, filter_count))
-            dfs_to_concat.append(calculate_enrichment_hypergeom(['Acyls'], get_FA_df(df_query_final), get_FA_df(df_universe_final), statistical_method, alpha_level, filter_count))
-            df = pd.concat(dfs_to_concat)
-
-        elif 'Acyls' not in checklist:    
-            df = calculate_enrichment_hypergeom(checklist, df_query_final, df_universe_final, statistical_method, alpha_level, filter_count)
-
-        df['p-value'] = df['p-value'].apply(lambda x: edit_pval(x))
-        df['Term (Classifier)'] = df['Term (Classifier)'].apply(lambda x: int(x) if isinstance(x, float) else x)
-        df['Term (Classifier)'] = df['Term (Classifier)'].astype(str)
-        
-        df_all_results = df
-
-        if filter == ['Filter statistically significant results']:
-            try:
-                df = df[df['Hypothesis Correction Result'] == True]
-            except Exception as e:
-                print(f'Error when filtering statically significant values: {e}')
-
-        df_get_sig = df[df['Hypothesis Correction Result'] == True].copy()
-        df_get_sig['p-value'] = pd.to_numeric(df_get_sig['p-value'], errors='ignore', downcast='float')
-
-        LIM_MAX = df_get_sig['p-value'].max()
-
-        upset_df = table_for_upset(df_get_sig, df_query_final)
-
-        if len(df.index) < 2:
-            fig = go.Figure()
-            fig.add_annotation(
-                text="Not enough data to plot a figure, the condition needs to be loosen.",
-                font={"size": 16},
-                showarrow=False
-            )
-            fig_dict = {}
-            VIL = pd.DataFrame()
-
-        if len(df.index) >= 2 and len(df.index) < 13:
-            original_df, df_to_plot, subsets, fig_dict, VIL = plotly_upset_plot_pivot(upset_df, LIM_MAX)
-            fig = plotly_upset_figure(df_to_plot, original_df, subsets, LIM_MAX) 
-            fig.update_layout(clickmode='event+select')
-
-        if len(df.index) >= 13:    
-            original_df, df_to_plot, subsets, fig_dict, VIL = plotly_upset_plot_pivot(upset_df, LIM_MAX)
-            fig = plotly_upset_figure(df_to_plot, original_df, subsets, LIM_MAX) 
-            fig.update_layout(clickmode='event+select')
-        
-        cache.set('upset_fig_'+session_id, fig)
-
-        table = table_create_table_statistics(df)
-
-        VIL_table = vil_table(VIL)
-
-        return table, df.to_dict('records'), fig, {'visibility':'visible', 'display':'block'}, VIL_table, fig_dict, n_clicks, VIL, df_all_results.to_dict('records')
-
-    elif input_id == 'enrichment-button' and len(checklist) == 0 and len(checklist_subset) != 0 and len(param_checklist) != 0 and statistical_test=='Hypergeometric':
-        
-        df_query_final = separate_db_position_geometry(pd.DataFrame(data_query))
-        df_universe_final = separate_db_position_geometry(pd.DataFrame(data_universe))
-
-
-        if param_checklist == ['Acyls']:
-            df = calculate_enrichment_within_subset_hypergeom(checklist_subset, ['Acyls'], get_FA_df(df_query_final), get_FA_df(df_universe_final), statistical_method, alpha_level, filter_count)
-
-        elif 'Acyls' in param_checklist:
-            excluded_list = [item for item in param_checklist if item != 'Acyls']
-            dfs_to_concat = []
-
-            if 'Total #C' not in excluded_list and 'Total #DB' not in excluded_list:
-
-                dfs_to_concat.append(calculate_enrichment_within_subset_hypergeom(checklist_subset, excluded_list, df_query_final, df_universe_final, statistical_method, alpha_level, filter_count))
-                dfs_to_concat.append(calculate_enrichment_within_subset_hypergeom(checklist_subset, ['Acyls'], get_FA_df(df_query_final), get_FA_df(df_universe_final), statistical_method, alpha_level, filter_count))
-            
-            if 'Total #C' not in excluded_list and 'Total #DB' in excluded_list:
-                dfs_to_concat.append(calculate_enrichment_within_subset_hypergeom(checklist_subset, excluded_list, df_query_final, df_universe_final, statistical_method, alpha_level, filter_count))
-                dfs_to_concat.append(calculate_enrichment_within_subset_hypergeom(checklist_subset, ['Acyls'], get_FA_df(df_query_final), get_FA_df(df_universe_final), statistical_method, alpha_level, filter_count))
-                df_list = [calculate_enrichment_hypergeom_advanced(checklist_subset, df_query_final, df_universe_final, 'DOUBLE BONDS', double_bond_option, statistical_method, alpha_level, filter_count) for double_bond_option in double_bond_options]
-                dfs_to_concat.extend(df_list)
-
-            if 'Total #DB' not in excluded_list and 'Total #C' in excluded_list:
-                dfs_to_concat.append(calculate_enrichment_within_subset_hypergeom(checklist_subset, excluded_list, df_query_final, df_universe_final, statistical_method, alpha_level, filter_count))
-                dfs_to_concat.append(calculate_enrichment_within_subset_hypergeom(checklist_subset, ['Acyls'], get_FA_df(df_query_final), get_FA_df(df_universe_final), statistical_method, alpha_level, filter_count))
-                df_list = [calculate_enrichment_hypergeom_advanced(checklist_subset, df_query_final, df_universe_final, 'CARBONS', carbon_option, statistical_method, alpha_level, filter_count) for carbon_option in carbon_options]
-                dfs_to_concat.extend(df_list)
-            
-            if 'Total #C' in excluded_list and 'Total #DB' in excluded_list:
-                dfs_to_concat.append(calculate_enrichment_within_subset_hypergeom(checklist_subset, excluded_list, df_query_final, df_universe_final, statistical_method, alpha_level, filter_count))
-                dfs_to_concat.append(calculate_enrichment_within_subset_hypergeom(checklist_subset, ['Acyls'], get_FA_df(df_query_final), get_FA_df(df_universe_final), statistical_method, alpha_level, filter_count))
-                df_list_carbons = [calculate_enrichment_hypergeom_advanced(checklist_subset, df_query_final, df_universe_final, 'CARBONS', carbon_option, statistical_method, alpha_level, filter_count) for carbon_option in carbon_options]
-                dfs_to_concat.extend(df_list_carbons)
-                df_list_db = [calculate_enrichment_hypergeom_advanced(checklist_subset, df_query_final, df_universe_final, 'DOUBLE BONDS', double_bond_option, statistical_method, alpha_level, filter_count) for double_bond_option in double_bond_options]
-                dfs_to_concat.extend(df_list_db)
-
-            df = pd.concat(dfs_to_concat)
-
-        else:
-            dfs_to_concat = []
-
-            if 'Total #C' not in param_checklist and 'Total #DB' not in param_checklist:
-                df = calculate_enrichment_within_subset_hypergeom(checklist_subset, param_checklist, df_query_final, df_universe_final, statistical_method, alpha_level, filter_count)
-
-            if 'Total #C' not in param_checklist and 'Total #DB' in param_checklist:
-                dfs_to_concat.append(calculate_enrichment_within_subset_hypergeom(checklist_subset, param_checklist, df_query_final, df_universe_final, statistical_method, alpha_level, filter_count))
-                df_list = [calculate_enrichment_hypergeom_advanced(checklist_subset, df_query_final, df_universe_final, 'DOUBLE BONDS', double_bond_option, statistical_method, alpha_level, filter_count) for double_bond_option in double_bond_options]
-                dfs_to_concat.extend(df_list)
-            
-            if 'Total #DB' not in param_checklist and 'Total #C' in param_checklist:
-                dfs_to_concat.append(calculate_enrichment_within_subset_hypergeom(checklist_subset, param_checklist, df_query_final, df_universe_final, statistical_method, alpha_level, filter_count))
-                df_list = [calculate_enrichment_hypergeom_advanced(checklist_subset, df_query_final, df_universe_final, 'CARBONS', carbon_option, statistical_method, alpha_level, filter_count) for carbon_option in carbon_options]
-                dfs_to_concat.extend(df_list)
-            
-            if 'Total #C' in param_checklist and 'Total #DB' in param_checklist:
-                dfs_to_concat.append(calculate_enrichment_within_subset_hypergeom(checklist_subset, param_checklist, df_query_final, df_universe_final, statistical_method, alpha_level, filter_count))
-                df_list_carbons = [calculate_enrichment_hypergeom_advanced(checklist_subset, df_query_final, df_universe_final, 'CARBONS', carbon_option, statistical_method, alpha_level, filter_count) for carbon_option in carbon_options]
-                dfs_to_concat.extend(df_list_carbons)
-                df_list_db = [calculate_enrichment_hypergeom_advanced(checklist_subset, df_query_final, df_universe_final, 'DOUBLE BONDS', double_bond_option, statistical_method, alpha_level, filter_count) for double_bond_option in double_bond_options]
-                dfs_to_concat.extend(df_list_db)
-
-            df = pd.concat(dfs_to_concat)
+    raise PreventUpdate
 
-        df['p-value'] = df['p-value'].apply(lambda x: edit_pval(x))
-        df['Term (Classifier)'] = df['Term (Classifier)'].apply(lambda x: int(x) if isinstance(x, float) else x)
-        df['Term (Classifier)'] = df['Term (Classifier)'].astype(str)
 
-        df_all_results = df
-            
-        if filter == ['Filter statistically significant results']:
-            try:
-                df = df[df['Hypothesis Correction Result'] == True]
-            except Exception as e:
-                print(f'Error when filtering statically significant values: {e}')
 
-        df_get_sig = df[df['Hypothesis Correction Result'] == True].copy()
-        df_get_sig['p-value'] = pd.to_numeric(df_get_sig['p-value'], errors='ignore', downcast='float')
+@app.callback(
+    Output('basic-interactions', 'figure'),
+    Output('basic-interactions-session', 'data'),
+    Output('upset-pagination', 'max_value'),
+    Input('upset-session', 'data'),
+    Input('upset-mode-radio', 'value'),
+    Input('upset-top-k-input', 'value'),
+    Input('upset-pagination', 'active_page'),
+)
+def update_upset_figure(upset_session, mode, top_k, active_page):
 
-        LIM_MAX = df_get_sig['p-value'].max()
+    session_id = flask.session['session_id']
 
-        upset_df = table_for_upset(df_get_sig, df_query_final)
+    if upset_session is None:
+        raise PreventUpdate
 
-        if len(df.index) < 2:
-            fig = go.Figure()
-            fig.add_annotation(
-                text="Not enough data to plot a figure, the condition needs to be loosen.",
-                font={"size": 16},
-                showarrow=False
-            )
-            fig_dict = {}
-            VIL = pd.DataFrame()
+    upset_df = cache.get('upset_df_'+session_id)
+    limit = upset_session['limit']
 
-        if len(df.index) >= 2 and len(df.index) < 13:
-            original_df, df_to_plot, subsets, fig_dict, VIL = plotly_upset_plot_pivot(upset_df, LIM_MAX)
-            fig = plotly_upset_figure(df_to_plot, original_df, subsets, LIM_MAX) 
-            fig.update_layout(clickmode='event+select')
+    # 'terms': every intersection of the most significant terms, otherwise a page of the top-k intersections
+    top_k = None if mode == 'terms' else max(1, int(top_k or UPSET_TOP_K))
+    pages = 1 if top_k is None or upset_df is None else upset_page_count(upset_df, limit, top_k)
 
-        if len(df.index) >= 13:    
-            original_df, df_to_plot, subsets, fig_dict, VIL = plotly_upset_plot_pivot(upset_df, LIM_MAX)
-            fig = plotly_upset_figure(df_to_plot, original_df, subsets, LIM_MAX) 
-            fig.update_layout(clickmode='event+select')
-        
+    if not upset_session['plot'] or upset_df is None or pages == 0:
+        fig = go.Figure()
+        fig.add_annotation(
+            text="Not enough data to plot a figure, the condition needs to be loosen.",
+            font={"size": 16},
+            showarrow=False
+        )
         cache.set('upset_fig_'+session_id, fig)
+        return fig, {}, 1
 
-        table = table_create_table_statistics(df)
-
-        VIL_table = vil_table(VIL)
-
-        return table, df.to_dict('records'), fig, {'visibility':'visible', 'display':'block'}, VIL_table, fig_dict, n_clicks, VIL, df_all_results.to_dict('records')
-    
-    elif input_id == 'enrichment-button' and len(checklist) != 0 and len(checklist_subset) != 0 and len(param_checklist) != 0 and statistical_test == 'Hypergeometric':
-        
-        df_query_final = separate_db_position_geometry(pd.DataFrame(data_query))
-        df_universe_final = separate_db_position_geometry(pd.DataFrame(data_universe))
-
-        if checklist == ['Acyls']:
-                df_general = calculate_enrichment_hypergeom(checklist, get_FA_df(df_query_final), get_FA_df(df_universe_final), statistical_method, alpha_level, filter_count)
-
-        elif 'Acyls' in checklist:
-            excluded_list = [item for item in checklist if item != 'Acyls']
-            dfs_general_to_concat = []
-            dfs_general_to_concat.append(calculate_enrichment_hypergeom(excluded_list, df_query_final, df_universe_final, statistical_method, alpha_level, filter_count))
-            dfs_general_to_concat.append(calculate_enrichment_hypergeom(['Acyls'], get_FA_df(df_query_final), get_FA_df(df_universe_final), statistical_method, alpha_level, filter_count))
-            df_general = pd.concat(dfs_general_to_concat)
-
-        else:    
-            df_general = calculate_enrichment_hypergeom(checklist, df_query_final, df_universe_final, statistical_method, alpha_level, filter_count)
-
-
-        if param_checklist == ['Acyls']:
-            df_subset = calculate_enrichment_within_subset_hypergeom(checklist_subset, ['Acyls'], get_FA_df(df_query_final), get_FA_df(df_universe_final), statistical_method, alpha_level, filter_count)
-
-        elif 'Acyls' in param_checklist:
-            excluded_list = [item for item in param_checklist if item != 'Acyls']
-            dfs_subset_to_concat = []
-
-            if 'Total #C' not in excluded_list and 'Total #DB' not in excluded_list:
-                dfs_subset_to_concat.append(calculate_enrichment_within_subset_hypergeom(checklist_subset, excluded_list, df_query_final, df_universe_final, statistical_method, alpha_level, filter_count))
-                dfs_subset_to_concat.append(calculate_enrichment_within_subset_hypergeom(checklist_subset, ['Acyls'], get_FA_df(df_query_final), get_FA_df(df_universe_final), statistical_method, alpha_level, filter_count))
+    page = min(max(1, active_page or 1), pages) - 1
 
-            if 'Total #C' not in excluded_list and 'Total #DB' in excluded_list:
-                dfs_subset_to_concat.append(calculate_enrichment_within_subset_hypergeom(checklist_subset, param_checklist, df_query_final, df_universe_final, statistical_method, alpha_level, filter_count))
-                dfs_subset_to_concat.append(calculate_enrichment_within_subset_hypergeom(checklist_subset, ['Acyls'], get_FA_df(df_query_final), get_FA_df(df_universe_final), statistical_method, alpha_level, filter_count))
-                df_list = [calculate_enrichment_hypergeom_advanced(checklist_subset, df_query_final, df_universe_final, 'DOUBLE BONDS', double_bond_option, statistical_method, alpha_level, filter_count) for double_bond_option in double_bond_options]
-                dfs_subset_to_concat.extend(df_list)
+    original_df, df_to_plot, subsets, fig_dict, VIL = plotly_upset_plot_pivot(upset_df, limit, top_k, page, mode)
+    fig = plotly_upset_figure(df_to_plot, original_df, subsets, limit)
+    fig.update_layout(clickmode='event+select')
 
-            if 'Total #DB' not in excluded_list and 'Total #C' in excluded_list:
-                dfs_subset_to_concat.append(calculate_enrichment_within_subset_hypergeom(checklist_subset, excluded_list, df_query_final, df_universe_final, statistical_method, alpha_level, filter_count))
-                dfs_subset_to_concat.append(calculate_enrichment_within_subset_hypergeom(checklist_subset, ['Acyls'], get_FA_df(df_query_final), get_FA_df(df_universe_final), statistical_method, alpha_level, filter_count))
-                df_list = [calculate_enrichment_hypergeom_advanced(checklist_subset, df_query_final, df_universe_final, 'CARBONS', carbon_option, statistical_method, alpha_level, filter_count) for carbon_option in carbon_options]
-                dfs_subset_to_concat.extend(df_list)
+    cache.set('upset_fig_'+session_id, fig)
 
-            if 'Total #C' in excluded_list and 'Total #DB' in excluded_list:
+    return fig, fig_dict, pages
 
-                dfs_subset_to_concat.append(calculate_enrichment_within_subset_hypergeom(checklist_subset, excluded_list, df_query_final, df_universe_final, statistical_method, alpha_level, filter_count))
-                dfs_subset_to_concat.append(calculate_enrichment_within_subset_hypergeom(checklist_subset, ['Acyls'], get_FA_df(df_query_final), get_FA_df(df_universe_final), statistical_method, alpha_level, filter_count))
-                df_list_carbons = [calculate_enrichment_hypergeom_advanced(checklist_subset, df_query_final, df_universe_final, 'CARBONS', carbon_option, statistical_method, alpha_level, filter_count) for carbon_option in carbon_options]
-                dfs_subset_to_concat.extend(df_list_carbons)
-                df_list_db = [calculate_enrichment_hypergeom_advanced(checklist_subset, df_query_final, df_universe_final, 'DOUBLE BONDS', double_bond_option, statistical_method, alpha_level, filter_count) for double_bond_option in double_bond_options]
-                dfs_subset_to_concat.extend(df_list_db)
 
-            df_subset = pd.concat(dfs_subset_to_concat)
-
-        else:
-
-            if 'Total #C' not in param_checklist and 'Total #DB' not in param_checklist:
-                df_subset = calculate_enrichment_within_subset_hypergeom(checklist_subset, param_checklist, df_query_final, df_universe_final, statistical_method, alpha_level, filter_count)
-
-            if 'Total #C' not in param_checklist and 'Total #DB' in param_checklist:
-                dfs_subset_to_concat.append(calculate_enrichment_within_subset_hypergeom(checklist_subset, param_checklist, df_query_final, df_universe_final, statistical_method, alpha_level, filter_count))
-                df_list = [calculate_enrichment_hypergeom_advanced(checklist_subset, df_query_final, df_universe_final, 'DOUBLE BONDS', double_bond_option, statistical_method, alpha_level, filter_count) for double_bond_option in double_bond_options]
-                dfs_subset_to_concat.extend(df_list)
+### batch enrichment - many queries against the reference lipidome
+@app.callback(
+    Output('download-batch-enrichment', 'data'),
+    Output('batch-enrichment-message', 'children'),
+    Input('batch-enrichment-button', 'n_clicks'),
+    State('upload-batch-query-data', 'contents'),
+    State('upload-batch-query-data', 'filename'),
+    State('datatable-universe-session', 'data'),
+    State('parser-dropdown', 'value'),
+    State('enrichment-checklist', 'value'),
+    State('enrichment-checklist-subset', 'value'),
+    State('parameters-checklist', 'value'),
+    State('radioitems-alternative', 'value'),
+    State('statistical-method-dropdown', 'value'),
+    State('alpha-level-input', 'value'),
+    State('statistical-test-dropdown', 'value'),
+    State('filter-count', 'value'),
+    State('batch-correction-radio', 'value'),
+    State('permutation-iterations-input', 'value'),
+    State('permutation-seed-input', 'value'),
+    prevent_initial_call=True,
+)
+def create_batch_enrichment(n_clicks, contents, filenames, data_universe, parser_dropdown, checklist, checklist_subset, param_checklist, radio_item, statistical_method, alpha_level, statistical_test, filter_count, correction, iterations, seed):
 
-            if 'Total #DB' not in param_checklist and 'Total #C' in param_checklist:
-                dfs_subset_to_concat.append(calculate_enrichment_within_subset_hypergeom(checklist_subset, param_checklist, df_query_final, df_universe_final, statistical_method, alpha_level, filter_count))
-                df_list = [calculate_enrichment_hypergeom_advanced(checklist_subset, df_query_final, df_universe_final, 'CARBONS', carbon_option, statistical_method, alpha_level, filter_count) for carbon_option in carbon_options]
-                dfs_subset_to_concat.extend(df_list)
-            
-            if 'Total #C' in param_checklist and 'Total #DB' in param_checklist:
-                dfs_subset_to_concat.append(calculate_enrichment_within_subset_hypergeom(checklist_subset, param_checklist, df_query_final, df_universe_final, statistical_method, alpha_level, filter_count))
-                df_list_carbons = [calculate_enrichment_hypergeom_advanced(checklist_subset, df_query_final, df_universe_final, 'CARBONS', carbon_option, statistical_method, alpha_level, filter_count) for carbon_option in carbon_options]
-                dfs_subset_to_concat.extend(df_list_carbons)
-                df_list_db = [calculate_enrichment_hypergeom_advanced(checklist_subset, df_query_final, df_universe_final, 'DOUBLE BONDS', double_bond_option, statistical_method, alpha_level, filter_count) for double_bond_option in double_bond_options]
-                dfs_subset_to_concat.extend(df_list_db)
-            
-            df_subset = pd.concat(dfs_subset_to_concat)
+    if n_clicks is None or contents is None or data_universe is None or alpha_level is None:
+        raise PreventUpdate
 
-        df = pd.concat([df_general, df_subset])
-        
-        df['p-value'] = df['p-value'].apply(lambda x: edit_pval(x))
-        df['Term (Classifier)'] = df['Term (Classifier)'].apply(lambda x: int(x) if isinstance(x, float) else x)
-        df['Term (Classifier)'] = df['Term (Classifier)'].astype(str)
+    session_id = flask.session['session_id']
+    report_path = cache.get('report_path'+session_id)
 
-        df_all_results = df
-            
-        if filter == ['Filter statistically significant results']:
-            try:
-                df = df[df['Hypothesis Correction Result'] == True]
-            except Exception as e:
-                print(f'Error when filtering statically significant values: {e}')
+    # subsets are tested only when both of their selections are made, as with the process button, and
+    # never with the permutation test whose within-subset checklists are disabled
+    if len(checklist_subset) == 0 or len(param_checklist) == 0 or statistical_test == PERMUTATION_TEST:
+        checklist_subset, param_checklist = [], []
 
-        df_get_sig = df[df['Hypothesis Correction Result'] == True].copy()
-        df_get_sig['p-value'] = pd.to_numeric(df_get_sig['p-value'], errors='ignore', downcast='float')
+    if len(checklist) == 0 and len(checklist_subset) == 0:
+        return None, html.P('Select the required parameters and submit', style={'color':'#b3b3b3'})
 
-        LIM_MAX = df_get_sig['p-value'].max()
+    if not table_available(data_universe):
+        return None, html.P(SESSION_EXPIRED_MESSAGE, style={'color':'#b50800'})
 
-        upset_df = table_for_upset(df_get_sig, df_query_final)
+    queries = split_query_set([(filename, parse_contents([content], [filename])) for content, filename in zip(contents, filenames)])
 
-        if len(df.index) < 2:
-            fig = go.Figure()
-            fig.add_annotation(
-                text="Not enough data to plot a figure, the condition needs to be loosen.",
-                font={"size": 16},
-                showarrow=False
-            )
-            fig_dict = {}
-            VIL = pd.DataFrame()
+    # the reference lipidome is already parsed, only the names of the queries go to the parser, each once
+    parsed_queries = parse_query_set(queries, parser_dropdown, report_path)
 
-        if len(df.index) >= 2 and len(df.index) < 13:
-            original_df, df_to_plot, subsets, fig_dict, VIL = plotly_upset_plot_pivot(upset_df, LIM_MAX)
-            fig = plotly_upset_figure(df_to_plot, original_df, subsets, LIM_MAX) 
-            fig.update_layout(clickmode='event+select')
+    df = run_batch_enrichment(parsed_queries, load_table(data_universe, separate_db_position_geometry), checklist, checklist_subset, param_checklist, statistical_test, radio_item, statistical_method, alpha_level, filter_count,
+                              correction=correction, prepared=True, iterations=int(iterations or PERMUTATION_ITERATIONS), seed=None if seed is None else int(seed), universe_fingerprint=data_universe['fingerprint'])
 
-        if len(df.index) >= 13:    
-            original_df, df_to_plot, subsets, fig_dict, VIL = plotly_upset_plot_pivot(upset_df, LIM_MAX)
-            fig = plotly_upset_figure(df_to_plot, original_df, subsets, LIM_MAX) 
-            fig.update_layout(clickmode='event+select')
-        
-        cache.set('upset_fig_'+session_id, fig)
+    message = html.P(str(len(parsed_queries)) + ' of ' + str(len(queries)) + ' queries processed, ' + str(int(df['Hypothesis Correction Result'].sum())) + ' significant terms.', style={'padding-bottom':'1rem'})
 
-        table = table_create_table_statistics(df)
-        VIL_table = vil_table(VIL)
+    batch_file_name = 'LORA_batch_enrichment_' + str(datetime.now().strftime('%Y_%m_%d_%H_%M_%S')) + '.tsv'
 
-        return table, df.to_dict('records'), fig, {'visibility':'visible', 'display':'block'}, VIL_table, fig_dict, n_clicks, VIL, df_all_results.to_dict('records')
+    return dcc.send_data_frame(df.to_csv, batch_file_name, sep='\t', index=False), message
 
-    else:
-        pass
 
 
 ### Tab-3 Param Callback
@@ -2811,8 +2480,8 @@ def generate_cytoscape(value, query_data, universe_data, statistics_data):
 
     if triggered_id == 'enrichment-container' and statistics_data is not None:
 
-        df_query = pd.DataFrame(query_data)
-        df_universe = pd.DataFrame(universe_data)
+        df_query = load_table(query_data)
+        df_universe = load_table(universe_data)
         df_statistics = pd.DataFrame(statistics_data)
         
         elements, _, cy_nodes, cy_edges = get_elements(df_universe, df_query, df_statistics)
@@ -2871,8 +2540,8 @@ def displayTapNodeData(data, query_data, universe_data, statistics_data):
 
         LM_abbreviations=get_abbr()
 
-        df_query = pd.DataFrame(query_data)
-        df_universe = pd.DataFrame(universe_data)
+        df_query = load_table(query_data)
+        df_universe = load_table(universe_data)
         df_statistics = pd.DataFrame(statistics_data)
         
         this_session = cache.get(session_id)
@@ -2966,6 +2635,7 @@ def display_click_data(clickData, atlas):
                 dash_table.DataTable(
                     data=data_df.to_dict('records'),
                     columns=[{"id": x, "name": x} for x in data_df.columns],
+                    page_size=UPSET_TABLE_PAGE_SIZE,
                     style_data={
                         'lineHeight': '20px'
                     },
@@ -3047,9 +2717,9 @@ def create_report(
     
     print(f"Starting report creation for session {session_id}")
 
-    triggered_id = ctx.triggered_id
-
-    if triggered_id == 'enrichment-container':
+    # the upset figure of a new result is drawn by a chained callback, the report waits for it and is then
+    # triggered by both; new pages of the figure alone do not start a report
+    if 'enrichment-container.children' in ctx.triggered_prop_ids:
 
         print("Enrichment container triggered")
         
@@ -3075,8 +2745,8 @@ def create_report(
 
         ## Query and Universe tables
         print("Creating Query and Universe tables (parsed data) xlsx started")
-        query_goslin_table = pd.DataFrame(query_data)
-        universe_goslin_table = pd.DataFrame(universe_data)
+        query_goslin_table = load_table(query_data)
+        universe_goslin_table = load_table(universe_data)
         with pd.ExcelWriter(report_path+'/parsed_data.xlsx', engine='xlsxwriter') as writer:
             query_goslin_table.to_excel(writer, sheet_name='parsed_query', index=False)
             universe_goslin_table.to_excel(writer, sheet_name='parsed_reference', index=False)
@@ -3127,7 +2797,7 @@ def create_report(
         print("Saving Lipid Tree html started")
         fig_tree.write_html(report_path +'/Lipid_tree_plot_interactive.html')
 
-        combined_checklist = [f"{param} within {enrich}" for enrich in enrichment_checklist_subset for param in parameters_checklist]
+        combined_checklist = [] if statistical_test == PERMUTATION_TEST else [f"{param} within {enrich}" for enrich in enrichment_checklist_subset for param in parameters_checklist]
         parameters_to_report = enrichment_checklist + combined_checklist
         parameters_string = ", ".join(parameters_to_report)
 
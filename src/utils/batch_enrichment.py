@@ -0,0 +1,174 @@
+import pandas as pd
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+from utils.common_functions import prepare_for_parsing, character_exchange_df, prepare_for_storing
+from utils.hypothesis_correction import correct_table
+from utils.convert_batch import convert_tables
+from utils.enrichment_planner import PlanFrames, plan_enrichment, run_plan
+from utils.statistics_permutation import PERMUTATION_ITERATIONS
+
+
+BATCH_WORKERS = int(os.environ.get('LORA_BATCH_WORKERS', 4))
+
+# 'level': as in the result table of a single query, 'query': all terms of a query, 'batch': all terms of all queries
+BATCH_CORRECTIONS = ['level', 'query', 'batch']
+
+BATCH_COLUMNS = ['Query', 'Term (Group)', 'Term (Classifier)', 'Level', 'No Query', 'No Reference', 'p-value', 'Odds Ratio', 'FDR', 'Hypothesis Correction Result']
+
+
+
+def split_query_set(files):
+
+    '''
+    Split an uploaded query set into query lists, every column of every file is one query
+
+    Param
+    -------
+    files: list
+           (filename, DataFrame) for every uploaded file
+
+    Returns
+    -------
+    queries: dict
+             query id -> lipid names prepared for parsing; the id is the column header, or the file name
+             with the column number for files without a header
+    '''
+
+    queries = {}
+
+    for filename, df in files:
+        if df is None:
+            continue
+
+        stem = os.path.splitext(os.path.basename(str(filename)))[0]
+
+        for i, column in enumerate(df.columns):
+            if isinstance(column, str) and not column.startswith('Unnamed'):
+                query_id = column
+            else:
+                query_id = stem if len(df.columns) == 1 else stem + ' ' + str(i + 1)
+
+            while query_id in queries:
+                query_id = query_id + "'"
+
+            names = df[column].dropna().astype(str).to_frame()
+            names = character_exchange_df(prepare_for_parsing(names))
+
+            queries[query_id] = names.iloc[:, 0].str.rstrip(' ')
+
+    return queries
+
+
+
+def parse_query_set(queries, grammar, path, progress=None):
+
+    '''
+    Parse all queries of a set at once, names shared by several queries are parsed once
+
+    Param
+    -------
+    queries: dict
+             returned by split_query_set
+    grammar: string
+    path: string
+          directory for temporary input files
+    progress: function
+
+    Returns
+    -------
+    parsed: dict
+            query id -> parsed table prepared as the stored ones, the queries without any parsed lipid are left out
+    '''
+
+    if len(queries) == 0:
+        return {}
+
+    tables = convert_tables(list(queries.values()), grammar, path, progress)
+
+    parsed = {}
+
+    for query_id, table in zip(queries, tables):
+        if table is None or 'Normalized Name' not in table.columns or 'Lipid Maps Category' not in table.columns:
+            print('No lipids were parsed in the query ' + str(query_id) + '.')
+            continue
+
+        parsed[query_id] = prepare_for_storing(table).reset_index(drop=True)
+
+    return parsed
+
+
+
+def run_batch_enrichment(queries, universe, checklist, checklist_subset, param_checklist, statistical_test, alternative, statistical_method, alpha_level, filter_count,
+                         correction='level', workers=BATCH_WORKERS, prepared=False, iterations=PERMUTATION_ITERATIONS, seed=None, universe_fingerprint=None):
+
+    '''
+    Run the enrichment analysis of many queries against one universe, the universe frames and its index are
+    prepared once and the queries are computed in parallel
+
+    Param
+    -------
+    queries: dict
+             query id -> parsed query table, e.g. returned by parse_query_set
+    universe: DataFrame
+              parsed universe table
+    checklist: list
+    checklist_subset: list
+    param_checklist: list
+    statistical_test: string
+                      'Fisher exact test', 'Hypergeometric' or 'Permutation test'
+    alternative: string
+    statistical_method: string
+    alpha_level: float
+    filter_count: int
+    correction: string
+                scope of the multiple hypothesis correction, options: BATCH_CORRECTIONS
+    workers: int
+             number of queries computed at the same time
+    prepared: bool
+              universe already went through separate_db_position_geometry
+    iterations: int
+                number of permutations, permutation test only
+    seed: int
+          seed of the permutations, the same for every query
+    universe_fingerprint: string
+                          content hash of the universe table
+
+    Returns
+    -------
+    df: DataFrame
+        one row for every (query, term): BATCH_COLUMNS, 'Odds Ratio' for the Fisher exact test only
+    '''
+
+    if correction not in BATCH_CORRECTIONS:
+        raise ValueError('Unknown correction ' + str(correction) + ', options: ' + ', '.join(BATCH_CORRECTIONS) + '.')
+
+    plan = plan_enrichment(checklist, checklist_subset, param_checklist)
+    shared = PlanFrames(pd.DataFrame(), universe, prepared, universe_fingerprint)
+
+    if len(plan) == 0 or len(queries) == 0:
+        return pd.DataFrame(columns=[column for column in BATCH_COLUMNS if column != 'Odds Ratio'])
+
+    # the universe side is prepared before fanning out, every query then only groups its own rows
+    for frames in dict.fromkeys(step['frames'] for step in plan):
+        shared.get('universe_acyls' if frames == 'acyls' else 'universe')
+        shared.universe_index(frames)
+
+    def run(item):
+        query_id, query = item
+        # the term families of one query run one after another, the queries are the parallel unit
+        df = run_plan(plan, shared.for_query(query), statistical_test, alternative, statistical_method, alpha_level, filter_count, 1, iterations, seed)
+        df.insert(0, 'Query', query_id)
+        return df
+
+    with ThreadPoolExecutor(max_workers=max(1, min(len(queries), workers))) as executor:
+        dfs = list(executor.map(run, queries.items()))
+
+    df = pd.concat(dfs, ignore_index=True)
+    df = df[[column for column in BATCH_COLUMNS if column in df.columns]]
+
+    if correction != 'level' and len(df.index) > 0:
+        df = correct_table(df, statistical_method, alpha_level, by='Query' if correction == 'query' else None)
+
+    return df
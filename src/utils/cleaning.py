@@ -2,11 +2,12 @@ import os
 import time
 import shutil
 from utils.reporter import get_jar_file
+from utils.session_store import clear_session_store
 
 def clear_old_assets_and_cache(original_cwd, current_session_id):
 
     '''
-    It navigates to the "assets" and "cache-dir" directory, iterates through its contents, and removes any files or folders that are not in the list_to_retain and are older than a specified time limit (11 minutes in this case). The function then returns to the original working directory.
+    It navigates to the "assets" and "cache-dir" directory (the "session-store" of parsed tables is cleared separately, by session inactivity, see clear_session_store), iterates through its contents, and removes any files or folders that are not in the list_to_retain and are older than a specified time limit (11 minutes in this case). The function then returns to the original working directory.
     
     Param
     -------
@@ -71,4 +72,7 @@ def clear_old_assets_and_cache(original_cwd, current_session_id):
 
     clear_directory(cache_directory, cache_to_retain)
 
-    os.chdir(original_cwd)
\ No newline at end of file
+    os.chdir(original_cwd)
+
+    # Clear stored parsed tables
+    clear_session_store(current_session_id)
\ No newline at end of file
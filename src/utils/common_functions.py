@@ -6,13 +6,21 @@ import re
 from re import search
 import pandas as pd
 import numpy as np
+import threading
+from collections import OrderedDict
 
 from scipy.stats import rankdata
 from dash import dash_table
 import plotly.graph_objects as go
 
-import statsmodels.stats.multitest as smt
+from utils.hypothesis_correction import multiple_test_correction
 from utils.upset_chart import plotly_upset_plot_pivot, plotly_upset_figure
+from utils.session_store import table_fingerprint
+
+CHARACTER_EXCHANGE_PATTERN = re.compile(r';(\d+)O$')
+FA_DB_POSITION_COLUMN_PATTERN = re.compile(r'^(FA\d+ )DB Positions$')
+DB_POSITION_PATTERN = re.compile(r'(?:^|\|)(?:(?P<number>\d+)(?P<geometry>[a-zA-Z]+)[^|]*|(?P<number_only>\d+)|(?P<geometry_only>[a-zA-Z]+))(?=\||$)')
+
 
 
 def fdr(p_vals, method, alpha_level):
@@ -25,22 +33,18 @@ def fdr(p_vals, method, alpha_level):
     p_vals: numpy.ndarray
             already sorted in ascending order
     method: string
-            https://www.statsmodels.org/dev/generated/statsmodels.stats.multitest.multipletests.html
+            'fdr_bh', 'bonferroni' or 'holm', see multiple_test_correction
     alpha_level: float
                  threshold value for multiple tests
                  
     Returns
     -------
-    mt[0]: numpy.ndarray, bool
-           true for hypothesis that can be rejected for given alpha
-
-    mt[1]: numpy.ndarray
-           p-values corrected for multiple tests
+    pvals_corrected: numpy.ndarray
+                     p-values corrected for multiple tests, 'N.D.' for less than two p-values
     '''
 
-    if p_vals != []:
-        mt = smt.multipletests(pvals=p_vals, alpha=alpha_level, method=method, is_sorted=True)
-        return mt[1]
+    if len(p_vals) > 1:
+        return multiple_test_correction(p_vals, method, alpha_level)[0]
     else:
         return 'N.D.'
 
@@ -63,15 +67,19 @@ def character_exchange(lipid_name):
                 original lipid name
     '''
 
-    try:
-        position =  re.search(r';\d+O$', lipid_name).span()
-        object = lipid_name[position[0]:position[1]]
-        number = re.findall(r"\d+", object)
-        new_lipid_name = lipid_name[:position[0]+1] + lipid_name[position[0]+2] + number[0]
-        return new_lipid_name
-    except:
+    if not isinstance(lipid_name, str):
         return lipid_name
 
+    match = CHARACTER_EXCHANGE_PATTERN.search(lipid_name)
+
+    if match is None:
+        return lipid_name
+
+    position = match.start()
+    new_lipid_name = lipid_name[:position+1] + lipid_name[position+2] + match.group(1)
+
+    return new_lipid_name
+
 
 
 def character_exchange_df(df):
@@ -89,17 +97,9 @@ def character_exchange_df(df):
          edited dataframe
     '''
 
-    # init lipid names
-    lipids = []
+    # only names with ; can contain a misdefined entry
+    lipids = [character_exchange(name) if ';' in name else name for name in df.iloc[:, 0].astype(str)]
 
-    try:
-        # iterate over each row
-        for row in df.iloc[:, 0]:
-            row = character_exchange(str(row))
-            lipids.append(row)
-    except:
-        print('Character_exchange_df cant be executed.')
-        
     df2 = pd.DataFrame(lipids)
 
     return df2 
@@ -132,9 +132,11 @@ def prepare_for_parsing(df):
 
     df = df.iloc[:, 0].dropna()
 
-    df  = df.apply(lambda x: separate_lipids(x)).reset_index(drop=True)
-    df = df.drop(df[df == ''].index)
-    df = df.drop(df[df == 'Original name'].index)
+    # same as separate_lipids, the name after the first | if there is one
+    lipids = [name.split('|')[1] if '|' in name else name for name in df]
+    df = pd.Series(lipids, name=df.name, dtype=df.dtype)
+
+    df = df[~df.isin(['', 'Original name'])]
     df = df.reset_index(drop=True)
     df = df.to_frame()
 
@@ -520,10 +522,63 @@ def get_FA(carbon_chain, double_bond, bond_type, name):
 
 
 
+def get_FA_column(df, chain):
+
+    '''
+    Generate fatty acyls of one chain for all rows at once, the same strings as get_FA
+
+    Param
+    -------
+    df: dataframe
+    chain: string
+           FA1, FA2, ...
+
+    Returns
+    -------
+    fatty acyls: series
+    '''
+
+    carbon_chain = pd.to_numeric(df[chain + ' #C'], errors='coerce')
+    double_bond = pd.to_numeric(df[chain + ' #DB'], errors='coerce')
+    bond_type = df[chain + ' Bond Type'].astype(object)
+    name = df['Normalized Name'].astype(object)
+
+    defined = (carbon_chain.notna() & double_bond.notna()).to_numpy()
+    acyl = np.full(len(df.index), None, dtype=object)
+    acyl[(carbon_chain.isna() & double_bond.isna()).to_numpy()] = np.nan
+
+    if (carbon_chain.notna() != double_bond.notna()).any():
+        print('Unable to get FA.')
+
+    numbers = (carbon_chain[defined].astype('int64').astype(str) + ':' + double_bond[defined].astype('int64').astype(str)).to_numpy()
+    bond_type = bond_type.to_numpy()[defined]
+    name = name.to_numpy()[defined]
+
+    acyl_defined = np.full(len(numbers), None, dtype=object)
+    ester = bond_type == 'ESTER'
+    acyl_defined[ester] = numbers[ester]
+
+    for bond, pattern in [('ETHER_PLASMANYL', ' O-'), ('ETHER_PLASMENYL', ' P-')]:
+        ether = (bond_type == bond) & pd.notna(name)
+        prefix = pd.Series(name[ether], dtype=object).astype(str).str.findall(pattern).str.join('').str.strip()
+        acyl_defined[ether] = (prefix + numbers[ether]).to_numpy()
+
+    acyl[defined] = acyl_defined
+
+    return pd.Series(acyl, index=df.index, dtype=object)
+
+
+
+FA_DF_CACHE = OrderedDict()
+FA_DF_CACHE_SIZE = 8
+FA_DF_CACHE_LOCK = threading.Lock()
+
+
+
 def get_FA_df(df):
 
     '''
-    Generate melted dataframe for calculation fatty acyls enrichment
+    Generate melted dataframe for calculation fatty acyls enrichment, memoised on the content of df
 
     Param
     -------
@@ -535,16 +590,28 @@ def get_FA_df(df):
     
     '''
 
+    key = table_fingerprint(df)
+
+    with FA_DF_CACHE_LOCK:
+        if key in FA_DF_CACHE:
+            FA_DF_CACHE.move_to_end(key)
+            return FA_DF_CACHE[key].copy()
+
     FA_chains = get_FA_options(df)
 
-    for i in FA_chains:
-        i_cols = [col for col in df.columns if '{}'.format(i) in col]
-        df['{}'.format(i)] = df.apply(lambda x: get_FA(x[i + ' #C'], x[i + ' #DB'], x[i + ' Bond Type'], x['Normalized Name']), axis=1)
-    
+    # acyls of the chains replace the previous ones at the end of the columns
+    acyls = pd.DataFrame({i: get_FA_column(df, i) for i in FA_chains}, index=df.index)
+    df = pd.concat([df.drop(columns=[i for i in FA_chains if i in df.columns]), acyls], axis=1)
+
     col_names = list(df.columns.values)[:-(len(FA_chains))]
     df = df.melt(id_vars = col_names, var_name ='FAs', value_name ='Acyls')
 
-    return df
+    with FA_DF_CACHE_LOCK:
+        FA_DF_CACHE[key] = df
+        while len(FA_DF_CACHE) > FA_DF_CACHE_SIZE:
+            FA_DF_CACHE.popitem(last=False)
+
+    return df.copy()
 
 
 def gen_table_demo(path_to_dir):
@@ -824,7 +891,8 @@ def get_db_position_geometry(cell):
 def separate_db_position_geometry(df):
 
     '''
-    Apply get_db_position_geometry function to dataframe and generate two new columns - one for position numbers, second for position geometry.
+    Generate two new columns from the double bond positions of every fatty acyl - one for position numbers, second for position geometry.
+    Same result as get_db_position_geometry applied to every cell, computed for whole columns at once.
 
     Param
     -------
@@ -836,24 +904,29 @@ def separate_db_position_geometry(df):
     '''
 
     for column in df.columns:
-        if 'DB Position' in column and 'LCB' not in column:
-
-            FA_position = re.search(r'^FA\d+ ', column).span()
-            FA_name = column[:FA_position[1]]
-
-            df[column] = df[column].fillna('')
-            df['{}DB Position Numbers'.format(FA_name)] = df[column].str.split('|')
-
-            df['{}DB Position Geometries'.format(FA_name)] = np.nan
-            df['{}DB Position Numbers'.format(FA_name)] = df['{}DB Position Numbers'.format(FA_name)].apply(lambda x: get_db_position_geometry(x))
-            df['{}DB Position Numbers'.format(FA_name)] = df['{}DB Position Numbers'.format(FA_name)].fillna(value=np.nan)
-            for i, row in df['{}DB Position Numbers'.format(FA_name)].items():
-                if pd.isna(row) != True:
-                    try:
-                        df.loc[i, '{}DB Position Numbers'.format(FA_name)] = row.split(',')[0]
-                        df.loc[i, '{}DB Position Geometries'.format(FA_name)] = row.split(',')[1]
-                    except:
-                        pass
+        FA_match = FA_DB_POSITION_COLUMN_PATTERN.match(str(column))
+        if FA_match is None:
+            continue
+
+        FA_name = FA_match.group(1)
+
+        df[column] = df[column].fillna('')
+        positions = df[column][df[column].map(type) == str]
+
+        # every position is '9Z', '9' or 'Z', the '|' separated positions of the distinct cells are found in one pass
+        cells = pd.Series(positions.unique(), dtype=object)
+        matches = cells.str.extractall(DB_POSITION_PATTERN) if len(cells) > 0 else pd.DataFrame(columns=['number', 'geometry', 'number_only', 'geometry_only'])
+        numbers = matches['number'].fillna(matches['number_only']).dropna()
+        geometries = matches['geometry'].fillna(matches['geometry_only']).dropna()
+
+        numbers = numbers.groupby(level=0).agg('|'.join).reindex(cells.index, fill_value='')
+        geometries = geometries.groupby(level=0).agg('|'.join).reindex(cells.index, fill_value='')
+
+        numbers = positions.map(pd.Series(numbers.to_numpy(), index=cells.to_numpy()))
+        geometries = positions.map(pd.Series(geometries.to_numpy(), index=cells.to_numpy()))
+
+        df['{}DB Position Numbers'.format(FA_name)] = pd.Series(numbers, index=df.index, dtype=object)
+        df['{}DB Position Geometries'.format(FA_name)] = pd.Series(geometries, index=df.index, dtype=object) if len(positions) > 0 else np.nan
     
     return df
 
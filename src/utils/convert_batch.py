@@ -1,71 +1,762 @@
 import pandas as pd
 import numpy as np
-import subprocess
-from subprocess import PIPE, Popen
-from io import StringIO
+import tempfile
+from subprocess import PIPE, DEVNULL, Popen
+from pandas.api.types import union_categoricals
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import atexit
+import importlib.metadata
 import os
 
+from utils.parse_cache import ParseCache, get_parser_version
+from utils.convert_pygoslin import PygoslinParser, order_columns
+
+
+PARSER_BACKEND = os.environ.get('LORA_PARSER_BACKEND', 'jgoslin')
+JGOSLIN_POOL_SIZE = int(os.environ.get('LORA_JGOSLIN_POOL_SIZE', 2))
+JGOSLIN_SHARD_SIZE = int(os.environ.get('LORA_JGOSLIN_SHARD_SIZE', 5000))
+JGOSLIN_CHUNK_SIZE = 2000
+
+# read_csv defaults for missing values and booleans, the parsed tables keep the same types
+JGOSLIN_NA_VALUES = ['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+                     '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'n/a', 'nan', 'null']
+JGOSLIN_BOOL_VALUES = {'True': True, 'TRUE': True, 'true': True, 'False': False, 'FALSE': False, 'false': False}
+
+# message of the names the parser returned no row for
+UNMATCHED_NAME_MESSAGE = 'Lipid name was not returned by the parser.'
+
 
-def convert_table(df, grammar, path):
+
+def get_java_cli(folder_path='assets'):
 
     '''
-    Receiving a df containing a list of lipid names and processing with jgoslin
+    Find the jgoslin-cli jar file in the assets directory
+
+    Param
+    -------
+    folder_path: string
+
+    Returns
+    -------
+    java_cli: string
+              path to the jar file
+
+    Raise
+    -------
+    ValueError if there is no or more than one jar file
+    '''
+
+    file_list = os.listdir(folder_path)
+    jar_list = [f for f in file_list if f.endswith('.jar')]
+
+    if len(jar_list) == 1:
+        return os.path.join(folder_path, jar_list[0])
+    else:
+        raise ValueError(f'No or multiple jar files, expected in {folder_path}, expected just one.')
+
+
+
+def jgoslin_command(java_cli, grammar, input_file):
+
+    '''
+    Build the jgoslin-cli command line for the chosen grammar
+
+    Param
+    -------
+    java_cli: string
+    grammar: string
+    input_file: string
+                file with one lipid name per line
+
+    Returns
+    -------
+    command: list
+    '''
+
+    if grammar == 'LIPID':
+        return ['java', '-jar', java_cli, '-f', input_file]
+    else:
+        return ['java', '-jar', java_cli, '-f', input_file, '-g', grammar]
+
+
+
+def run_streaming(process, filedata, consume):
+
+    '''
+    Feed lipid names to a jgoslin process and consume its output as it arrives
+
+    Param
+    -------
+    process: Popen
+             jgoslin process with piped stdout, stdin is piped when filedata is given
+    filedata: string or None
+    consume: function
+             reads the output stream of jgoslin
+
+    Returns
+    -------
+    result: object
+            returned by consume, None when jgoslin failed
+    '''
+
+    def feed():
+        try:
+            process.stdin.write(filedata.encode('utf-8'))
+            process.stdin.close()
+        except (BrokenPipeError, OSError):
+            pass
+
+    # write from a thread so a full stdout pipe can not block the input
+    writer = None
+    if filedata is not None:
+        writer = threading.Thread(target=feed, daemon=True)
+        writer.start()
+
+    try:
+        result = consume(process.stdout)
+    except Exception as e:
+        print('Java cli error:', e)
+        result = None
+    finally:
+        process.stdout.close()
+        if writer is not None:
+            writer.join()
+        process.wait()
+
+    if process.returncode != 0:
+        return None
+
+    return result
+
+
+
+class JgoslinWorkerPool:
+
+    '''
+    Pool of warm jgoslin-cli processes.
+
+    jgoslin-cli reads its whole input before it answers, so one process serves one batch of names.
+    The pool keeps up to pool_size processes per grammar already started and waiting for their
+    names on stdin, which takes the JVM start-up off the request path. Every handed-out worker is
+    replaced immediately, dead workers are dropped by the health check and a crashed batch is
+    retried once on a fresh process.
+    '''
+
+    def __init__(self, java_cli, pool_size=JGOSLIN_POOL_SIZE):
+        self.java_cli = java_cli
+        self.pool_size = pool_size
+        self.workers = {}
+        self.lock = threading.Lock()
+        # jgoslin-cli takes its input as a file, stdin is passed through /dev/stdin
+        self.stdin_supported = os.path.exists('/dev/stdin')
+        self.enabled = pool_size > 0 and self.stdin_supported
+
+    def _spawn(self, grammar):
+        return Popen(jgoslin_command(self.java_cli, grammar, '/dev/stdin'), stdin=PIPE, stdout=PIPE, stderr=DEVNULL)
+
+    @staticmethod
+    def _is_healthy(worker):
+        return worker.poll() is None
+
+    def warm_up(self, grammar):
+        if not self.enabled:
+            return
+
+        with self.lock:
+            idle = self.workers.setdefault(grammar, deque())
+            while len(idle) > 0 and not self._is_healthy(idle[0]):
+                idle.popleft()
+            while len(idle) < self.pool_size:
+                idle.append(self._spawn(grammar))
+
+    def acquire(self, grammar):
+        worker = None
+
+        with self.lock:
+            idle = self.workers.setdefault(grammar, deque())
+            while len(idle) > 0 and worker is None:
+                candidate = idle.popleft()
+                if self._is_healthy(candidate):
+                    worker = candidate
+
+        if worker is None:
+            worker = self._spawn(grammar)
+
+        self.warm_up(grammar)
+
+        return worker
+
+    def parse(self, filedata, grammar, consume):
+
+        '''
+        Parse lipid names on a warm worker, the output is consumed while jgoslin writes it
+
+        Param
+        -------
+        filedata: string
+                  lipid names separated by new lines
+        grammar: string
+        consume: function
+                 reads the output stream of jgoslin, see read_jgoslin_output
+
+        Returns
+        -------
+        result: object
+                returned by consume, None when the batch could not be parsed
+        '''
+
+        for attempt in range(2):
+            worker = self.acquire(grammar) if attempt == 0 and self.enabled else self._spawn(grammar)
+            result = run_streaming(worker, filedata, consume)
+
+            if result is not None:
+                return result
+
+        return None
+
+    def disable(self):
+        self.enabled = False
+        self.stdin_supported = False
+        self.shutdown()
+
+    def shutdown(self):
+        with self.lock:
+            for idle in self.workers.values():
+                for worker in idle:
+                    if self._is_healthy(worker):
+                        worker.kill()
+            self.workers = {}
+
+
+
+class JgoslinBackend:
+
+    '''
+    Parser backend running jgoslin-cli on the worker pool, requires java and the jar in assets
+    '''
+
+    name = 'jgoslin'
+    parallel = True
+
+    def __init__(self, java_cli):
+        self.pool = JgoslinWorkerPool(java_cli)
+
+    def version(self):
+        return 'jgoslin ' + get_parser_version(self.pool.java_cli)
+
+    def warm_up(self, grammar):
+        self.pool.warm_up(grammar)
+
+    def shutdown(self):
+        self.pool.shutdown()
+
+    def parse(self, names, grammar, path, progress=None):
+        return parse_shard(names, grammar, self.pool, path, progress)
+
+
+
+class PygoslinBackend:
+
+    '''
+    Parser backend running the pygoslin grammars in-process, the table has the columns of jgoslin-cli
+    '''
+
+    name = 'pygoslin'
+    parallel = False
+
+    def __init__(self):
+        self.parser = PygoslinParser()
+
+    def version(self):
+        return 'pygoslin ' + importlib.metadata.version('pygoslin')
+
+    def warm_up(self, grammar):
+        with self.parser.lock:
+            self.parser.get_parsers(grammar)
+
+    def shutdown(self):
+        pass
+
+    def parse(self, names, grammar, path, progress=None):
+        frames = self.parser.parse(names, grammar, progress, JGOSLIN_CHUNK_SIZE)
+        table = concat_categorical_frames([frame.astype('category') for frame in frames])
+        table = table[order_columns(table.columns)]
+
+        return index_by_name(table, names)
+
+
+
+_parser_backend = None
+_parse_cache = None
+_backend_lock = threading.Lock()
+
+
+def get_parser_backend():
+
+    '''
+    Get the parser backend shared by all sessions, create it on first use
+
+    LORA_PARSER_BACKEND selects 'jgoslin' (default) or 'pygoslin', pygoslin is used only when
+    selected, its tables are checked against jgoslin by tests/test_parser_backends.py
+
+    Returns
+    -------
+    backend: JgoslinBackend or PygoslinBackend
+    '''
+
+    global _parser_backend
+
+    with _backend_lock:
+        if _parser_backend is None:
+            if PARSER_BACKEND == 'pygoslin':
+                _parser_backend = PygoslinBackend()
+            else:
+                _parser_backend = JgoslinBackend(get_java_cli())
+
+            atexit.register(_parser_backend.shutdown)
+
+    return _parser_backend
+
+
+
+def get_parse_cache():
+
+    '''
+    Get the parse cache shared by all sessions, create it on first use
+
+    Returns
+    -------
+    parse_cache: ParseCache
+    '''
+
+    global _parse_cache
+
+    with _backend_lock:
+        if _parse_cache is None:
+            _parse_cache = ParseCache()
+
+    return _parse_cache
+
+
+
+def read_jgoslin_output(stream, progress=None):
+
+    '''
+    Read the jgoslin output chunk by chunk while it is written
+
+    The text fields are kept as categorical columns, so the output is never held as one
+    large buffer, the types are given to the columns later by infer_column.
 
     Param
     -------
+    stream: file object
+            stdout of jgoslin
+    progress: function
+              called with the number of rows of every chunk read
+
+    Returns
+    -------
+    table: dataframe
+           categorical columns with the raw text fields
+    '''
+
+    frames = []
+
+    for chunk in pd.read_csv(stream, sep='\t', dtype=str, keep_default_na=False, chunksize=JGOSLIN_CHUNK_SIZE):
+        frames.append(chunk.astype('category'))
+
+        if progress is not None:
+            progress(len(chunk))
+
+    return concat_categorical_frames(frames)
+
+
+
+def concat_categorical_frames(frames):
+
+    '''
+    Concatenate frames with categorical columns, the columns stay categorical
+
+    Param
+    -------
+    frames: list
+            dataframes with categorical columns, not all need to have the same columns
+
+    Returns
+    -------
     df: dataframe
-        contains lipid names
+    '''
+
+    frames = [frame for frame in frames if len(frame) > 0]
+
+    if len(frames) == 0:
+        return pd.DataFrame()
+
+    columns = list(dict.fromkeys(column for frame in frames for column in frame.columns))
+    no_categories = pd.Index([], dtype=object)
+    data = {}
+
+    for column in columns:
+        parts = []
+        for frame in frames:
+            if column in frame.columns:
+                parts.append(frame[column].array)
+            else:
+                parts.append(pd.Categorical.from_codes(np.full(len(frame), -1), categories=no_categories))
+        data[column] = union_categoricals(parts)
+
+    index = np.concatenate([frame.index.to_numpy(dtype=object) for frame in frames])
+
+    return pd.DataFrame(data, index=index)
+
+
+
+def infer_column(column):
+
+    '''
+    Give a categorical column of raw text fields the type read_csv would give it
+
+    Only the categories are converted, the values are then taken by the category codes.
+
+    Param
+    -------
+    column: series
+            categorical column with raw text fields
+
+    Returns
+    -------
+    column: series
+            int, float, bool or object column
+    '''
+
+    column = column.cat.remove_unused_categories()
+    categories = pd.Series(column.cat.categories.to_numpy(dtype=object), dtype=object)
+    codes = column.cat.codes.to_numpy()
+
+    if len(categories) == 0:
+        return pd.Series(np.nan, index=column.index, dtype='float64')
+
+    # missing fields and the NA spellings of read_csv become NaN
+    na_categories = categories.isin(JGOSLIN_NA_VALUES).to_numpy()
+    is_na = (codes == -1) | na_categories[codes]
+    values = categories[~na_categories]
+
+    if is_na.all():
+        return pd.Series(np.nan, index=column.index, dtype='float64')
+
+    try:
+        converted = pd.to_numeric(values).to_numpy()
+    except (ValueError, TypeError):
+        converted = None
+
+    if converted is not None:
+        if converted.dtype.kind in 'iu' and not is_na.any():
+            lookup = np.zeros(len(categories), dtype=converted.dtype)
+        else:
+            lookup = np.full(len(categories), np.nan)
+        lookup[~na_categories] = converted
+
+    elif values.isin(list(JGOSLIN_BOOL_VALUES)).all():
+        lookup = categories.map(JGOSLIN_BOOL_VALUES).to_numpy(dtype=object)
+
+    else:
+        lookup = categories.to_numpy(dtype=object)
+
+    result = lookup[codes]
+
+    if is_na.any():
+        result[is_na] = np.nan
+    elif converted is None and values.isin(list(JGOSLIN_BOOL_VALUES)).all():
+        result = result.astype(bool)
+
+    return pd.Series(result, index=column.index)
+
+
+
+def index_by_name(table, names):
+
+    '''
+    Index the rows of the jgoslin output by the parsed names
+
+    Param
+    -------
+    table: dataframe
+           output of read_jgoslin_output
+    names: list
+           names in the order they were sent to jgoslin
+
+    Returns
+    -------
+    table: dataframe
+    '''
+
+    # one output row per input line, otherwise match on the name jgoslin echoes back
+    if len(table) == len(names):
+        table.index = pd.Index(names, dtype=object)
+    else:
+        table.index = pd.Index(np.asarray(table['Original Name'], dtype=object))
+
+    return table[~table.index.duplicated()]
+
+
+
+def fill_unmatched_rows(rows, missing, names):
+
+    '''
+    Fill the rows of names the parser returned no row for, they keep their original name and a message
+    and have no normalized name, the same as the names jgoslin could not parse
+
+    Param
+    -------
+    rows: dataframe
+          categorical parser output reindexed by the input names, empty fields for the missing ones
+    missing: numpy.ndarray, bool
+    names: list
+
+    Returns
+    -------
+    rows: dataframe
+    '''
+
+    fills = {'Original Name': np.asarray(names, dtype=object)[missing]}
+    if 'Message' in rows.columns:
+        fills['Message'] = np.full(int(missing.sum()), UNMATCHED_NAME_MESSAGE, dtype=object)
+
+    for column, values in fills.items():
+        categories = rows[column].cat.categories
+        rows[column] = rows[column].cat.add_categories(pd.Index(pd.unique(values)).difference(categories))
+        rows.loc[missing, column] = values
+
+    return rows
+
+
+
+def cached_rows_to_frame(rows):
+
+    '''
+    Turn rows from the parse cache into a frame with categorical columns
+
+    Param
+    -------
+    rows: dict
+          name -> list of (column, value) pairs
+
+    Returns
+    -------
+    table: dataframe
+    '''
+
+    frames = []
+    items = list(rows.items())
+
+    for start in range(0, len(items), JGOSLIN_CHUNK_SIZE):
+        chunk = items[start:start+JGOSLIN_CHUNK_SIZE]
+        frame = pd.DataFrame.from_records([dict(row) for _, row in chunk], index=[name for name, _ in chunk])
+        frames.append(frame.astype('category'))
+
+    return concat_categorical_frames(frames)
+
+
+
+def store_in_parse_cache(parse_cache, table, grammar, version):
+
+    '''
+    Store the rows of freshly parsed names in the parse cache
+
+    Param
+    -------
+    parse_cache: ParseCache
+    table: dataframe
+           categorical jgoslin output indexed by name
+    grammar: string
+    version: string
+
+    Returns
+    -------
+    none
+    '''
+
+    for start in range(0, len(table), JGOSLIN_CHUNK_SIZE):
+        chunk = table.iloc[start:start+JGOSLIN_CHUNK_SIZE].astype(object)
+        rows = {}
+
+        for name, values in zip(chunk.index, chunk.itertuples(index=False)):
+            rows[name] = [(column, value) for column, value in zip(chunk.columns, values) if isinstance(value, str)]
+
+        parse_cache.put_many(rows, grammar, version)
+
+
+
+def parse_shard(names, grammar, pool, path, progress=None):
+
+    '''
+    Parse one shard of unseen lipid names with jgoslin
+
+    The names are piped to jgoslin, a temporary input file is written only on platforms
+    where java can not read them from stdin.
+
+    Param
+    -------
+    names: list
+           unique lipid names
+    grammar: string
+    pool: JgoslinWorkerPool
+    path: string
+          directory for the temporary input file
+    progress: function
+              called with the number of rows of every chunk read
+
+    Returns
+    -------
+    table: dataframe
+           categorical jgoslin output indexed by name, None if parsing failed
+    '''
+
+    def consume(stream):
+        return read_jgoslin_output(stream, progress)
+
+    filedata = '\n'.join(names) + '\n'
+
+    table = None
+    if pool.stdin_supported:
+        table = pool.parse(filedata, grammar, consume)
+
+    if table is None:
+        with tempfile.NamedTemporaryFile('w', dir=path, prefix='goslin_in_data_', suffix='.txt', delete=False) as file:
+            file.write(filedata)
+
+        try:
+            process = Popen(jgoslin_command(pool.java_cli, grammar, file.name), stdout=PIPE, stderr=DEVNULL)
+            table = run_streaming(process, None, consume)
+        finally:
+            os.remove(file.name)
+
+        if pool.stdin_supported and table is not None:
+            # java cannot read the names from stdin on this platform, use input files from now on
+            print('jgoslin worker pool disabled, falling back to input files.')
+            pool.disable()
+
+    if table is None:
+        return None
+
+    return index_by_name(table, names)
+
+
+
+def convert_tables(dfs, grammar, path, progress=None):
+
+    '''
+    Receiving dfs containing lists of lipid names and processing them with jgoslin at once
+
+    The distinct names of all dfs are parsed only once. Names parsed before with the same
+    grammar and jar are taken from the parse cache, the unseen names are split into shards
+    parsed in parallel and their output is read in chunks while jgoslin writes it.
+
+    Param
+    -------
+    dfs: list
+         dataframes containing lipid names, e.g. query and universe
     grammar: string
              the chosen grammar to be used for parsing
+    path: string
+          directory for temporary input files, used only when java can not read stdin
+    progress: function
+              called with the number of names parsed so far and the number of names to parse
 
     Returns
     -------
-    df_new: dataframe
+    dfs_new: list
+             parsed dataframe for every input df, None if parsing failed
     '''
 
     def clean_file_data(filedata):
             return filedata.replace('"', '')
 
-    def run_jgoslin_cli(input_list, java_cli, grammar):
-        if grammar == 'LIPID':
-            process = Popen(['java', '-jar', java_cli, '-f', input_list], stdout=PIPE, stderr=PIPE)
+    backend = get_parser_backend()
+
+    names_list = [clean_file_data(df.to_csv(header=None, index=None)).splitlines() for df in dfs]
+
+    parse_cache = get_parse_cache()
+    version = backend.version()
+
+    unique_names = list(dict.fromkeys(name for names in names_list for name in names))
+    cached_rows = parse_cache.get_many(unique_names, grammar, version)
+    unseen_names = [name for name in unique_names if name not in cached_rows]
+
+    tables = [cached_rows_to_frame(cached_rows)]
+    del cached_rows
+
+    parsed = [len(unique_names) - len(unseen_names)]
+    progress_lock = threading.Lock()
+
+    def report(rows):
+        with progress_lock:
+            parsed[0] = min(parsed[0] + rows, len(unique_names))
+            if progress is not None:
+                progress(parsed[0], len(unique_names))
+
+    report(0)
+
+    if len(unseen_names) > 0:
+        shards = [unseen_names[i:i+JGOSLIN_SHARD_SIZE] for i in range(0, len(unseen_names), JGOSLIN_SHARD_SIZE)]
+
+        workers = max(1, min(len(shards), JGOSLIN_POOL_SIZE)) if backend.parallel else 1
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            parsed_shards = list(executor.map(lambda shard: backend.parse(shard, grammar, path, report), shards))
+
+        if any(table is None for table in parsed_shards):
+            print(f'{backend.name} could not parse the lipid names.')
+            return [None] * len(dfs)
+
+        for table in parsed_shards:
+            store_in_parse_cache(parse_cache, table, grammar, version)
+            tables.append(table)
+
+    table = concat_categorical_frames(tables)
+
+    dfs_new = []
+
+    for names in names_list:
+        if len(table) == 0:
+            rows = table.iloc[[]]
         else:
-            process = Popen(['java', '-jar', java_cli, '-f', input_list, '-g', grammar], stdout=PIPE, stderr=PIPE)
+            # one row per input name as in the jgoslin-cli output, names without an output row are reported as not parsed
+            rows = table.reindex(names).reset_index(drop=True)
+            missing = table.index.get_indexer(names) < 0
+            if missing.any():
+                print(f'{backend.name} returned no row for {int(missing.sum())} lipid names, they are reported as not parsed.')
+                rows = fill_unmatched_rows(rows, missing, names)
 
-        return process.communicate()
+        df_new = pd.DataFrame({column: infer_column(rows[column]) for column in rows.columns}, index=rows.index)
 
-    input_file = path + '/goslin_in_data.txt'
+        for column in df_new.columns:
+            if 'SN Position' in column:
+                df_new[column] = df_new[column].where(lambda x: x > 0, np.nan)
 
-    folder_path = 'assets'
-    file_list = os.listdir(folder_path)
-    jar_list = [f for f in file_list if f.endswith('.jar')]
+        dfs_new.append(df_new)
 
-    if len(jar_list) == 1:
-        java_cli = os.path.join(folder_path, jar_list[0])
-    else:
-        raise ValueError(f'No or multiple jar files, expected in {folder_path}, expected just one.')
-    
+    return dfs_new
 
-    df.to_csv(input_file, header=None, index=None)
 
-    with open(input_file, 'r') as file:
-        filedata = file.read()
 
-    with open(input_file, 'w') as file:
-        file.write(clean_file_data(filedata))
+def convert_table(df, grammar, path):
 
-    try:
-        result = run_jgoslin_cli(input_file, java_cli, grammar)
-        table_in = StringIO(result[0].decode('utf-8'))
-        df_new = pd.read_csv(table_in, sep='\t')
-    except Exception as e:
-        print('Java cli error:', e)
-        return None
+    '''
+    Receiving a df containing a list of lipid names and processing with jgoslin
 
-    os.remove(input_file)
+    Param
+    -------
+    df: dataframe
+        contains lipid names
+    grammar: string
+             the chosen grammar to be used for parsing
 
-    for column in df_new.columns:
-        if 'SN Position' in column:
-            df_new[column] = df_new[column].where(lambda x: x > 0, np.nan)
+    Returns
+    -------
+    df_new: dataframe
+    '''
 
-    return df_new
\ No newline at end of file
+    return convert_tables([df], grammar, path)[0]
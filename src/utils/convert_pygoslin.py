@@ -0,0 +1,211 @@
+import pandas as pd
+import threading
+
+try:
+    from pygoslin.parser.Parser import ShorthandParser, GoslinParser, FattyAcidParser, LipidMapsParser, SwissLipidsParser, HmdbParser
+    from pygoslin.domain.LipidLevel import LipidLevel
+    from pygoslin.domain.LipidClass import all_lipids
+except ImportError:
+    ShorthandParser = None
+
+
+# grammar names as written by jgoslin-cli
+GRAMMARS = {
+    'SHORTHAND2020': lambda: ShorthandParser(),
+    'GOSLIN': lambda: GoslinParser(),
+    'FATTY_ACID': lambda: FattyAcidParser(),
+    'LIPIDMAPS': lambda: LipidMapsParser(),
+    'SWISSLIPIDS': lambda: SwissLipidsParser(),
+    'HMDB': lambda: HmdbParser(),
+}
+
+CATEGORY_NAMES = {
+    'UNDEFINED': 'Undefined lipid category',
+    'GL': 'Glycerolipids',
+    'GP': 'Glycerophospholipids',
+    'SP': 'Sphingolipids',
+    'ST': 'Sterol lipids',
+    'FA': 'Fatty acyls',
+    'SL': 'Saccharolipids',
+    'PK': 'Polyketides',
+}
+
+BASE_COLUMNS = ['Normalized Name', 'Original Name', 'Grammar', 'Message', 'Adduct', 'Sum Formula', 'Mass', 'Lipid Maps Category',
+                'Lipid Maps Main Class', 'Functional Class Abbr', 'Functional Class Synonyms', 'Level']
+
+CHAIN_COLUMNS = ['SN Position', '#C', '#DB', 'Bond Type', 'DB Positions']
+
+SHORTHAND_LEVELS = ['CATEGORY', 'CLASS', 'SPECIES', 'MOLECULAR_SPECIES', 'SN_POSITION', 'STRUCTURE_DEFINED', 'FULL_STRUCTURE', 'COMPLETE_STRUCTURE']
+
+
+
+def pygoslin_available():
+    return ShorthandParser is not None
+
+
+
+def order_columns(columns):
+
+    '''
+    Order the columns of the parsed table like jgoslin-cli
+
+    Param
+    -------
+    columns: list
+
+    Returns
+    -------
+    columns: list
+    '''
+
+    def key(column):
+        if column in BASE_COLUMNS:
+            return (0, BASE_COLUMNS.index(column), '')
+        if column.startswith('Total #'):
+            return (1, ['Total #C', 'Total #DB'].index(column) if column in ['Total #C', 'Total #DB'] else 2, column)
+        if column.startswith('Lipid Shorthand '):
+            return (3, SHORTHAND_LEVELS.index(column[len('Lipid Shorthand '):]), '')
+
+        chain, field = column.split(' ', 1) if ' ' in column else (column, '')
+        chain_number = 0 if chain == 'LCB' else int(chain[2:]) if chain[2:].isdigit() else 99
+        field_number = CHAIN_COLUMNS.index(field) if field in CHAIN_COLUMNS else len(CHAIN_COLUMNS)
+        return (2, chain_number * (len(CHAIN_COLUMNS) + 1) + field_number, field)
+
+    return sorted(columns, key=key)
+
+
+
+class PygoslinParser:
+
+    '''
+    In-process replacement of jgoslin-cli based on the pygoslin grammars.
+
+    The grammars are compiled once per process. pygoslin parsers keep state while
+    parsing, so the names are parsed one at a time under a lock.
+    '''
+
+    def __init__(self):
+        if not pygoslin_available():
+            raise ValueError('pygoslin is not installed, the in-process parser is not available.')
+
+        self.parsers = {}
+        self.lock = threading.Lock()
+
+    def get_parsers(self, grammar):
+        # the universal LIPID grammar tries the grammars in the order of jgoslin
+        grammar_names = list(GRAMMARS) if grammar == 'LIPID' else [grammar]
+
+        for grammar_name in grammar_names:
+            if grammar_name not in self.parsers:
+                self.parsers[grammar_name] = GRAMMARS[grammar_name]()
+
+        return [(grammar_name, self.parsers[grammar_name]) for grammar_name in grammar_names]
+
+    def parse_name(self, name, grammar):
+
+        '''
+        Parse one lipid name into a row of the jgoslin-cli table
+
+        Param
+        -------
+        name: string
+        grammar: string
+
+        Returns
+        -------
+        row: dict
+             column -> text field, same columns as jgoslin-cli
+        '''
+
+        row = {'Normalized Name': '', 'Original Name': name, 'Grammar': grammar, 'Message': ''}
+
+        lipid = None
+        for grammar_name, parser in self.get_parsers(grammar):
+            try:
+                lipid = parser.parse(name, raise_error=False)
+            except Exception:
+                lipid = None
+            if lipid is not None:
+                row['Grammar'] = grammar_name
+                break
+
+        if lipid is None:
+            row['Message'] = f'Lipid name "{name}" could not be parsed.'
+            return row
+
+        info = lipid.lipid.info
+        lipid_class = all_lipids[lipid.lipid.headgroup.lipid_class]
+        category = lipid.lipid.headgroup.lipid_category.name
+
+        row['Normalized Name'] = lipid.get_lipid_string()
+        row['Adduct'] = lipid.adduct.get_lipid_string() if lipid.adduct is not None else ''
+        try:
+            row['Sum Formula'] = lipid.get_sum_formula()
+            row['Mass'] = '%.4f' % lipid.get_mass()
+        except Exception:
+            row['Message'] = 'Sum formula could not be computed.'
+        row['Lipid Maps Category'] = f'{CATEGORY_NAMES.get(category, category)} [{category}]'
+        row['Lipid Maps Main Class'] = lipid_class['description']
+        row['Functional Class Abbr'] = '[' + lipid_class['name'] + ']'
+        row['Functional Class Synonyms'] = '[' + ', '.join(lipid_class['synonyms']) + ']'
+        row['Level'] = info.level.name
+        row['Total #C'] = str(info.num_carbon)
+        row['Total #DB'] = str(info.db_num())
+
+        for group, functional_groups in info.functional_groups.items():
+            # internal groups of pygoslin are written in brackets
+            if not group.startswith('['):
+                row['Total #' + group] = str(sum(functional_group.count for functional_group in functional_groups))
+
+        for fa in lipid.lipid.fa_list:
+            row[f'{fa.name} SN Position'] = str(fa.position)
+            row[f'{fa.name} #C'] = str(fa.num_carbon)
+            row[f'{fa.name} #DB'] = str(fa.db_num())
+            row[f'{fa.name} Bond Type'] = fa.lipid_FA_bond_type.name
+            if isinstance(fa.double_bonds, dict):
+                row[f'{fa.name} DB Positions'] = '|'.join(f'{position}{geometry}' for position, geometry in sorted(fa.double_bonds.items()))
+
+        for level in SHORTHAND_LEVELS:
+            shorthand = ''
+            if LipidLevel[level].value <= info.level.value:
+                try:
+                    shorthand = lipid.get_lipid_string(LipidLevel[level])
+                except Exception:
+                    shorthand = ''
+            row['Lipid Shorthand ' + level] = shorthand
+
+        return row
+
+    def parse(self, names, grammar, progress=None, chunk_size=2000):
+
+        '''
+        Parse lipid names into the jgoslin-cli table
+
+        Param
+        -------
+        names: list
+        grammar: string
+        progress: function
+                  called with the number of rows of every chunk parsed
+        chunk_size: int
+
+        Returns
+        -------
+        frames: list
+                dataframes with the text fields of chunk_size names each
+        '''
+
+        frames = []
+
+        for start in range(0, len(names), chunk_size):
+            chunk = names[start:start+chunk_size]
+
+            with self.lock:
+                rows = [self.parse_name(name, grammar) for name in chunk]
+
+            frames.append(pd.DataFrame.from_records(rows).fillna(''))
+
+            if progress is not None:
+                progress(len(chunk))
+
+        return frames
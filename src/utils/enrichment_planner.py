@@ -0,0 +1,278 @@
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import os
+
+from utils.common_functions import get_FA_df, separate_db_position_geometry
+from utils.session_store import table_fingerprint
+from utils.term_counts import get_universe_index
+from utils.hypothesis_correction import correct_table
+from utils.statistics_fisher import calculate_enrichment_fisher, calculate_enrichment_within_subset_fisher, calculate_enrichment_fisher_advanced_buckets
+from utils.statistics_hypergeom import calculate_enrichment_hypergeom, calculate_enrichment_within_subset_hypergeom, calculate_enrichment_hypergeom_advanced_buckets
+from utils.statistics_permutation import PERMUTATION_TEST, PERMUTATION_ITERATIONS, calculate_enrichment_permutation
+
+
+ENRICHMENT_WORKERS = int(os.environ.get('LORA_ENRICHMENT_WORKERS', 4))
+
+# 'level': every term level is corrected on its own, 'joint': all terms of the result table together
+ENRICHMENT_CORRECTIONS = ['level', 'joint']
+
+CARBON_OPTIONS = ['acyls containing less than 16 carbon atoms', 'acyls containing 16-18 carbon atoms', 'acyls containing more than 18 carbon atoms']
+DOUBLE_BOND_OPTIONS = ['acyls containing 0 double bonds (saturated)', 'acyls containing 1 double bonds (monounsaturated)', 'acyls containing 2 or more double bonds (polyunsaturated)']
+
+# intermediate frames of the plan, name -> (transform, input frame)
+TRANSFORMS = {
+    'query': (separate_db_position_geometry, 'query_table'),
+    'universe': (separate_db_position_geometry, 'universe_table'),
+    'query_acyls': (get_FA_df, 'query'),
+    'universe_acyls': (get_FA_df, 'universe'),
+}
+
+
+
+def plan_enrichment(checklist, checklist_subset, param_checklist):
+
+    '''
+    Turn the selections of the enrichment tab into the term families to compute, in the order of the
+    result table
+
+    Param
+    -------
+    checklist: list
+               levels of the general enrichment, 'Acyls' for the shorthand levels
+    checklist_subset: list
+                      levels the subsets are tested within
+    param_checklist: list
+                     subsets tested within the levels of checklist_subset, 'Acyls' for the shorthand levels,
+                     'Total #C' and 'Total #DB' add the acyl chain buckets
+
+    Returns
+    -------
+    plan: list
+          dict for every term family: 'family' ('general', 'within' or 'buckets'), 'levels', 'terms'
+          and the frames it reads ('parsed' or 'acyls')
+    '''
+
+    plan = []
+
+    levels = [level for level in checklist if level != 'Acyls']
+    if len(levels) > 0:
+        plan.append({'family': 'general', 'levels': levels, 'terms': None, 'frames': 'parsed'})
+    if 'Acyls' in checklist:
+        plan.append({'family': 'general', 'levels': ['Acyls'], 'terms': None, 'frames': 'acyls'})
+
+    if len(checklist_subset) == 0 or len(param_checklist) == 0:
+        return plan
+
+    terms = [term for term in param_checklist if term != 'Acyls']
+    if len(terms) > 0:
+        plan.append({'family': 'within', 'levels': checklist_subset, 'terms': terms, 'frames': 'parsed'})
+    if 'Acyls' in param_checklist:
+        plan.append({'family': 'within', 'levels': checklist_subset, 'terms': ['Acyls'], 'frames': 'acyls'})
+
+    filters = (CARBON_OPTIONS if 'Total #C' in terms else []) + (DOUBLE_BOND_OPTIONS if 'Total #DB' in terms else [])
+    if len(filters) > 0:
+        plan.append({'family': 'buckets', 'levels': checklist_subset, 'terms': filters, 'frames': 'parsed'})
+
+    return plan
+
+
+
+class PlanFrames:
+
+    '''
+    Intermediate frames of one enrichment request, every transform runs once however many term
+    families read its result; the universe indexes are shared with the other requests against the same
+    reference table
+    '''
+
+    def __init__(self, query, universe, prepared=False, universe_fingerprint=None):
+        self.frames = {'query_table': query, 'universe_table': universe}
+        if prepared:
+            self.frames.update({'query': query, 'universe': universe})
+        self.locks = {name: threading.Lock() for name in TRANSFORMS}
+        self.universe_fingerprint = universe_fingerprint
+
+    def get(self, name):
+        if name not in self.frames:
+            transform, source = TRANSFORMS[name]
+            source_frame = self.get(source)
+            with self.locks[name]:
+                if name not in self.frames:
+                    self.frames[name] = transform(source_frame)
+
+        return self.frames[name]
+
+    def pair(self, frames):
+        if frames == 'acyls':
+            return self.get('query_acyls'), self.get('universe_acyls')
+        return self.get('query'), self.get('universe')
+
+    def for_query(self, query):
+        # another query against the same universe, the universe frames computed so far are shared
+        frames = PlanFrames(query, self.frames['universe_table'], universe_fingerprint=self.universe_fingerprint)
+        frames.frames.update({name: frame for name, frame in self.frames.items() if name.startswith('universe')})
+        return frames
+
+    def universe_index(self, frames):
+        if self.universe_fingerprint is None:
+            with self.locks['universe']:
+                if self.universe_fingerprint is None:
+                    self.universe_fingerprint = table_fingerprint(self.get('universe_table'))
+
+        # the transforms are deterministic, the indexes of one table are told apart by the frames they read
+        name = 'universe_acyls' if frames == 'acyls' else 'universe'
+        return get_universe_index(self.get(name), self.universe_fingerprint + ':' + frames)
+
+
+
+def run_family(step, frames, statistical_test, alternative, statistical_method, alpha_level, filter_count, iterations=PERMUTATION_ITERATIONS, seed=None):
+
+    '''
+    Compute one term family of the plan
+
+    Param
+    -------
+    step: dict
+          returned by plan_enrichment
+    frames: PlanFrames
+    statistical_test: string
+                      'Fisher exact test', 'Hypergeometric' or 'Permutation test'
+    alternative: string
+    statistical_method: string
+    alpha_level: float
+    filter_count: int
+    iterations: int
+                number of permutations, permutation test only
+    seed: int
+          seed of the permutations, permutation test only
+
+    Returns
+    -------
+    df: DataFrame
+    '''
+
+    query, universe = frames.pair(step['frames'])
+    universe_index = frames.universe_index(step['frames'])
+    args = (statistical_method, alpha_level, filter_count)
+
+    if statistical_test == PERMUTATION_TEST:
+        if step['family'] != 'general':
+            raise ValueError('The permutation test is available for the general enrichment only.')
+        return calculate_enrichment_permutation(step['levels'], query, universe, alternative, *args, iterations=iterations, seed=seed, universe_index=universe_index)
+
+    if statistical_test == 'Fisher exact test':
+        if step['family'] == 'general':
+            return calculate_enrichment_fisher(step['levels'], query, universe, alternative, *args, universe_index=universe_index)
+        if step['family'] == 'within':
+            return calculate_enrichment_within_subset_fisher(step['levels'], step['terms'], query, universe, alternative, *args, universe_index=universe_index)
+        return calculate_enrichment_fisher_advanced_buckets(step['levels'], query, universe, alternative, step['terms'], *args, universe_index=universe_index)
+
+    if step['family'] == 'general':
+        return calculate_enrichment_hypergeom(step['levels'], query, universe, *args, universe_index=universe_index)
+    if step['family'] == 'within':
+        return calculate_enrichment_within_subset_hypergeom(step['levels'], step['terms'], query, universe, *args, universe_index=universe_index)
+    return calculate_enrichment_hypergeom_advanced_buckets(step['levels'], query, universe, step['terms'], *args, universe_index=universe_index)
+
+
+
+def run_enrichment(query, universe, checklist, checklist_subset, param_checklist, statistical_test, alternative, statistical_method, alpha_level, filter_count, workers=ENRICHMENT_WORKERS, prepared=False, iterations=PERMUTATION_ITERATIONS, seed=None, universe_fingerprint=None,
+                   correction='level'):
+
+    '''
+    Run the enrichment analysis of the selections on the parsed tables, the shared frames are prepared
+    once and the independent term families are computed in parallel
+
+    Param
+    -------
+    query: DataFrame
+           parsed query table
+    universe: DataFrame
+              parsed universe table
+    checklist: list
+    checklist_subset: list
+    param_checklist: list
+    statistical_test: string
+                      'Fisher exact test', 'Hypergeometric' or 'Permutation test'
+    alternative: string
+                 defines the alternative hypothesis, Fisher exact test and permutation test only
+    statistical_method: string
+    alpha_level: float
+    filter_count: int
+    workers: int
+             number of term families computed at the same time
+    prepared: bool
+              query and universe already went through separate_db_position_geometry
+    iterations: int
+                number of permutations, permutation test only
+    seed: int
+          seed of the permutations, none for a random seed
+    universe_fingerprint: string
+                          content hash of the universe table, e.g. the one of its session store handle; the
+                          universe-side counts are cached under it, hashed here by default
+    correction: string
+                scope of the multiple hypothesis correction, options: ENRICHMENT_CORRECTIONS
+
+    Returns
+    -------
+    df: DataFrame
+        results of all the term families
+    frames: PlanFrames
+            prepared frames, frames.get('query') is the query with separated double bond positions
+    '''
+
+    if correction not in ENRICHMENT_CORRECTIONS:
+        raise ValueError('Unknown correction ' + str(correction) + ', options: ' + ', '.join(ENRICHMENT_CORRECTIONS) + '.')
+
+    plan = plan_enrichment(checklist, checklist_subset, param_checklist)
+    frames = PlanFrames(query, universe, prepared, universe_fingerprint)
+
+    df = run_plan(plan, frames, statistical_test, alternative, statistical_method, alpha_level, filter_count, workers, iterations, seed)
+
+    if correction == 'joint' and len(df.index) > 0:
+        df = correct_table(df, statistical_method, alpha_level)
+
+    return df, frames
+
+
+
+def run_plan(plan, frames, statistical_test, alternative, statistical_method, alpha_level, filter_count, workers=ENRICHMENT_WORKERS, iterations=PERMUTATION_ITERATIONS, seed=None):
+
+    '''
+    Compute the term families of a plan on the frames of one query
+
+    Param
+    -------
+    plan: list
+          returned by plan_enrichment
+    frames: PlanFrames
+    statistical_test: string
+    alternative: string
+    statistical_method: string
+    alpha_level: float
+    filter_count: int
+    workers: int
+             number of term families computed at the same time
+    iterations: int
+    seed: int
+
+    Returns
+    -------
+    df: DataFrame
+        results of all the term families, empty for an empty plan
+    '''
+
+    # prepare the shared frames before fanning out, so no family waits on another one's transform
+    for name in ['query', 'universe'] + (['query_acyls', 'universe_acyls'] if any(step['frames'] == 'acyls' for step in plan) else []):
+        frames.get(name)
+
+    def run(step):
+        return run_family(step, frames, statistical_test, alternative, statistical_method, alpha_level, filter_count, iterations, seed)
+
+    if len(plan) == 0:
+        return pd.DataFrame()
+
+    with ThreadPoolExecutor(max_workers=max(1, min(len(plan), workers))) as executor:
+        dfs = list(executor.map(run, plan))
+
+    return pd.concat(dfs)
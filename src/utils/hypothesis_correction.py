@@ -1,38 +1,130 @@
-import statsmodels.stats.multitest as smt
+import pandas as pd
 import numpy as np
 
 
-def hypothesis_correction(pvals, statistical_method, alpha_level):
-    
+def multiple_test_correction(pvals, statistical_method, alpha_level):
+
     '''
-    Calculate multiple hypothesis correction if the input array is not empty, otherwise returns N.D. (not defined)
-     -> without this 'if' condition bonferroni and holm_bonferroni printed out error message: 'slice indices must be integers or none or have an __index__'
+    Adjusted p-values and rejected hypotheses in one pass over p-values sorted in ascending order, the same
+    values as statsmodels multipletests(is_sorted=True) without calling it once for each output
 
     Param
     -------
     pvals: numpy.ndarray
+           already sorted in ascending order, missing p-values last
     statistical_method: string
+                        options: 'fdr_bh', 'bonferroni', 'holm'
     alpha_level: float
 
     Returns
     -------
-    array_out: numpy.ndarray 
-               
+    pvals_corrected: numpy.ndarray
+    reject: numpy.ndarray, bool
+            true for hypothesis that can be rejected for given alpha
     '''
 
-    if pvals != []:
+    pvals = np.asarray(pvals, dtype=float)
+    ntests = len(pvals)
+
+    if ntests == 0:
+        return np.array([], dtype=float), np.array([], dtype=bool)
 
-        try:
-            if statistical_method == 'fdr_bh':
-                array_out = smt.multipletests(pvals=pvals, alpha=alpha_level, method=statistical_method, is_sorted=True)
-            if statistical_method == 'bonferroni':
-                array_out = smt.multipletests(pvals=pvals, alpha=alpha_level, method=statistical_method, is_sorted=True)
-            if statistical_method == 'holm':
-                array_out = smt.multipletests(pvals=pvals, alpha=alpha_level, method=statistical_method, is_sorted=True)
-        except:
-            print('Error in processing Hypothesis Correction')
+    if statistical_method == 'fdr_bh':
+        ecdffactor = np.arange(1, ntests + 1) / float(ntests)
+        reject = pvals <= ecdffactor * alpha_level
+        rejected = np.flatnonzero(reject)
+        if len(rejected) > 0:
+            reject[:rejected[-1]] = True
+        pvals_corrected = np.minimum.accumulate((pvals / ecdffactor)[::-1])[::-1]
+
+    elif statistical_method == 'bonferroni':
+        reject = pvals <= alpha_level / float(ntests)
+        pvals_corrected = pvals * float(ntests)
+
+    elif statistical_method == 'holm':
+        steps = np.arange(ntests, 0, -1)
+        notreject = pvals > alpha_level / steps
+        not_rejected = np.flatnonzero(notreject)
+        if len(not_rejected) > 0:
+            notreject[not_rejected[0]:] = True
+        reject = ~notreject
+        pvals_corrected = np.maximum.accumulate(pvals * steps)
 
     else:
-        array_out = np.array([False])
-    
-    return array_out[0]
\ No newline at end of file
+        raise ValueError('method not recognized')
+
+    pvals_corrected[pvals_corrected > 1] = 1
+
+    return pvals_corrected, reject
+
+
+
+def hypothesis_correction(pvals, statistical_method, alpha_level):
+
+    '''
+    Calculate multiple hypothesis correction if the input array has more than one p-value, otherwise returns False
+
+    Param
+    -------
+    pvals: numpy.ndarray
+    statistical_method: string
+    alpha_level: float
+
+    Returns
+    -------
+    array_out: numpy.ndarray
+
+    '''
+
+    if len(pvals) > 1:
+        return multiple_test_correction(pvals, statistical_method, alpha_level)[1]
+
+    return False
+
+
+
+def correct_table(df, statistical_method, alpha_level, by=None):
+
+    '''
+    Correct the p-values of a result table jointly, across all of its term levels or within the groups of
+    a column, instead of within every term level
+
+    Param
+    -------
+    df: DataFrame
+        result table with 'p-value', 'FDR' and 'Hypothesis Correction Result' columns
+    statistical_method: string
+    alpha_level: float
+    by: string
+        column with the groups corrected on their own, e.g. 'Query'; none for one group
+
+    Returns
+    -------
+    df: DataFrame
+        same rows, 'FDR' and 'Hypothesis Correction Result' replaced; missing p-values are not tested
+    '''
+
+    p_values = pd.to_numeric(df['p-value'], errors='coerce').to_numpy(dtype=float)
+
+    fdr_values = np.full(len(p_values), np.nan, dtype=object)
+    reject = np.zeros(len(p_values), dtype=bool)
+
+    groups = df.groupby(by, sort=False).indices.values() if by is not None else [np.arange(len(p_values))]
+
+    for rows in groups:
+        tested = rows[~np.isnan(p_values[rows])]
+        order = tested[np.argsort(p_values[tested], kind='mergesort')]
+
+        # single terms are not corrected, the same as in the result table
+        if len(order) > 1:
+            pvals_corrected, rejected = multiple_test_correction(p_values[order], statistical_method, alpha_level)
+            fdr_values[order] = [round(x, 4) for x in pvals_corrected.tolist()]
+            reject[order] = rejected
+        else:
+            fdr_values[order] = 'N.D.'
+
+    df = df.copy()
+    df['FDR'] = fdr_values
+    df['Hypothesis Correction Result'] = reject
+
+    return df
@@ -0,0 +1,132 @@
+import sqlite3
+import hashlib
+import json
+import os
+from contextlib import closing
+from functools import lru_cache
+
+
+PARSE_CACHE_DIR = os.environ.get('LORA_PARSE_CACHE_DIR', './parse-cache')
+
+
+
+@lru_cache(maxsize=8)
+def _file_digest(path, size, mtime):
+    digest = hashlib.sha256()
+
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+
+def get_parser_version(java_cli):
+
+    '''
+    Version of the parser used in the cache keys, the content hash of the jgoslin jar file
+
+    Param
+    -------
+    java_cli: string
+              path to the jar file
+
+    Returns
+    -------
+    version: string
+    '''
+
+    stat = os.stat(java_cli)
+
+    return _file_digest(java_cli, stat.st_size, stat.st_mtime)
+
+
+
+class ParseCache:
+
+    '''
+    Disk-backed cache of parsed lipid names shared by all sessions.
+
+    Every parsed name is stored as one output row of jgoslin, keyed by the hash of
+    (name, grammar, parser version), so a new jar never serves rows of the old one.
+    The rows are kept as the raw text fields of the jgoslin table, which lets the
+    caller rebuild the table with exactly the same type inference as a fresh run.
+    '''
+
+    def __init__(self, cache_dir=PARSE_CACHE_DIR):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.db_path = os.path.join(cache_dir, 'parsed_names.sqlite')
+
+        with closing(self._connect()) as connection, connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS parsed (key TEXT PRIMARY KEY, row TEXT NOT NULL)')
+
+    def _connect(self):
+        connection = sqlite3.connect(self.db_path, timeout=30)
+        connection.execute('PRAGMA journal_mode=WAL')
+        return connection
+
+    @staticmethod
+    def make_key(name, grammar, version):
+        return hashlib.sha256('\t'.join([version, grammar, name]).encode('utf-8')).hexdigest()
+
+    def get_many(self, names, grammar, version):
+
+        '''
+        Look up parsed rows of lipid names
+
+        Param
+        -------
+        names: list
+               unique lipid names
+        grammar: string
+        version: string
+
+        Returns
+        -------
+        rows: dict
+              name -> list of (column, value) pairs, only for the cached names
+        '''
+
+        keys = {self.make_key(name, grammar, version): name for name in names}
+        key_list = list(keys)
+        rows = {}
+
+        try:
+            with closing(self._connect()) as connection, connection:
+                # stay below the sqlite limit of bound parameters
+                for start in range(0, len(key_list), 500):
+                    chunk = key_list[start:start+500]
+                    placeholders = ','.join('?' * len(chunk))
+                    query = f'SELECT key, row FROM parsed WHERE key IN ({placeholders})'
+                    for key, row in connection.execute(query, chunk):
+                        rows[keys[key]] = json.loads(row)
+        except sqlite3.Error as e:
+            print('Parse cache error:', e)
+
+        return rows
+
+    def put_many(self, rows, grammar, version):
+
+        '''
+        Store parsed rows of lipid names
+
+        Param
+        -------
+        rows: dict
+              name -> list of (column, value) pairs
+        grammar: string
+        version: string
+
+        Returns
+        -------
+        none
+        '''
+
+        records = [(self.make_key(name, grammar, version), json.dumps(row)) for name, row in rows.items()]
+
+        try:
+            with closing(self._connect()) as connection, connection:
+                connection.executemany('INSERT OR REPLACE INTO parsed (key, row) VALUES (?, ?)', records)
+        except sqlite3.Error as e:
+            print('Parse cache error:', e)
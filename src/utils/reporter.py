@@ -9,6 +9,7 @@ from datetime import datetime
 
 from fpdf import FPDF
 from pages.layout import get_header_version
+from utils.convert_batch import get_parser_backend
 
 
 class PDF(FPDF):
@@ -75,6 +76,15 @@ def get_jar_file():
     return jar_file
 
 
+def get_parser_name():
+    backend = get_parser_backend()
+
+    if backend.name == 'jgoslin':
+        return get_jar_file()
+    else:
+        return backend.version()
+
+
 def get_statistical_method_name(statistical_method):
     if statistical_method == 'fdr_bh':
         return 'False Discovery Rate (FDR; Benjamini/Hochberg)'
@@ -105,7 +115,7 @@ def reporter_create_pdf(session_id, parameters, statistical_test, alternative, s
     pdf.cell(w=40, h=ch, txt="LORA version: ", ln=0)
     pdf.cell(w=80, h=ch, txt=get_header_version(), ln=1)
     pdf.cell(w=40, h=ch, txt="Goslin version: ", ln=0)
-    pdf.cell(w=80, h=ch, txt=get_jar_file(), ln=1)    
+    pdf.cell(w=80, h=ch, txt=get_parser_name(), ln=1)    
     pdf.ln(ch)
     pdf.set_font('Arial', '', 10)
 
@@ -1,11 +1,39 @@
 import pandas as pd
 import re
 from utils.common_functions import *
+from utils.term_counts import ACYL_LEVEL_OPTIONS, ACYL_BUCKETS, ACYL_BUCKET_COLUMNS
+
+
+def numbered_names(names):
+
+    '''
+    Number the repeated names of a term, e.g. the same acyl found in two chains of one lipid
+
+    Param
+    -------
+    names: numpy.ndarray
+
+    Returns
+    -------
+    names: list
+           second and later occurrences get ' (2)', ' (3)', ...
+    '''
+
+    seen = {}
+    numbered = []
+    for name in names:
+        seen[name] = seen.get(name, 0) + 1
+        numbered.append(name if seen[name] == 1 else name + ' (' + str(seen[name]) + ')')
+
+    return numbered
+
+
 
 def table_for_upset(df, query):
-    
+
     '''
-    Get table for upset plot
+    Get table for upset plot, the lipids of every significant term are looked up on indexes of the query
+    and its melted acyls built once, and the table is assembled in one concat
 
     Param
     -------
@@ -23,196 +51,143 @@ def table_for_upset(df, query):
     s_duplicates = query['Normalized Name'].astype(str) + ' (' + letters[query['Normalized Name'].groupby(query['Normalized Name']).cumcount()] + ')'
     s_duplicates = s_duplicates.apply(lambda x: x.replace(' (a)', ''))
 
+    query = query.copy()
     query.insert(loc=1, column='Unique Name', value=s_duplicates.tolist())
 
-    upset = pd.DataFrame()
-
-    for i in range(len(df)):
+    frames = {'query': query}
+    indexes = {}
+    empty = np.array([], dtype=np.int64)
 
-        if df.iloc[i, 0] == 'Lipid Maps Category' or  df.iloc[i, 0] == 'Lipid Maps Main Class':
+    def frame(name):
+        if name not in frames:
+            # the melted acyls are only built for the acyl terms
+            frames[name] = get_FA_df(query).reset_index(drop=True)
+        return frames[name]
 
-            filtered_df = query[query[df.iloc[i, 0]] == df.iloc[i, 1]]
-            filtered_df = filtered_df.drop_duplicates(subset='Unique Name')
+    def positions(name, column):
+        # rows of every value of the column, one groupby for all the terms of the column
+        if (name, column) not in indexes:
+            indexes[(name, column)] = frame(name).groupby(column, sort=False).indices
+        return indexes[(name, column)]
 
-            inter_df = filtered_df['Unique Name'].to_frame()
-            inter_df['{}: {}'.format(df.iloc[i, 0], df.iloc[i, 1])] = df.iloc[i, 5]
-            inter_df = inter_df.set_index('Unique Name')
+    def subset_mask(name, subset):
+        # the main class wins over a category of the same name; terms of subsets missing from the query have no lipids
+        if (name, 'subset', subset) not in indexes:
+            table = frame(name)
+            mask = None
+            if subset in table['Lipid Maps Category'].values:
+                mask = (table['Lipid Maps Category'] == subset).to_numpy()
+            if subset in table['Lipid Maps Main Class'].values:
+                mask = (table['Lipid Maps Main Class'] == subset).to_numpy()
+            indexes[(name, 'subset', subset)] = mask
+        return indexes[(name, 'subset', subset)]
 
-            upset = pd.concat([upset, inter_df], axis=1)
+    def acyl_names():
+        if ('acyls', 'names') not in indexes:
+            indexes[('acyls', 'names')] = frame('acyls')['Unique Name'].to_numpy(dtype=object)
+        return indexes[('acyls', 'names')]
 
-        if (re.findall("^Acyls", df.iloc[i, 0]) != []) and (re.findall("Acyls$", df.iloc[i, 0]) != []):
-            
-            level_options = ['MOLECULAR_SPECIES', 'SN_POSITION', 'STRUCTURE_DEFINED', 'FULL_STRUCTURE', 'COMPLETE_STRUCTURE']
-            level_index = level_options.index(df.iloc[i, 2])
-            level_selected = level_options[level_index:]
+    def level_rows(rows, level):
+        if ('acyls', 'levels') not in indexes:
+            indexes[('acyls', 'levels')] = frame('acyls')['Level'].to_numpy()
+        levels = indexes[('acyls', 'levels')][rows]
+        return rows[np.isin(levels, ACYL_LEVEL_OPTIONS[ACYL_LEVEL_OPTIONS.index(level):])]
 
-            query_FA = get_FA_df(query)
+    def first_rows(name, rows, columns):
+        # the first row of every combination of the columns, kept in order
+        if (name, tuple(columns)) not in indexes:
+            indexes[(name, tuple(columns))] = frame(name).groupby(columns, sort=False, dropna=False).ngroup().to_numpy()
+        first = np.unique(indexes[(name, tuple(columns))][rows], return_index=True)[1]
+        return rows[np.sort(first)]
 
-            filtered_df = query_FA[(query_FA[df.iloc[i, 0]] == df.iloc[i, 1]) & (query_FA['Level'].isin(level_selected))]
-            filtered_df = filtered_df.drop_duplicates(subset=['Unique Name', 'FAs'])
+    names = query['Unique Name'].to_numpy(dtype=object)
+    subsets = set(query['Lipid Maps Category']) | set(query['Lipid Maps Main Class'])
+    p_values = df.iloc[:, 5]
 
-            inter_df = filtered_df['Unique Name'].to_frame()
-            inter_df['{} [{}]: {}'.format(df.iloc[i, 0], df.iloc[i, 2], df.iloc[i, 1])] = df.iloc[i, 5]
+    terms = []
 
-            s = inter_df.groupby('Unique Name').cumcount().add(1).astype(str)
-            inter_df['Unique Name'] += (' (' + s + ')').replace(' (1)', '')
+    for i, (group, classifier, level) in enumerate(zip(df.iloc[:, 0].tolist(), df.iloc[:, 1].tolist(), df.iloc[:, 2].tolist())):
 
-            inter_df = inter_df.set_index('Unique Name')
+        if group == 'Lipid Maps Category' or group == 'Lipid Maps Main Class':
 
-            upset = pd.concat([upset, inter_df], axis=1)
+            rows = positions('query', group).get(classifier, empty)
+            terms.append(('{}: {}'.format(group, classifier), names[rows], p_values.iloc[i]))
 
+        if (re.findall("^Acyls", group) != []) and (re.findall("Acyls$", group) != []):
 
-        if (list(filter(df.iloc[i, 0].startswith, ['Total'])) != []) == True:
-            param = df.iloc[i, 0].split(' within ')[0]
-            subset = df.iloc[i, 0].split(' within ')[1]
+            rows = level_rows(positions('acyls', group).get(classifier, empty), level)
+            rows = first_rows('acyls', rows, ['Unique Name', 'FAs'])
 
-            if subset in query['Lipid Maps Category'].values:
-                if df.iloc[i, 1].isdigit():
-                    filtered_df = query[(query['Lipid Maps Category'] == subset) & (query[param] == int(df.iloc[i, 1]))]
-                else:
-                    filtered_df = query[(query['Lipid Maps Category'] == subset) & (query[param] == df.iloc[i, 1])]
-            if subset in query['Lipid Maps Main Class'].values:
-                if df.iloc[i, 1].isdigit():
-                    filtered_df = query[(query['Lipid Maps Main Class'] == subset) & (query[param] == int(df.iloc[i, 1]))]
-                else:
-                    filtered_df = query[(query['Lipid Maps Main Class'] == subset) & (query[param] == df.iloc[i, 1])]
+            terms.append(('{} [{}]: {}'.format(group, level, classifier), numbered_names(acyl_names()[rows]), p_values.iloc[i]))
 
-            
-            filtered_df = filtered_df.drop_duplicates(subset='Unique Name')
-            
-            inter_df = filtered_df['Unique Name'].to_frame()
-            inter_df['{}: {}'.format(df.iloc[i, 0], df.iloc[i, 1])] = df.iloc[i, 5]
-            inter_df = inter_df.set_index('Unique Name')
+        if (list(filter(group.startswith, ['Total'])) != []) == True:
+            param = group.split(' within ')[0]
+            subset = group.split(' within ')[1]
 
-            upset = pd.concat([upset, inter_df], axis=1)
+            condition = int(classifier) if classifier.isdigit() else classifier
+            mask = subset_mask('query', subset)
+            rows = positions('query', param).get(condition, empty)
+            rows = empty if mask is None else rows[mask[rows]]
 
-        if (re.findall("^Acyls", df.iloc[i, 0]) != []) and (re.findall("Acyls$", df.iloc[i, 0]) == []):
-            param = df.iloc[i, 0].split(' within ')[0]
-            subset = df.iloc[i, 0].split(' within ')[1]
+            terms.append(('{}: {}'.format(group, classifier), names[rows], p_values.iloc[i]))
 
-            level_options = ['MOLECULAR_SPECIES', 'SN_POSITION', 'STRUCTURE_DEFINED', 'FULL_STRUCTURE', 'COMPLETE_STRUCTURE']
-            level_index = level_options.index(df.iloc[i, 2])
-            level_selected = level_options[level_index:]
-            
-            query_FA = get_FA_df(query)
+        if (re.findall("^Acyls", group) != []) and (re.findall("Acyls$", group) == []):
+            param = group.split(' within ')[0]
+            subset = group.split(' within ')[1]
 
-            if subset in query_FA['Lipid Maps Category'].values:
-                filtered_df = query_FA[(query_FA['Lipid Maps Category'] == subset) & (query_FA[param] == df.iloc[i, 1]) & (query_FA['Level'].isin(level_selected))]
-            if subset in query_FA['Lipid Maps Main Class'].values:
-                filtered_df = query_FA[(query_FA['Lipid Maps Main Class'] == subset) & (query_FA[param] == df.iloc[i, 1]) & (query_FA['Level'].isin(level_selected))]
+            mask = subset_mask('acyls', subset)
+            rows = positions('acyls', param).get(classifier, empty)
+            rows = empty if mask is None else level_rows(rows[mask[rows]], level)
+            rows = first_rows('acyls', rows, ['Original Name', 'FAs'])
 
-            filtered_df = filtered_df.drop_duplicates(subset=['Original Name', 'FAs'])
+            terms.append(('{} [{}]: {}'.format(group, level, classifier), numbered_names(acyl_names()[rows]), p_values.iloc[i]))
 
-            inter_df = filtered_df['Unique Name'].to_frame()
-            inter_df['{} [{}]: {}'.format(df.iloc[i, 0], df.iloc[i, 2], df.iloc[i, 1])] = df.iloc[i, 5]
+        if group in subsets: ### not so specific, might be changed/improved
 
-            s = inter_df.groupby('Unique Name').cumcount().add(1).astype(str)
-            inter_df['Unique Name'] += (' (' + s + ')').replace(' (1)', '')
+            searching_param = classifier.split(' with ')[1]
+            specific, condition = ACYL_BUCKETS[searching_param]
+            mask = subset_mask('query', group)
 
-            inter_df = inter_df.set_index('Unique Name')
+            # lipids with an acyl in the bucket, in the order of the first chain that has one
+            rows, found = [], np.zeros(len(query.index), dtype=bool)
+            for column in re.findall(ACYL_BUCKET_COLUMNS[specific], ' '.join(map(str, query.columns))):
+                hits = mask & condition(pd.to_numeric(query[column], errors='coerce').to_numpy(dtype=float, na_value=np.nan))
+                rows.append(np.flatnonzero(hits & ~found))
+                found |= hits
+
+            rows = np.concatenate(rows) if len(rows) > 0 else empty
+            terms.append(('{} {}'.format(group, searching_param), names[rows], p_values.iloc[i]))
 
-            upset = pd.concat([upset, inter_df], axis=1)
+        if (list(filter(group.startswith, ['FA', 'LCB'])) != []) == True:
 
-        if (df.iloc[i, 0] in query['Lipid Maps Category'].values) or (df.iloc[i, 0] in query['Lipid Maps Main Class'].values): ### not so specific, might be changed/improved
+            param = group.split(' within ')[0]
+            subset = group.split(' within ')[1]
 
-            subset = df.iloc[i, 0]
-            searching_param = df.iloc[i, 1].split(' with ')[1]
-            
-            column_names_list = query.columns.to_list()
+            condition = float(classifier) if classifier.isnumeric() else classifier
+            mask = subset_mask('query', subset)
+            rows = positions('query', param).get(condition, empty)
+            rows = empty if mask is None else rows[mask[rows]]
 
-            if 'carbon' in searching_param:
-                matches = re.findall(r'FA\d #C', ' '.join(map(str, column_names_list)))
-            if 'double bonds' in searching_param:
-                matches = re.findall(r'FA\d #DB', ' '.join(map(str, column_names_list)))
+            terms.append(('{}: {}'.format(group, classifier), names[rows], p_values.iloc[i]))
 
-            filtered_df_new = pd.DataFrame()
-            for ii in matches:
-                query[ii] = query[ii].replace(0, np.nan)
+    # lipids x terms p-value matrix, the lipids in the order they first appear in the terms
+    if len(terms) > 0:
+        position = {name: i for i, name in enumerate(dict.fromkeys(name for term in terms for name in term[1]))}
+        matrix = np.full((len(position), len(terms)), np.nan, dtype=p_values.dtype if pd.api.types.is_float_dtype(p_values.dtype) else object)
+        for j, (name, term_names, p_value) in enumerate(terms):
+            matrix[[position[name] for name in term_names], j] = p_value
 
-                ### CARBONS
-                if searching_param == 'acyls containing less than 16 carbon atoms':
-                    if subset in query['Lipid Maps Category'].values:
-                        filtered_df = query.loc[(query['Lipid Maps Category'] == subset) & (query[ii] < 16)]
-                    if subset in query['Lipid Maps Main Class'].values:
-                        filtered_df = query.loc[(query['Lipid Maps Main Class'] == subset) & (query[ii] < 16)]
-
-                if searching_param == 'acyls containing 16-18 carbon atoms':
-                    if subset in query['Lipid Maps Category'].values:
-                        filtered_df = query.loc[(query['Lipid Maps Category'] == subset) & (query[ii] >= 16) & (query[ii] <= 18)]
-                    if subset in query['Lipid Maps Main Class'].values:
-                        filtered_df = query.loc[(query['Lipid Maps Main Class'] == subset) & (query[ii] >= 16) & (query[ii] <= 18)]
-
-                if searching_param == 'acyls containing more than 18 carbon atoms':
-                    if subset in query['Lipid Maps Category'].values:
-                        filtered_df = query.loc[(query['Lipid Maps Category'] == subset) & (query[ii] > 18)]
-                    if subset in query['Lipid Maps Main Class'].values:
-                        filtered_df = query.loc[(query['Lipid Maps Main Class'] == subset) & (query[ii] > 18)]
-
-                ### DOUBLE BONDS
-                if searching_param == 'acyls containing 0 double bonds (saturated)':
-                    if subset in query['Lipid Maps Category'].values:
-                        filtered_df = query.loc[(query['Lipid Maps Category'] == subset) & (query[ii] == 0)]
-                    if subset in query['Lipid Maps Main Class'].values:
-                        filtered_df = query.loc[(query['Lipid Maps Main Class'] == subset) & (query[ii] == 0)]
-                
-                if searching_param == 'acyls containing 1 double bonds (monounsaturated)':
-                    if subset in query['Lipid Maps Category'].values:
-                        filtered_df = query.loc[(query['Lipid Maps Category'] == subset) & (query[ii] == 1)]
-                    if subset in query['Lipid Maps Main Class'].values:
-                        filtered_df = query.loc[(query['Lipid Maps Main Class'] == subset) & (query[ii] == 1)]
-
-                if searching_param == 'acyls containing 2 or more double bonds (polyunsaturated)':
-                    if subset in query['Lipid Maps Category'].values:
-                        filtered_df = query.loc[(query['Lipid Maps Category'] == subset) & (query[ii] >= 2)]
-                    if subset in query['Lipid Maps Main Class'].values:
-                        filtered_df = query.loc[(query['Lipid Maps Main Class'] == subset) & (query[ii] >= 2)]
-
-
-                filtered_df_new = pd.concat([filtered_df_new, filtered_df])
-                filtered_df_new = filtered_df_new.drop_duplicates(subset='Unique Name', keep='first')
-                
-
-            inter_df = filtered_df_new['Unique Name'].to_frame()
-            inter_df['{} {}'.format(df.iloc[i, 0], searching_param)] = df.iloc[i, 5]
-            inter_df = inter_df.set_index('Unique Name')
-
-            upset = pd.concat([upset, inter_df], axis=1)
-
-        if (list(filter(df.iloc[i, 0].startswith, ['FA', 'LCB'])) != []) == True:
-
-            param = df.iloc[i, 0].split(' within ')[0]
-            subset = df.iloc[i, 0].split(' within ')[1]
-
-            if (df.iloc[i, 1]).isnumeric():
-                condition = float(df.iloc[i, 1])
-            else:
-                condition = df.iloc[i, 1]
-
-            if subset in query['Lipid Maps Category'].values:
-                filtered_df = query[(query['Lipid Maps Category'] == subset) & (query[param] == condition)]
-            if subset in query['Lipid Maps Main Class'].values:
-                filtered_df = query[(query['Lipid Maps Main Class'] == subset) & (query[param] == condition)]
-
-            filtered_df = filtered_df.drop_duplicates(subset='Unique Name')
-
-            inter_df = filtered_df['Unique Name'].to_frame()
-            inter_df['{}: {}'.format(df.iloc[i, 0], df.iloc[i, 1])] = df.iloc[i, 5]
-            inter_df = inter_df.set_index('Unique Name')
-
-            upset = pd.concat([upset, inter_df], axis=1)
+        upset = pd.DataFrame(matrix, index=pd.Index(list(position), dtype=object, name='Unique Name'), columns=[term[0] for term in terms])
+    else:
+        upset = pd.DataFrame()
 
     upset = upset.reset_index()
     upset = upset.rename(columns = {'Unique Name':'Names'})
-    print(upset)
     if 'Names' in upset.columns:
         upset['Names'] = upset['Names'].apply(lambda x: re.sub(r' \(\d+\)', '', x))
     else:
         print("Names column not found in DataFrame")
 
     upset = upset.fillna(1)
-    
-    return upset
-
-
-
 
+    return upset
@@ -0,0 +1,258 @@
+import pandas as pd
+import numpy as np
+import hashlib
+import json
+import os
+import time
+import shutil
+from functools import lru_cache
+from dash.exceptions import PreventUpdate
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+SESSION_STORE_DIR = os.environ.get('LORA_SESSION_STORE_DIR', './session-store')
+
+# tables of sessions that have not stored or loaded a table for this many seconds are removed
+SESSION_STORE_LIMIT = int(os.environ.get('LORA_SESSION_STORE_LIMIT', 3600))
+
+SESSION_EXPIRED_MESSAGE = 'The processed data of this session have expired, please upload and process the data again.'
+
+SMALL_INT_DTYPES = ['Int8', 'Int16', 'Int32']
+
+
+
+class SessionTableMissing(PreventUpdate):
+
+    '''
+    The stored table of a handle was removed, the callback stops without updating its outputs and
+    the tab-2 messages ask to upload the data again
+    '''
+
+
+
+def compact_column(column):
+
+    '''
+    Compact dtype of a parsed column for storing, categories for text fields and small nullable ints for
+    integer-valued numbers (#C, #DB, SN Position)
+
+    Param
+    -------
+    column: series
+
+    Returns
+    -------
+    column: series
+    '''
+
+    if column.dtype == object:
+        return column.astype('category')
+
+    if pd.api.types.is_bool_dtype(column) or not pd.api.types.is_numeric_dtype(column):
+        return column
+
+    values = column.dropna().to_numpy()
+    if len(values) == 0 or not np.all(np.mod(values, 1) == 0):
+        return column
+
+    for dtype in SMALL_INT_DTYPES:
+        info = np.iinfo(dtype.lower())
+        if values.min() >= info.min and values.max() <= info.max:
+            return column.astype(dtype)
+
+    return column
+
+
+
+def restore_column(column, dtype):
+
+    '''
+    Restore dtype of a stored column, the frame is the same as the one rebuilt from list-of-dict records
+
+    Param
+    -------
+    column: series
+    dtype: string
+
+    Returns
+    -------
+    column: series
+    '''
+
+    if dtype == 'object':
+        column = column.astype(object)
+        # missing text fields come back from the records as None
+        return column.where(column.notna(), None)
+
+    return column.astype(dtype)
+
+
+
+def table_fingerprint(df):
+    digest = hashlib.sha256()
+    digest.update(json.dumps(list(map(str, df.columns))).encode('utf-8'))
+    digest.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+
+    return digest.hexdigest()
+
+
+
+def table_path(session_id, name, file_format):
+    # handles come back from the browser, keep them inside the store directory
+    if os.path.basename(str(session_id)) != str(session_id) or os.path.basename(str(name)) != str(name):
+        raise ValueError('Invalid session table handle.')
+
+    return os.path.join(SESSION_STORE_DIR, str(session_id), str(name) + '.' + file_format)
+
+
+
+def store_table(session_id, name, df):
+
+    '''
+    Store parsed table of a session on the server, only the returned handle goes to the dcc.Store
+
+    Param
+    -------
+    session_id: string
+    name: string
+          'query' or 'universe'
+    df: dataframe
+
+    Returns
+    -------
+    handle: dict
+            session_id, name, file format, content fingerprint, number of rows and original dtypes
+    '''
+
+    df = df.reset_index(drop=True)
+    file_format = 'parquet' if pyarrow is not None else 'pkl'
+    path = table_path(session_id, name, file_format)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    compact = pd.DataFrame({column: compact_column(df[column]) for column in df.columns}, columns=df.columns)
+
+    # write next to the old file and swap, a running callback may still read the previous table
+    temporary_path = path + '.tmp'
+    if file_format == 'parquet':
+        compact.to_parquet(temporary_path, engine='pyarrow', index=False)
+    else:
+        compact.to_pickle(temporary_path)
+    os.replace(temporary_path, path)
+
+    return {
+        'session_id': session_id,
+        'name': name,
+        'format': file_format,
+        'fingerprint': table_fingerprint(df),
+        'rows': len(df.index),
+        'dtypes': {column: str(dtype) for column, dtype in df.dtypes.items()},
+    }
+
+
+
+@lru_cache(maxsize=8)
+def _read_table(path, fingerprint, dtypes, prepare=None):
+    if prepare is not None:
+        # prepared tables are cached next to the plain ones, the transform runs once per stored table
+        return prepare(_read_table(path, fingerprint, dtypes).copy())
+
+    if path.endswith('.parquet'):
+        compact = pd.read_parquet(path, engine='pyarrow')
+    else:
+        compact = pd.read_pickle(path)
+
+    dtypes = json.loads(dtypes)
+
+    return pd.DataFrame({column: restore_column(compact[column], dtype) for column, dtype in dtypes.items()}, columns=list(dtypes))
+
+
+
+def load_table(handle, prepare=None):
+
+    '''
+    Load parsed table of a session from its handle
+
+    Param
+    -------
+    handle: dict
+            returned by store_table, none before the upload
+    prepare: function
+             transform of the table, e.g. separate_db_position_geometry, cached with the table
+
+    Returns
+    -------
+    df: dataframe
+        same dtypes as the stored table, a fresh copy for every call
+
+    Raise
+    -------
+    SessionTableMissing if the stored table was removed
+    '''
+
+    if handle is None:
+        return pd.DataFrame()
+
+    path = table_path(handle['session_id'], handle['name'], handle['format'])
+
+    try:
+        # every load marks the session as active for clear_session_store
+        os.utime(os.path.dirname(path))
+        df = _read_table(path, handle['fingerprint'], json.dumps(handle['dtypes']), prepare)
+    except FileNotFoundError:
+        print(SESSION_EXPIRED_MESSAGE)
+        raise SessionTableMissing(SESSION_EXPIRED_MESSAGE)
+
+    return df.copy()
+
+
+
+def table_available(handle):
+
+    '''
+    Check that the stored table of a handle still exists
+
+    Param
+    -------
+    handle: dict
+            returned by store_table, none before the upload
+
+    Returns
+    -------
+    available: bool
+               false only for a handle whose table was removed
+    '''
+
+    if handle is None:
+        return True
+
+    return os.path.isfile(table_path(handle['session_id'], handle['name'], handle['format']))
+
+
+def clear_session_store(current_session_id):
+
+    '''
+    Remove stored tables of the sessions inactive for longer than the retention limit, the directory
+    of a session is touched on every store and load
+
+    Param
+    -------
+    current_session_id: string
+
+    Returns
+    -------
+    none
+    '''
+
+    if not os.path.isdir(SESSION_STORE_DIR):
+        return
+
+    current_time = time.time()
+
+    for item in os.listdir(SESSION_STORE_DIR):
+        item_location = os.path.join(SESSION_STORE_DIR, item)
+        if item != current_session_id and os.stat(item_location).st_mtime < current_time - SESSION_STORE_LIMIT:
+            shutil.rmtree(item_location, ignore_errors=True)
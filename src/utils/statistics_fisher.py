@@ -1,207 +1,205 @@
 import pandas as pd
 import numpy as np
-import re
-from scipy.stats import fisher_exact
+from scipy.stats import hypergeom
 
-from utils.common_functions import fdr
-from utils.hypothesis_correction import hypothesis_correction
+from utils.term_counts import UniverseIndex, general_blocks, within_subset_blocks, acyl_bucket_blocks, terms_table
 
 
 
-def calculate_enrichment_fisher(levels, query, universe, alternative, statistical_method, alpha_level, filter_count):
-    
+
+def binary_search_batch(a, d, lo, hi):
+
     '''
-    Calculate enrichment using Fisher exact test
+    Binary search of scipy's two-sided Fisher exact test, run for all terms at once
 
     Param
     -------
-    levels: list
-            list of options at which level the enrichment is calculated
-            options: 'Lipid Maps Category', 'Lipid Maps Main Class', 'Acyls'
-    query: DataFrame
-    universe: DataFrame
-    alternative: string
-                 defines the alternative hypothesis
-                 options: 'greater', 'less', 'two-sided'; default: 'greater'
-    statistical_method: string
-                        defines the multiple hypothesis correction
-                        options: 'FDR', 'Bonferroni Correction', 'Holm-Bonferroni'; default: 'FDR'
-    alpha_level: float
-                 threshold value for multiple tests
+    a: function
+       called with the indices of the searched terms and the points to evaluate, ascending between lo and hi
+    d: numpy.ndarray
+       searched values
+    lo: numpy.ndarray
+    hi: numpy.ndarray
 
     Returns
     -------
-    df_final: DataFrame
+    index: numpy.ndarray
+           i between lo and hi such that a(i) <= d < a(i+1)
     '''
 
-    query = query[query['Lipid Maps Category'] != 'Undefined lipid category [UNDEFINED]']
-    universe = universe[universe['Lipid Maps Category'] != 'Undefined lipid category [UNDEFINED]'] 
-
-    query = query.replace('0:0', np.nan)
-    universe = universe.replace('0:0', np.nan)
-
-    if 'Acyls' not in levels:
-
-        df_final = pd.DataFrame()
+    lo = lo.copy()
+    hi = hi.copy()
+    index = np.zeros(len(lo), dtype=np.int64)
+    found = np.zeros(len(lo), dtype=bool)
 
-        for level in levels:
+    while True:
+        active = np.flatnonzero(~found & (lo < hi))
+        if len(active) == 0:
+            break
 
-            if level in universe.columns and level in query.columns:
+        mid = lo[active] + (hi[active] - lo[active]) // 2
+        midval = a(active, mid)
 
-                universe_gb = universe.groupby(by=level)
-                query_gb = query.groupby(by=level)
+        lower = midval < d[active]
+        higher = midval > d[active]
+        equal = ~lower & ~higher
 
-                universe_groups = dict(list(universe_gb))
-                query_groups = dict(list(query_gb))
-                
-                universe_grandtotal = int(universe['Normalized Name'].count())
-                query_grandtotal = int(query['Normalized Name'].count())
+        lo[active[lower]] = mid[lower] + 1
+        hi[active[higher]] = mid[higher] - 1
+        index[active[equal]] = mid[equal]
+        found[active[equal]] = True
 
-                group_name, category_name, level_name, p_value, oddsr_ratio, number_query, number_universe = ([] for i in range(7))
-                for category in [c for c in universe_groups.keys() if c not in ['nan', 'None']]: 
+    rest = np.flatnonzero(~found)
+    if len(rest) > 0:
+        index[rest] = np.where(a(rest, lo[rest]) <= d[rest], lo[rest], lo[rest] - 1)
 
-                    universe_n = universe_groups[category].count()
-                    universe_total = int(universe_n['Normalized Name'].sum())
+    return index
 
-                    try:
-                        query_n = query_groups[category].count()
-                        query_total = int(query_n['Normalized Name'].sum())
 
-                    except:
-                        query_total=0
 
-                    if query_total > filter_count and universe_total > filter_count:  
-                        contingency_table = [[query_total, universe_total], [query_grandtotal-query_total, universe_grandtotal-universe_total]]  
-                        oddsr, p = fisher_exact(contingency_table, alternative=alternative)
-
-                        group_name.append(level)
-                        category_name.append(category)
-
-                        if level == 'Lipid Maps Category':
-                            level_name.append('CATEGORY')
-                        if level == 'Lipid Maps Main Class':
-                            level_name.append('CLASS')
-                        if level.startswith('Total'):
-                            level_name.append('SPECIES')
-                        if 'SN Position' in level:
-                            level_name.append('SN_POSITION')
-                        if 'Position Numbers' in level:
-                            level_name.append('STRUCTURE_DEFINED')
-                        if 'Position Geometries' in level:
-                            level_name.append('FULL_STRUCTURE')
-                        if 'DB Positions' in level:
-                            level_name.append('FULL_STRUCTURE')
-                        if level.startswith('FA') and not level.endswith(('SN Position', 'Position Numbers', 'Position Geometries', 'DB Positions')):
-                            level_name.append('MOLECULAR_SPECIES')
-
-                        number_universe.append(str(universe_total) + '/' + str(universe_grandtotal))
-                        number_query.append(str(query_total) + '/' + str(query_grandtotal))
-                        p_value.append(p)
-                        oddsr_ratio.append(str(round(oddsr, 4)))
+def fisher_exact_batch(contingency_tables, alternative='two-sided'):
 
+    '''
+    Fisher exact test of many 2x2 contingency tables in one call, the same algorithm as scipy.stats.fisher_exact
+    evaluated on arrays, so p-values and odds ratios are the same as the ones of the scalar calls
 
-                df = pd.DataFrame(list(zip(group_name, category_name, level_name, number_query, number_universe, p_value, oddsr_ratio)), 
-                                    columns =['Term (Group)', 'Term (Classifier)', 'Level', 'No Query', 'No Reference','p-value', 'Odds Ratio'])
+    Param
+    -------
+    contingency_tables: list
+                        [[a, b], [c, d]] tables
+    alternative: string
+                 options: 'greater', 'less', 'two-sided'
 
-                df = df.drop(df[df['Term (Classifier)'] == False].index)
+    Returns
+    -------
+    oddsratio: numpy.ndarray
+    p_value: numpy.ndarray
+    '''
 
-                df = df.sort_values('p-value', ignore_index=True)
+    tables = np.asarray(contingency_tables, dtype=np.int64).reshape(-1, 2, 2)
+    c00, c01, c10, c11 = tables[:, 0, 0], tables[:, 0, 1], tables[:, 1, 0], tables[:, 1, 1]
 
-                df['FDR'] = fdr(df['p-value'].to_numpy(), statistical_method, alpha_level)
-                df['FDR'] = df['FDR'].apply(lambda x: round(x, 4) if isinstance(x, float) else x)
+    if np.any(tables < 0):
+        raise ValueError('All values in `table` must be nonnegative.')
 
-                df['Odds Ratio'] = df['Odds Ratio'].apply(lambda x: 'N.D.' if (x=='nan') else x)
+    oddsratio = np.full(len(tables), np.inf)
+    p_value = np.ones(len(tables))
 
-                df['Hypothesis Correction Result'] = hypothesis_correction(df['p-value'].to_numpy(), statistical_method, alpha_level)
+    ratio = (c10 > 0) & (c01 > 0)
+    oddsratio[ratio] = c00[ratio] * c11[ratio] / (c10[ratio] * c01[ratio])
 
-                df_final = pd.concat([df_final, df]).reset_index(drop=True)
-        
-    if 'Acyls' in levels:
+    # if both values in a row or column are zero, the p-value is 1 and the odds ratio is NaN
+    degenerate = (c00 + c01 == 0) | (c10 + c11 == 0) | (c00 + c10 == 0) | (c01 + c11 == 0)
+    oddsratio[degenerate] = np.nan
 
-        df_final = pd.DataFrame()
+    terms = np.flatnonzero(~degenerate)
+    if len(terms) == 0:
+        return oddsratio, p_value
 
-        level_options = ['MOLECULAR_SPECIES', 'SN_POSITION', 'STRUCTURE_DEFINED', 'FULL_STRUCTURE', 'COMPLETE_STRUCTURE']
+    c00, c01, c11 = c00[terms], c01[terms], c11[terms]
+    n1 = c00 + c01
+    M = n1 + tables[terms, 1, 0] + c11
+    n = c00 + tables[terms, 1, 0]
 
-        while len(level_options) > 0:
+    if alternative == 'less':
+        p_value[terms] = np.minimum(hypergeom.cdf(c00, M, n1, n), 1.0)
 
-            universe_filtered = universe.loc[universe['Level'].isin(level_options)]
-            query_filtered = query.loc[query['Level'].isin(level_options)]
+    elif alternative == 'greater':
+        p_value[terms] = np.minimum(hypergeom.cdf(c01, M, n1, c01 + c11), 1.0)
 
-            for level in levels:
-                universe_gb = universe_filtered.groupby(by=level)
-                query_gb = query_filtered.groupby(by=level)
+    elif alternative == 'two-sided':
+        mode = ((n + 1) * (n1 + 1) / (M + 2)).astype(np.int64)
+        pexact = hypergeom.pmf(c00, M, n1, n)
+        pmode = hypergeom.pmf(mode, M, n1, n)
 
-                universe_groups = dict(list(universe_gb))
-                query_groups = dict(list(query_gb))
-                
-                universe_grandtotal = int(universe['Normalized Name'].count())
-                query_grandtotal = int(query['Normalized Name'].count())
+        epsilon = 1e-14
+        gamma = 1 + epsilon
 
-                group_name, category_name, level_name, p_value, oddsr_ratio, number_query, number_universe, missing_query, missing_universe, missing_query_val, missing_universe_val = ([] for i in range(11))
-                for category in [c for c in universe_groups.keys() if c not in ['nan', 'None']]:
-                    universe_n = universe_groups[category].count()
-                    universe_total = int(universe_n['Normalized Name'].sum())
+        with np.errstate(divide='ignore', invalid='ignore'):
+            at_mode = np.abs(pexact - pmode) / np.maximum(pexact, pmode) <= epsilon
 
-                    universe_n_all = universe[universe[level] == category].shape[0]
+        below = ~at_mode & (c00 < mode)
+        above = ~at_mode & ~below
 
-                    try:
-                        query_n = query_groups[category].count()
-                        query_total = int(query_n['Normalized Name'].sum())
+        p = np.ones(len(terms))
 
-                        query_n_all = query[query[level] == category].shape[0]
+        i = np.flatnonzero(below)
+        if len(i) > 0:
+            plower = hypergeom.cdf(c00[i], M[i], n1[i], n[i])
+            tail = hypergeom.pmf(n[i], M[i], n1[i], n[i]) > pexact[i] * gamma
+            p[i] = plower
 
-                    except:
-                        query_total=0
+            j = np.flatnonzero(~tail)
+            if len(j) > 0:
+                k = i[j]
+                guess = binary_search_batch(lambda s, x: -hypergeom.pmf(x, M[k[s]], n1[k[s]], n[k[s]]), -pexact[k] * gamma, mode[k], n[k])
+                p[k] = np.minimum(plower[j] + hypergeom.sf(guess, M[k], n1[k], n[k]), 1.0)
 
-                    if query_total > filter_count and universe_total > filter_count:  
-                        contingency_table = [[query_total, universe_total], [query_grandtotal-query_total, universe_grandtotal-universe_total]]  
-                        oddsr, p = fisher_exact(contingency_table, alternative=alternative)
+        i = np.flatnonzero(above)
+        if len(i) > 0:
+            pupper = hypergeom.sf(c00[i] - 1, M[i], n1[i], n[i])
+            tail = hypergeom.pmf(0, M[i], n1[i], n[i]) > pexact[i] * gamma
+            p[i] = pupper
 
-                        group_name.append(level)
-                        category_name.append(category)
-                        level_name.append(level_options[0])
-                        number_universe.append(str(universe_total) + '/' + str(universe_grandtotal))
-                        number_query.append(str(query_total) + '/' + str(query_grandtotal))
-                        p_value.append(p)
-                        oddsr_ratio.append(round(oddsr, 4))
+            j = np.flatnonzero(~tail)
+            if len(j) > 0:
+                k = i[j]
+                guess = binary_search_batch(lambda s, x: hypergeom.pmf(x, M[k[s]], n1[k[s]], n[k[s]]), pexact[k] * gamma, np.zeros(len(k), dtype=np.int64), mode[k])
+                p[k] = np.minimum(pupper[j] + hypergeom.cdf(guess, M[k], n1[k], n[k]), 1.0)
 
-                        missing_query.append(str(query_total) + '/' + str(query_n_all))
-                        missing_universe.append(str(universe_total) + '/' + str(universe_n_all))
+        p_value[terms] = p
 
-                        if (query_total/query_n_all) == 1:
-                            missing_query_val.append(str(False))
-                        if (query_total/query_n_all) != 1:
-                            missing_query_val.append(str(True))
+    else:
+        raise ValueError("`alternative` should be one of {'two-sided', 'less', 'greater'}")
 
-                        if (universe_total/universe_n_all) == 1:
-                            missing_universe_val.append(str(False))
-                        if (universe_total/universe_n_all) != 1:
-                            missing_universe_val.append(str(True))
+    return oddsratio, p_value
 
 
-                df = pd.DataFrame(list(zip(group_name, category_name, level_name, number_query, number_universe, p_value, oddsr_ratio, missing_query, missing_universe, missing_query_val, missing_universe_val)), 
-                                    columns =['Term (Group)', 'Term (Classifier)', 'Level', 'No Query', 'No Reference','p-value', 'Odds Ratio', 'Missing Query', 'Missing Reference', 'Missing Query Val', 'Missing Reference Val'])
 
-                df = df.drop(df[df['Term (Classifier)'] == False].index)
+def calculate_enrichment_fisher(levels, query, universe, alternative, statistical_method, alpha_level, filter_count, universe_index=None):
+    
+    '''
+    Calculate enrichment using Fisher exact test
 
-                df = df.sort_values('p-value', ignore_index=True)
+    Param
+    -------
+    levels: list
+            list of options at which level the enrichment is calculated
+            options: 'Lipid Maps Category', 'Lipid Maps Main Class', 'Acyls'
+    query: DataFrame
+    universe: DataFrame
+    alternative: string
+                 defines the alternative hypothesis
+                 options: 'greater', 'less', 'two-sided'; default: 'greater'
+    statistical_method: string
+                        defines the multiple hypothesis correction
+                        options: 'FDR', 'Bonferroni Correction', 'Holm-Bonferroni'; default: 'FDR'
+    alpha_level: float
+                 threshold value for multiple tests
+    universe_index: UniverseIndex
+                    index of the universe, built for this call by default
 
-                df['FDR'] = fdr(df['p-value'].to_numpy(), statistical_method, alpha_level)
-                df['FDR'] = df['FDR'].apply(lambda x: round(x, 4) if isinstance(x, float) else x)
+    Returns
+    -------
+    df_final: DataFrame
+    '''
 
-                df['Odds Ratio'] = df['Odds Ratio'].apply(lambda x: 'N.D.' if (x=='nan') else x)
+    if universe_index is None:
+        universe_index = UniverseIndex(universe)
 
-                df['Hypothesis Correction Result'] = hypothesis_correction(df['p-value'].to_numpy(), statistical_method, alpha_level)
+    # the terms of every level, or of every round of the shorthand level cascade, are one block
+    blocks = general_blocks(levels, query, universe_index, filter_count)
 
-                df_final = pd.concat([df_final, df]).reset_index(drop=True)
+    contingency_tables = [[[query_total, universe_total], [block['Query Grandtotal']-query_total, block['Universe Grandtotal']-universe_total]]
+                          for block in blocks for query_total, universe_total in zip(block['Query'], block['Universe'])]
+    oddsr_values, p_value = fisher_exact_batch(contingency_tables, alternative=alternative)
 
-                level_options = level_options[1:]
-    
-    return df_final
+    bounds = np.cumsum([len(block['Query']) for block in blocks])[:-1]
 
+    return terms_table(blocks, np.split(p_value, bounds), statistical_method, alpha_level, np.split(oddsr_values, bounds), odds_ratio_text='Acyls' not in levels)
 
 
-def calculate_enrichment_within_subset_fisher(levels, subsets, query, universe, alternative, statistical_method, alpha_level, filter_count):
+def calculate_enrichment_within_subset_fisher(levels, subsets, query, universe, alternative, statistical_method, alpha_level, filter_count, universe_index=None):
 
     '''
     Calculate enrichment within chosen subsets using Fisher exact test
@@ -223,6 +221,8 @@ def calculate_enrichment_within_subset_fisher(levels, subsets, query, universe,
                         options: 'FDR', 'Bonferroni Correction', 'Holm-Bonferroni'; default: 'FDR'
     alpha_level: float
                  threshold value for multiple tests
+    universe_index: UniverseIndex
+                    index of the universe, built for this call by default
     Returns
     -------
     df_final: DataFrame
@@ -235,31 +235,16 @@ def calculate_enrichment_within_subset_fisher(levels, subsets, query, universe,
         subsets = [s for s in subsets if s != 'Ethers']
     
     
-    df_final = pd.DataFrame()
-
-    for level in levels:
-
-        universe_gb = universe.groupby(by=level)
-        query_gb = query.groupby(by=level)
+    # all (category, subset, term) counts come from one grouped pass instead of a call per category
+    blocks = within_subset_blocks(levels, subsets, query, universe, filter_count, universe_index)
 
-        universe_groups = dict(list(universe_gb))
-        query_groups = dict(list(query_gb))
+    contingency_tables = [[[query_total, universe_total], [block['Query Grandtotal']-query_total, block['Universe Grandtotal']-universe_total]]
+                          for block in blocks for query_total, universe_total in zip(block['Query'], block['Universe'])]
+    oddsr_values, p_value = fisher_exact_batch(contingency_tables, alternative=alternative)
 
-        for category in [c for c in universe_groups.keys() if c not in ['nan', 'None']]:
-            universe_groups_category = universe_gb.get_group(category)
-            try:
-                query_groups_category = query_gb.get_group(category)
-            except:
-                query_groups_category = universe_gb.get_group(category)
+    bounds = np.cumsum([len(block['Query']) for block in blocks])[:-1]
 
-            df = calculate_enrichment_fisher(subsets, query_groups_category, universe_groups_category, alternative, statistical_method, alpha_level, filter_count)
-
-            df['Term (Group)'] = df['Term (Group)'].apply(lambda x: str(x) + ' within ' + str(category))
-
-            df_final = pd.concat([df_final, df]).reset_index(drop=True)
-
-        
-    return df_final
+    return terms_table(blocks, np.split(p_value, bounds), statistical_method, alpha_level, np.split(oddsr_values, bounds), odds_ratio_text='Acyls' not in subsets)
 
 
 
@@ -294,136 +279,47 @@ def calculate_enrichment_fisher_advanced(levels, query, universe, alternative, s
     df_final: DataFrame
     '''
 
-    query = query[query['Lipid Maps Category'] != 'Undefined lipid category [UNDEFINED]']
-    universe = universe[universe['Lipid Maps Category'] != 'Undefined lipid category [UNDEFINED]']
-
-    df_final = pd.DataFrame()
-
-    for level in levels:
-
-        universe_gb = universe.groupby(by=level)
-        query_gb = query.groupby(by=level)
-
-        universe_groups = dict(list(universe_gb))
-        query_groups = dict(list(query_gb))
-
-        group_name, category_name, level_name, p_value, oddsr_ratio, number_query, number_universe = ([] for i in range(7))
-        for category in [c for c in universe_groups.keys() if c not in ['nan', 'None']]:
-
-            universe_groups_category = universe_gb.get_group(category)
-
-            try:
-                query_groups_category = query_gb.get_group(category)
-            except:
-                query_groups_category = universe_gb.get_group(category)
-
-
-            universe_grandtotal = int(universe_groups_category['Normalized Name'].count())
-            query_grandtotal = int(query_groups_category['Normalized Name'].count())
-
-
-            column_names_list = query_groups_category.columns.to_list()
-
-
-            if specific == 'CARBONS':
-                matches = re.findall(r'FA\d #C', ' '.join(map(str, column_names_list)))
-            if specific == 'DOUBLE BONDS':
-                matches = re.findall(r'FA\d #DB', ' '.join(map(str, column_names_list)))
-
-
-            universe_filtered_new = pd.DataFrame()
-            query_filtered_new = pd.DataFrame()
-
-
-            for i in matches:
-                universe_groups_category_copy = universe_groups_category.copy()
-                universe_groups_category_copy.loc[universe_groups_category_copy[i] == 0, i] = np.nan
-
-                query_groups_category_copy = query_groups_category.copy()
-                query_groups_category_copy.loc[query_groups_category_copy[i] == 0, i] = np.nan
-
-                ### CARBONS
-                if filter == 'acyls containing less than 16 carbon atoms':
-                    universe_filtered = universe_groups_category_copy.loc[universe_groups_category_copy[i] < 16]
-                    query_filtered = query_groups_category_copy.loc[query_groups_category_copy[i] < 16]
-
-                if filter == 'acyls containing 16-18 carbon atoms':
-                    universe_filtered = universe_groups_category_copy.loc[(universe_groups_category_copy[i] >= 16) & (universe_groups_category_copy[i] <= 18)]
-                    query_filtered = query_groups_category_copy.loc[(query_groups_category_copy[i] >= 16) & (query_groups_category_copy[i] <= 18)]
-
-                if filter == 'acyls containing more than 18 carbon atoms':
-                    universe_filtered = universe_groups_category_copy.loc[universe_groups_category_copy[i] > 18]
-                    query_filtered = query_groups_category_copy.loc[query_groups_category_copy[i] > 18]
-
-
-                ### DOUBLE BONDS
-                if filter == 'acyls containing 0 double bonds (saturated)':
-                    universe_filtered = universe_groups_category_copy.loc[universe_groups_category_copy[i] == 0]
-                    query_filtered = query_groups_category_copy.loc[query_groups_category_copy[i] == 0]
-                
-                if filter == 'acyls containing 1 double bonds (monounsaturated)':
-                    universe_filtered = universe_groups_category_copy.loc[universe_groups_category_copy[i] == 1]
-                    query_filtered = query_groups_category_copy.loc[query_groups_category_copy[i] == 1]
-
-                if filter == 'acyls containing 2 or more double bonds (polyunsaturated)':
-                    universe_filtered = universe_groups_category_copy.loc[universe_groups_category_copy[i] >= 2]
-                    query_filtered = query_groups_category_copy.loc[query_groups_category_copy[i] >= 2]
-
-                universe_filtered_new = pd.concat([universe_filtered_new, universe_filtered])
-                query_filtered_new = pd.concat([query_filtered_new, query_filtered])
+    return calculate_enrichment_fisher_advanced_buckets(levels, query, universe, alternative, [filter], statistical_method, alpha_level, filter_count)
 
 
-            universe_filtered_new = universe_filtered_new.drop_duplicates()
-            query_filtered_new = query_filtered_new.drop_duplicates()
 
-            universe_n = universe_filtered_new.count()
-            universe_total = int(universe_n['Normalized Name'].sum())
+def calculate_enrichment_fisher_advanced_buckets(levels, query, universe, alternative, filters, statistical_method, alpha_level, filter_count, universe_index=None):
 
+    '''
+    Calculate enrichment based on several defined conditions using Fisher exact test, the lipids are bucketed
+    for all the conditions in one pass and the p-values are computed in one call
+    Param
+    -------
+    levels: list
+            list of options at which level the enrichment is calculated
+            options: 'Lipid Maps Category', 'Lipid Maps Main Class'
+    query: DataFrame
+    universe: DataFrame
+    alternative: string
+                 defines the alternative hypothesis
+                 options: 'greater', 'less', 'two-sided'; default: 'greater'
+    filters: list
+             filter conditions, every condition is corrected for multiple testing on its own
+             options: find options in carbon_options.txt and double_bonds_option.txt
+    statistical_method: string
+                        defines the multiple hypothesis correction
+                        options: 'FDR', 'Bonferroni Correction', 'Holm-Bonferroni'; default: 'FDR'
+    alpha_level: float
+                 threshold value for multiple tests
+    universe_index: UniverseIndex
+                    index of the universe, built for this call by default
 
-            try:
-                query_n = query_filtered_new.count()
-                query_total = int(query_n['Normalized Name'].sum())
-            except:
-                query_total=0
-
-
-            if query_total > filter_count and universe_total > filter_count:  
-                contingency_table = [[query_total, universe_total], [query_grandtotal-query_total, universe_grandtotal-universe_total]]  
-                oddsr, p = fisher_exact(contingency_table, alternative=alternative)
-
-                abbr_match = re.search('(?<=\[).*?(?=\])', category)
-
-                if abbr_match:
-                    abbr = abbr_match.group()
-                else:
-                    abbr = None
-
-                group_name.append(category)
-                
-                if abbr is not None:
-                    category_name.append('[' + abbr + ']' + ' with ' + filter)
-                else:
-                    category_name.append('[' + category + ']' + ' with ' + filter)
-
-                level_name.append('MOLECULAR_SPECIES')
-                number_universe.append(str(universe_total) + '/' + str(universe_grandtotal))
-                number_query.append(str(query_total) + '/' + str(query_grandtotal))
-                p_value.append(p)
-                oddsr_ratio.append(round(oddsr, 4))
-            
-        df = pd.DataFrame(list(zip(group_name, category_name, level_name, number_query, number_universe, p_value, oddsr_ratio)), 
-                columns =['Term (Group)', 'Term (Classifier)', 'Level', 'No Query', 'No Reference','p-value', 'Odds Ratio'])
-    
-
-        df = df.sort_values('p-value', ignore_index=True)
+    Returns
+    -------
+    df_final: DataFrame
+              same rows as calculate_enrichment_fisher_advanced run for every filter and concatenated
+    '''
 
-        df['FDR'] = fdr(df['p-value'].to_numpy(), statistical_method, alpha_level)
-        df['FDR'] = df['FDR'].apply(lambda x: round(x, 4) if isinstance(x, float) else x)
+    blocks = acyl_bucket_blocks(levels, query, universe, filters, filter_count, universe_index)
 
-        df['Odds Ratio'] = df['Odds Ratio'].apply(lambda x: 'N.D.' if (x=='nan') else x)
+    contingency_tables = [[[q, u], [qg - q, ug - u]] for block in blocks for q, u, qg, ug in zip(block['Query'], block['Universe'], block['Query Grandtotal'], block['Universe Grandtotal'])]
+    bounds = np.cumsum([len(block['Query']) for block in blocks])[:-1]
 
-        df['Hypothesis Correction Result'] = hypothesis_correction(df['p-value'].to_numpy(), statistical_method, alpha_level)
+    oddsr_values, p_value = fisher_exact_batch(contingency_tables, alternative=alternative)
 
-        df_final = pd.concat([df_final, df]).reset_index(drop=True)
-            
-    return df_final
\ No newline at end of file
+    return terms_table(blocks, np.split(p_value, bounds), statistical_method, alpha_level, np.split(oddsr_values, bounds), odds_ratio_text=False, dropna=False)
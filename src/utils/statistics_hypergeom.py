@@ -1,198 +1,141 @@
 import pandas as pd
 import numpy as np
-import re
 from scipy.stats import hypergeom
+from scipy.special import gammaln
+from functools import lru_cache
 
-from utils.common_functions import fdr
-from utils.hypothesis_correction import hypothesis_correction
+from utils.term_counts import UniverseIndex, general_blocks, within_subset_blocks, acyl_bucket_blocks, terms_table
 
 
 
-def calculate_enrichment_hypergeom(levels, query, universe, statistical_method, alpha_level, filter_count):
+@lru_cache(maxsize=16)
+def log_factorials(M):
+    table = gammaln(np.arange(M + 1) + 1)
+    table.setflags(write=False)
+    return table
+
+
+
+def hypergeom_sf_table(k, M, n, N):
 
     '''
-    Calculate enrichment using hypergeometric distribution
-    
+    Survival function of the hypergeometric distribution for terms sharing the population size M and the
+    number of draws N, the tails are summed from one table of log-factorials shared by all terms
+
     Param
     -------
-    levels: list
-            list of options at which level the enrichment is calculated
-            options: 'Lipid Maps Category', 'Lipid Maps Main Class', 'Acyls'
-    query: DataFrame
-    universe: DataFrame
-    statistical_method: string
-                        defines the multiple hypothesis correction
-                        options: 'FDR', 'Bonferroni Correction', 'Holm-Bonferroni'; default: 'FDR'
-    alpha_level: float
-                 threshold value for multiple tests
+    k: numpy.ndarray
+    M: int
+    n: numpy.ndarray
+    N: int
 
     Returns
     -------
-    df_final: DataFrame
+    p_value: numpy.ndarray
+             P(X > k), nan for invalid parameters like scipy.stats.hypergeom
     '''
 
-    query = query[query['Lipid Maps Category'] != 'Undefined lipid category [UNDEFINED]']
-    universe = universe[universe['Lipid Maps Category'] != 'Undefined lipid category [UNDEFINED]']
-
-    query = query.replace('0:0', np.nan)
-    universe = universe.replace('0:0', np.nan)
-
-    if 'Acyls' not in levels:
-
-        df_final = pd.DataFrame()
-
-        for level in levels:
-
-            if level in universe.columns and level in query.columns:
-
-                universe_gb = universe.groupby(by=level)
-                query_gb = query.groupby(by=level)
-
-                universe_groups = dict(list(universe_gb))
-                query_groups = dict(list(query_gb))
-                
-                universe_grandtotal = int(universe['Normalized Name'].count())
-                query_grandtotal = int(query['Normalized Name'].count())
-
-                group_name, category_name, level_name, p_value, number_query, number_universe = ([] for i in range(6))
-                for category in [c for c in universe_groups.keys() if c not in ['nan', 'None']]:
-                    universe_n = universe_groups[category].count()
-                    universe_total = int(universe_n['Normalized Name'].sum())
-                    
-                    try:
-                        query_n = query_groups[category].count()
-                        query_total = int(query_n['Normalized Name'].sum())
-
-                    except:
-                        query_total=0
-                    
-                    if query_total > filter_count and universe_total > filter_count:
-                        p = hypergeom.sf(query_total - 1, universe_grandtotal, universe_total, query_grandtotal)
-
-                        group_name.append(level)
-                        category_name.append(category)
-
-                        if level == 'Lipid Maps Category':
-                            level_name.append('CATEGORY')
-                        if level == 'Lipid Maps Main Class':
-                            level_name.append('CLASS')
-                        if level.startswith('Total'):
-                            level_name.append('SPECIES')
-                        if 'SN Position' in level:
-                            level_name.append('SN_POSITION')
-                        if 'Position Numbers' in level:
-                            level_name.append('STRUCTURE_DEFINED')
-                        if 'Position Geometries' in level:
-                            level_name.append('FULL_STRUCTURE')
-                        if 'DB Positions' in level:
-                            level_name.append('FULL_STRUCTURE')
-                        if level.startswith('FA') and not level.endswith(('SN Position', 'Position Numbers', 'Position Geometries', 'DB Positions')):
-                            level_name.append('MOLECULAR_SPECIES')
+    p_value = np.full(len(k), np.nan)
 
-                        number_universe.append(str(universe_total) + '/' + str(universe_grandtotal))
-                        number_query.append(str(query_total) + '/' + str(query_grandtotal))
-                        p_value.append(p)
+    if not (M > 0 and 0 <= N <= M):
+        return p_value
 
-                df = pd.DataFrame(list(zip(group_name, category_name, level_name, number_query, number_universe, p_value,)), 
-                                    columns =['Term (Group)', 'Term (Classifier)', 'Level', 'No Query', 'No Reference','p-value'])
-                
-                df = df.dropna(subset=['p-value'])
+    valid = (n >= 0) & (n <= M)
+    lower = np.maximum(0, N + n - M)
+    upper = np.minimum(n, N)
+    start = k + 1
 
-                df = df.drop(df[df['Term (Classifier)'] == False].index)
+    p_value[valid & (start <= lower)] = 1.0
+    p_value[valid & (start > upper)] = 0.0
 
-                df = df.sort_values('p-value', ignore_index=True)
+    terms = np.flatnonzero(valid & (start > lower) & (start <= upper))
 
-                df['FDR'] = fdr(df['p-value'].to_numpy(), statistical_method, alpha_level)
-                df['FDR'] = df['FDR'].apply(lambda x: round(x, 4) if isinstance(x, float) else x)
+    if len(terms) > 0:
+        lf = log_factorials(M)
 
-                df['Hypothesis Correction Result'] = hypothesis_correction(df['p-value'].to_numpy(), statistical_method, alpha_level)
+        start, upper, n = start[terms, None], upper[terms, None], n[terms, None]
+        x = start + np.arange((upper - start).max() + 1)
+        inside = x <= upper
+        x = np.where(inside, x, start)
 
-                df_final = pd.concat([df_final, df]).reset_index(drop=True)
+        log_pmf = lf[n] - lf[x] - lf[n - x] + lf[M - n] - lf[N - x] - lf[M - n - N + x] - (lf[M] - lf[N] - lf[M - N])
+        p_value[terms] = np.minimum(np.where(inside, np.exp(log_pmf), 0.0).sum(axis=1), 1.0)
 
-    if 'Acyls' in levels:
+    return p_value
 
-        df_final = pd.DataFrame()
 
-        level_options = ['MOLECULAR_SPECIES', 'SN_POSITION', 'STRUCTURE_DEFINED', 'FULL_STRUCTURE', 'COMPLETE_STRUCTURE']
 
-        while len(level_options) > 0:
+def hypergeom_sf_batch(k, M, n, N):
 
-            universe_filtered = universe.loc[universe['Level'].isin(level_options)]
-            query_filtered = query.loc[query['Level'].isin(level_options)]
-
-            for level in levels:
-
-                universe_gb = universe_filtered.groupby(by=level)
-                query_gb = query_filtered.groupby(by=level)
-
-                universe_groups = dict(list(universe_gb))
-                query_groups = dict(list(query_gb))
-                
-                universe_grandtotal = int(universe['Normalized Name'].count())
-                query_grandtotal = int(query['Normalized Name'].count())
+    '''
+    Survival function of the hypergeometric distribution for all terms of a level in one call
 
-                group_name, category_name, level_name, p_value, number_query, number_universe, missing_query, missing_universe, missing_query_val, missing_universe_val = ([] for i in range(10))
-                for category in [c for c in universe_groups.keys() if c not in ['nan', 'None']]:
-                    universe_n = universe_groups[category].count()
-                    universe_total = int(universe_n['Normalized Name'].sum())
+    Param
+    -------
+    k: list
+    M: int or list
+       population size, the universe grand total
+    n: list
+       successes in the population, the universe totals
+    N: int or list
+       number of draws, the query grand total
 
-                    universe_n_all = universe[universe[level] == category].shape[0]
-                    
-                    try:
-                        query_n = query_groups[category].count()
-                        query_total = int(query_n['Normalized Name'].sum())
+    Returns
+    -------
+    p_value: numpy.ndarray
+    '''
 
-                        query_n_all = query[query[level] == category].shape[0]
+    k = np.asarray(k, dtype=np.int64)
+    n = np.asarray(n, dtype=np.int64)
 
-                    except:
-                        query_total=0
-                    
-                    if query_total > filter_count and universe_total > filter_count:
-                        p = hypergeom.sf(query_total - 1, universe_grandtotal, universe_total, query_grandtotal)
-
-                        group_name.append(level)
-                        category_name.append(category)
-                        level_name.append(level_options[0])
-                        number_universe.append(str(universe_total) + '/' + str(universe_grandtotal))
-                        number_query.append(str(query_total) + '/' + str(query_grandtotal))
-                        p_value.append(p)
+    if len(k) == 0:
+        return np.array([], dtype=float)
 
-                        missing_query.append(str(query_total) + '/' + str(query_n_all))
-                        missing_universe.append(str(universe_total) + '/' + str(universe_n_all))
+    # fast path: all terms of a level share M and N
+    if np.ndim(M) == 0 and np.ndim(N) == 0:
+        return hypergeom_sf_table(k, int(M), n, int(N))
 
-                        if (query_total/query_n_all) == 1:
-                            missing_query_val.append(str(False))
-                        if (query_total/query_n_all) != 1:
-                            missing_query_val.append(str(True))
+    return np.asarray(hypergeom.sf(k, np.asarray(M, dtype=np.int64), n, np.asarray(N, dtype=np.int64)), dtype=float)
 
-                        if (universe_total/universe_n_all) == 1:
-                            missing_universe_val.append(str(False))
-                        if (universe_total/universe_n_all) != 1:
-                            missing_universe_val.append(str(True))
 
-                df = pd.DataFrame(list(zip(group_name, category_name, level_name, number_query, number_universe, p_value, missing_query, missing_universe, missing_query_val, missing_universe_val)), 
-                                    columns =['Term (Group)', 'Term (Classifier)', 'Level', 'No Query', 'No Reference','p-value', 'Missing Query', 'Missing Reference', 'Missing Query Val', 'Missing Reference Val'])
-                
-                df = df.dropna(subset=['p-value'])
 
-                df = df.drop(df[df['Term (Classifier)'] == False].index)
+def calculate_enrichment_hypergeom(levels, query, universe, statistical_method, alpha_level, filter_count, universe_index=None):
 
-                df = df.sort_values('p-value', ignore_index=True)
+    '''
+    Calculate enrichment using hypergeometric distribution
+    
+    Param
+    -------
+    levels: list
+            list of options at which level the enrichment is calculated
+            options: 'Lipid Maps Category', 'Lipid Maps Main Class', 'Acyls'
+    query: DataFrame
+    universe: DataFrame
+    statistical_method: string
+                        defines the multiple hypothesis correction
+                        options: 'FDR', 'Bonferroni Correction', 'Holm-Bonferroni'; default: 'FDR'
+    alpha_level: float
+                 threshold value for multiple tests
+    universe_index: UniverseIndex
+                    index of the universe, built for this call by default
 
-                df['FDR'] = fdr(df['p-value'].to_numpy(), statistical_method, alpha_level)
-                df['FDR'] = df['FDR'].apply(lambda x: round(x, 4) if isinstance(x, float) else x)
+    Returns
+    -------
+    df_final: DataFrame
+    '''
 
-                df['Hypothesis Correction Result'] = hypothesis_correction(df['p-value'].to_numpy(), statistical_method, alpha_level)
+    if universe_index is None:
+        universe_index = UniverseIndex(universe)
 
-                df_final = pd.concat([df_final, df]).reset_index(drop=True)
-    
-                level_options = level_options[1:]
+    # the terms of every level, or of every round of the shorthand level cascade, are one block
+    blocks = general_blocks(levels, query, universe_index, filter_count)
 
-    return df_final
+    p_values = [hypergeom_sf_batch(np.subtract(block['Query'], 1), block['Universe Grandtotal'], block['Universe'], block['Query Grandtotal']) for block in blocks]
 
+    return terms_table(blocks, p_values, statistical_method, alpha_level)
 
 
-def calculate_enrichment_within_subset_hypergeom(levels, subsets, query, universe, statistical_method, alpha_level, filter_count):
+def calculate_enrichment_within_subset_hypergeom(levels, subsets, query, universe, statistical_method, alpha_level, filter_count, universe_index=None):
 
     '''
     Calculate enrichment within chosen subsets using hypergeometric distribution
@@ -211,6 +154,8 @@ def calculate_enrichment_within_subset_hypergeom(levels, subsets, query, univers
                         options: 'FDR', 'Bonferroni Correction', 'Holm-Bonferroni'; default: 'FDR'
     alpha_level: float
                  threshold value for multiple tests
+    universe_index: UniverseIndex
+                    index of the universe, built for this call by default
 
     Returns
     -------
@@ -223,30 +168,12 @@ def calculate_enrichment_within_subset_hypergeom(levels, subsets, query, univers
     if 'Ethers' not in query.columns or 'Ethers' not in universe.columns:
         subsets = [s for s in subsets if s != 'Ethers']
 
-    df_final = pd.DataFrame()
-
-    for level in levels:
-
-        universe_gb = universe.groupby(by=level)
-        query_gb = query.groupby(by=level)
-
-        universe_groups = dict(list(universe_gb))
-        query_groups = dict(list(query_gb))
+    # all (category, subset, term) counts come from one grouped pass instead of a call per category
+    blocks = within_subset_blocks(levels, subsets, query, universe, filter_count, universe_index)
 
-        for category in [c for c in universe_groups.keys() if c not in ['nan', 'None']]:
-            universe_groups_category = universe_gb.get_group(category)
-            try:
-                query_groups_category = query_gb.get_group(category)
-            except:
-                query_groups_category = universe_gb.get_group(category)
+    p_values = [hypergeom_sf_batch(np.subtract(block['Query'], 1), block['Universe Grandtotal'], block['Universe'], block['Query Grandtotal']) for block in blocks]
 
-            df = calculate_enrichment_hypergeom(subsets, query_groups_category, universe_groups_category, statistical_method, alpha_level, filter_count)
-
-            df['Term (Group)'] = df['Term (Group)'].apply(lambda x: str(x) + ' within ' + str(category))
-
-            df_final = pd.concat([df_final, df]).reset_index(drop=True)
-        
-    return df_final
+    return terms_table(blocks, p_values, statistical_method, alpha_level)
 
 
 
@@ -278,134 +205,45 @@ def calculate_enrichment_hypergeom_advanced(levels, query, universe, specific, f
     df_final: DataFrame
     '''
 
-    query = query[query['Lipid Maps Category'] != 'Undefined lipid category [UNDEFINED]']
-    universe = universe[universe['Lipid Maps Category'] != 'Undefined lipid category [UNDEFINED]']
-
-    df_final = pd.DataFrame()
-
-    for level in levels:
-
-        universe_gb = universe.groupby(by=level)
-        query_gb = query.groupby(by=level)
-
-        universe_groups = dict(list(universe_gb))
-        query_groups = dict(list(query_gb))
-
-
-        group_name, category_name, level_name, p_value, number_query, number_universe = ([] for i in range(6))
-        for category in [c for c in universe_groups.keys() if c not in ['nan', 'None']]:
-
-            universe_groups_category = universe_gb.get_group(category)
-
-            try:
-                query_groups_category = query_gb.get_group(category)
-            except:
-                query_groups_category = universe_gb.get_group(category)
-
-            
-            universe_grandtotal = int(universe_groups_category['Normalized Name'].count())
-            query_grandtotal = int(query_groups_category['Normalized Name'].count())
-
-
-            column_names_list = query_groups_category.columns.to_list()
-
-
-            if specific == 'CARBONS':
-                matches = re.findall(r'FA\d #C', ' '.join(map(str, column_names_list)))
-            if specific == 'DOUBLE BONDS':
-                matches = re.findall(r'FA\d #DB', ' '.join(map(str, column_names_list)))
-
-
-            universe_filtered_new = pd.DataFrame()
-            query_filtered_new = pd.DataFrame()
-
-
-            for i in matches:
-                universe_groups_category_copy = universe_groups_category.copy()
-                universe_groups_category_copy.loc[universe_groups_category_copy[i] == 0, i] = np.nan
-
-                query_groups_category_copy = query_groups_category.copy()
-                query_groups_category_copy.loc[query_groups_category_copy[i] == 0, i] = np.nan
-
-                ### CARBONS
-                if filter == 'acyls containing less than 16 carbon atoms':
-                    universe_filtered = universe_groups_category_copy.loc[universe_groups_category_copy[i] < 16]
-                    query_filtered = query_groups_category_copy.loc[query_groups_category_copy[i] < 16]
-
-                if filter == 'acyls containing 16-18 carbon atoms':
-                    universe_filtered = universe_groups_category_copy.loc[(universe_groups_category_copy[i] >= 16) & (universe_groups_category_copy[i] <= 18)]
-                    query_filtered = query_groups_category_copy.loc[(query_groups_category_copy[i] >= 16) & (query_groups_category_copy[i] <= 18)]
-
-                if filter == 'acyls containing more than 18 carbon atoms':
-                    universe_filtered = universe_groups_category_copy.loc[universe_groups_category_copy[i] > 18]
-                    query_filtered = query_groups_category_copy.loc[query_groups_category_copy[i] > 18] 
-
-                ### DOUBLE BONDS
-                if filter == 'acyls containing 0 double bonds (saturated)':
-                    universe_filtered = universe_groups_category_copy.loc[universe_groups_category_copy[i] == 0]
-                    query_filtered = query_groups_category_copy.loc[query_groups_category_copy[i] == 0]
-                
-                if filter == 'acyls containing 1 double bonds (monounsaturated)':
-                    universe_filtered = universe_groups_category_copy.loc[universe_groups_category_copy[i] == 1]
-                    query_filtered = query_groups_category_copy.loc[query_groups_category_copy[i] == 1]
+    return calculate_enrichment_hypergeom_advanced_buckets(levels, query, universe, [filter], statistical_method, alpha_level, filter_count)
 
-                if filter == 'acyls containing 2 or more double bonds (polyunsaturated)':
-                    universe_filtered = universe_groups_category_copy.loc[universe_groups_category_copy[i] >= 2]
-                    query_filtered = query_groups_category_copy.loc[query_groups_category_copy[i] >= 2]
 
 
-                universe_filtered_new = pd.concat([universe_filtered_new, universe_filtered])
-                query_filtered_new = pd.concat([query_filtered_new, query_filtered])
+def calculate_enrichment_hypergeom_advanced_buckets(levels, query, universe, filters, statistical_method, alpha_level, filter_count, universe_index=None):
 
+    '''
+    Calculate enrichment based on several defined conditions using hypergeometric test, the lipids are bucketed
+    for all the conditions in one pass and the p-values are computed in one call
+    Param
+    -------
+    levels: list
+            list of options at which level the enrichment is calculated
+            options: 'Lipid Maps Category', 'Lipid Maps Main Class'
+    query: DataFrame
+    universe: DataFrame
+    filters: list
+             filter conditions, every condition is corrected for multiple testing on its own
+             options: find options in carbon_options.txt and double_bonds_option.txt
+    statistical_method: string
+                        defines the multiple hypothesis correction
+                        options: 'FDR', 'Bonferroni Correction', 'Holm-Bonferroni'; default: 'FDR'
+    alpha_level: float
+                 threshold value for multiple tests
+    universe_index: UniverseIndex
+                    index of the universe, built for this call by default
 
-            universe_filtered_new = universe_filtered_new.drop_duplicates()
-            query_filtered_new = query_filtered_new.drop_duplicates()
-
-            universe_n = universe_filtered_new.count()
-            universe_total = int(universe_n['Normalized Name'].sum())
-
-
-            try:
-                query_n = query_filtered_new.count()
-                query_total = int(query_n['Normalized Name'].sum())
-            except:
-                query_total=0
-
-
-            if query_total > filter_count and universe_total > filter_count:  
-                p = hypergeom.sf(query_total - 1, universe_grandtotal, universe_total, query_grandtotal)
-
-                abbr_match = re.search('(?<=\[).*?(?=\])', category)
-
-                if abbr_match:
-                    abbr = abbr_match.group()
-                else:
-                    abbr = None
-
-                group_name.append(category)
-
-                if abbr is not None:
-                    category_name.append('[' + abbr + ']' + ' with ' + filter)
-                else:
-                    category_name.append('[' + category + ']' + ' with ' + filter)
-                    
-                level_name.append('MOLECULAR_SPECIES')
-                number_universe.append(str(universe_total) + '/' + str(universe_grandtotal))
-                number_query.append(str(query_total) + '/' + str(query_grandtotal))
-                p_value.append(p)
-            
-        df = pd.DataFrame(list(zip(group_name, category_name, level_name, number_query, number_universe, p_value)), 
-                columns =['Term (Group)', 'Term (Classifier)', 'Level', 'No Query', 'No Reference','p-value'])
-    
-
-        df = df.sort_values('p-value', ignore_index=True)
+    Returns
+    -------
+    df_final: DataFrame
+              same rows as calculate_enrichment_hypergeom_advanced run for every filter and concatenated
+    '''
 
-        df['FDR'] = fdr(df['p-value'].to_numpy(), statistical_method, alpha_level)
-        df['FDR'] = df['FDR'].apply(lambda x: round(x, 4) if isinstance(x, float) else x)
+    blocks = acyl_bucket_blocks(levels, query, universe, filters, filter_count, universe_index)
 
-        df['Hypothesis Correction Result'] = hypothesis_correction(df['p-value'].to_numpy(), statistical_method, alpha_level)
+    query_totals, universe_totals, query_grandtotals, universe_grandtotals = ([value for block in blocks for value in block[key]] for key in ['Query', 'Universe', 'Query Grandtotal', 'Universe Grandtotal'])
+    bounds = np.cumsum([len(block['Query']) for block in blocks])[:-1]
 
-        df_final = pd.concat([df_final, df]).reset_index(drop=True)
-            
+    # the grand totals differ between the categories, no shared table here
+    p_value = hypergeom_sf_batch(np.subtract(query_totals, 1), universe_grandtotals, universe_totals, query_grandtotals)
 
-    return df_final
\ No newline at end of file
+    return terms_table(blocks, np.split(p_value, bounds), statistical_method, alpha_level, dropna=False)
@@ -0,0 +1,229 @@
+import pandas as pd
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import threading
+import atexit
+import os
+
+from utils.term_counts import ACYL_LEVEL_OPTIONS, UniverseIndex, general_blocks, terms_table
+
+
+PERMUTATION_TEST = 'Permutation test'
+PERMUTATION_ITERATIONS = 10000
+# the vectorised permutations run in the calling thread, more workers opt in to a shared process pool
+PERMUTATION_WORKERS = int(os.environ.get('LORA_PERMUTATION_WORKERS', 1))
+
+# permutations per task, the seeds of the tasks do not depend on the number of workers
+PERMUTATION_CHUNK = 1000
+
+# random keys drawn at once, bounds the memory of one batch
+PERMUTATION_BATCH_SIZE = 2**22
+
+
+
+_permutation_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_permutation_pool():
+
+    '''
+    Get the process pool shared by all permutation tests, create it on first use
+
+    Every session and every query of a batch submits its chunks to the same PERMUTATION_WORKERS
+    processes, no processes are started per click. The pool is created from the threads of the
+    server, its processes are spawned instead of forked so they do not inherit locks held by them
+
+    Returns
+    -------
+    pool: ProcessPoolExecutor
+    '''
+
+    global _permutation_pool
+
+    with _pool_lock:
+        if _permutation_pool is None:
+            _permutation_pool = ProcessPoolExecutor(max_workers=PERMUTATION_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+            atexit.register(_permutation_pool.shutdown)
+
+    return _permutation_pool
+
+
+
+def permutation_chunk(packed_membership, n_units, observed, sample_size, iterations, seed):
+
+    '''
+    Draw random query-sized subsets of the universe and count how often the null count of every term
+    reaches the observed one
+
+    Param
+    -------
+    packed_membership: numpy.ndarray
+                       membership of the universe units in the terms, bit-packed along the units
+    n_units: int
+    observed: numpy.ndarray
+              query count of every term
+    sample_size: int
+                 number of units drawn, the query grand total
+    iterations: int
+    seed: numpy.random.SeedSequence
+
+    Returns
+    -------
+    greater: numpy.ndarray
+             number of permutations with a null count >= observed
+    less: numpy.ndarray
+          number of permutations with a null count <= observed
+    '''
+
+    rng = np.random.default_rng(seed)
+    membership = np.unpackbits(packed_membership, axis=0, count=n_units).astype(np.float32)
+
+    greater = np.zeros(len(observed), dtype=np.int64)
+    less = np.zeros(len(observed), dtype=np.int64)
+
+    batch = max(1, PERMUTATION_BATCH_SIZE // max(n_units, 1))
+
+    for start in range(0, iterations, batch):
+        size = min(batch, iterations - start)
+
+        # the sample_size smallest random keys of every row are a uniform subset without replacement
+        keys = rng.random((size, n_units))
+        threshold = np.partition(keys, sample_size - 1, axis=1)[:, sample_size - 1:sample_size]
+        null = (keys <= threshold).astype(np.float32) @ membership
+
+        greater += (null >= observed).sum(axis=0)
+        less += (null <= observed).sum(axis=0)
+
+    return greater, less
+
+
+
+def permutation_p_values(membership, observed, sample_size, alternative='greater', iterations=PERMUTATION_ITERATIONS, seed=None, workers=PERMUTATION_WORKERS):
+
+    '''
+    Empirical p-values of all terms from one set of permutations shared by the terms
+
+    Param
+    -------
+    membership: numpy.ndarray
+                boolean matrix, universe units x terms
+    observed: list
+              query count of every term
+    sample_size: int
+                 query grand total
+    alternative: string
+                 options: 'greater', 'less', 'two-sided'
+    iterations: int
+    seed: int
+          none for a random seed
+    workers: int
+             1 to run in the calling thread, otherwise the chunks of PERMUTATION_CHUNK permutations go to
+             the shared process pool
+
+    Returns
+    -------
+    p_value: numpy.ndarray
+             (1 + permutations at least as extreme) / (1 + iterations), nan if the query does not fit the universe
+    '''
+
+    observed = np.asarray(observed, dtype=np.float32)
+    n_units, n_terms = membership.shape
+
+    if n_terms == 0:
+        return np.array([], dtype=float)
+
+    if not (0 < sample_size <= n_units) or iterations < 1:
+        return np.full(n_terms, np.nan)
+
+    packed_membership = np.packbits(membership.astype(bool), axis=0)
+
+    chunks = [min(PERMUTATION_CHUNK, iterations - start) for start in range(0, iterations, PERMUTATION_CHUNK)]
+    seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+    tasks = [(packed_membership, n_units, observed, sample_size, chunk, chunk_seed) for chunk, chunk_seed in zip(chunks, seeds)]
+
+    if workers > 1 and len(tasks) > 1:
+        results = list(get_permutation_pool().map(permutation_chunk, *zip(*tasks)))
+    else:
+        results = [permutation_chunk(*task) for task in tasks]
+
+    greater = sum(result[0] for result in results)
+    less = sum(result[1] for result in results)
+
+    p_greater = (1 + greater) / (1 + iterations)
+    p_less = (1 + less) / (1 + iterations)
+
+    if alternative == 'less':
+        return p_less
+    if alternative == 'two-sided':
+        return np.minimum(1.0, 2 * np.minimum(p_greater, p_less))
+    return p_greater
+
+
+
+def calculate_enrichment_permutation(levels, query, universe, alternative, statistical_method, alpha_level, filter_count, iterations=PERMUTATION_ITERATIONS, seed=None, workers=PERMUTATION_WORKERS, universe_index=None):
+
+    '''
+    Calculate enrichment using a permutation test, random query-sized subsets of the universe give the
+    empirical null distribution of every term
+
+    Param
+    -------
+    levels: list
+            list of options at which level the enrichment is calculated
+            options: 'Lipid Maps Category', 'Lipid Maps Main Class', 'Acyls'
+    query: DataFrame
+    universe: DataFrame
+    alternative: string
+                 defines the alternative hypothesis
+                 options: 'greater', 'less', 'two-sided'; default: 'greater'
+    statistical_method: string
+                        defines the multiple hypothesis correction
+                        options: 'FDR', 'Bonferroni Correction', 'Holm-Bonferroni'; default: 'FDR'
+    alpha_level: float
+                 threshold value for multiple tests
+    iterations: int
+                number of permutations
+    seed: int
+          seed of the random subsets, none for a random seed
+    workers: int
+             1 to run in the calling thread, otherwise the shared process pool is used
+    universe_index: UniverseIndex
+                    index of the universe, built for this call by default
+
+    Returns
+    -------
+    df_final: DataFrame
+              same columns as calculate_enrichment_hypergeom
+    '''
+
+    if universe_index is None:
+        universe_index = UniverseIndex(universe)
+
+    blocks = general_blocks(levels, query, universe_index, filter_count)
+
+    if len(blocks) == 0:
+        return pd.DataFrame()
+
+    universe = universe_index.general()
+
+    # the units drawn are the universe lipids counted in the grand total
+    units = universe['Normalized Name'].notna().to_numpy()
+
+    memberships = []
+    for block in blocks:
+        membership = universe_index.membership(block['Term (Group)'], block['Term (Classifier)'])[units]
+
+        if 'Step' in block:
+            # units annotated at the step of the cascade or a more detailed one
+            membership &= universe['Level'].isin(ACYL_LEVEL_OPTIONS[ACYL_LEVEL_OPTIONS.index(block['Step']):]).to_numpy()[units, None]
+
+        memberships.append(membership)
+
+    # one set of permutations is shared by the terms of all levels
+    observed = [query_total for block in blocks for query_total in block['Query']]
+    p_value = permutation_p_values(np.hstack(memberships), observed, blocks[0]['Query Grandtotal'], alternative, iterations, seed, workers)
+    bounds = np.cumsum([len(block['Query']) for block in blocks])[:-1]
+
+    return terms_table(blocks, np.split(p_value, bounds), statistical_method, alpha_level)
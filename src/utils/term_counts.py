@@ -0,0 +1,794 @@
+import pandas as pd
+import numpy as np
+import re
+import threading
+from collections import OrderedDict
+
+from utils.session_store import table_fingerprint
+
+
+ACYL_LEVEL_OPTIONS = ['MOLECULAR_SPECIES', 'SN_POSITION', 'STRUCTURE_DEFINED', 'FULL_STRUCTURE', 'COMPLETE_STRUCTURE']
+
+
+
+def get_level_name(level):
+
+    '''
+    Get the lipid shorthand level of the terms in a column
+
+    Param
+    -------
+    level: string
+           column name
+
+    Returns
+    -------
+    level_name: string
+                none for columns without a shorthand level
+    '''
+
+    if level == 'Lipid Maps Category':
+        return 'CATEGORY'
+    if level == 'Lipid Maps Main Class':
+        return 'CLASS'
+    if level.startswith('Total'):
+        return 'SPECIES'
+    if 'SN Position' in level:
+        return 'SN_POSITION'
+    if 'Position Numbers' in level:
+        return 'STRUCTURE_DEFINED'
+    if 'Position Geometries' in level:
+        return 'FULL_STRUCTURE'
+    if 'DB Positions' in level:
+        return 'FULL_STRUCTURE'
+    if level.startswith('FA') and not level.endswith(('SN Position', 'Position Numbers', 'Position Geometries', 'DB Positions')):
+        return 'MOLECULAR_SPECIES'
+
+    return None
+
+
+
+def drop_missing_terms(counts):
+    # terms are the last level of grouped counts
+    return counts[~counts.index.get_level_values(-1).isin(['nan', 'None'])]
+
+
+
+def count_terms(query, universe_index, level):
+
+    '''
+    Count lipids of every term of a level in the query, the universe counts come from the index
+
+    Param
+    -------
+    query: DataFrame
+    universe_index: UniverseIndex
+    level: string
+           column with the terms
+
+    Returns
+    -------
+    counts: DataFrame
+            index: terms of the universe in the groupby order
+            columns: 'Query', 'Universe' -> number of lipids with a normalized name
+    '''
+
+    universe_counts = universe_index.term_counts(level)
+    query_counts = query.groupby(by=level)['Normalized Name'].count()
+
+    return pd.DataFrame({
+        'Query': query_counts.reindex(universe_counts.index, fill_value=0).to_numpy(dtype=np.int64),
+        'Universe': universe_counts.to_numpy(dtype=np.int64),
+    }, index=universe_counts.index)
+
+
+
+def count_terms_cascade(df, level, level_options=ACYL_LEVEL_OPTIONS):
+
+    '''
+    Count lipids of every term of a level for every step of the shorthand level cascade, the counts of
+    step k include all lipids annotated at level_options[k:]
+
+    Param
+    -------
+    df: DataFrame
+    level: string
+           column with the terms, or list of columns ending with the terms
+    level_options: list
+                   shorthand levels ordered from the least to the most detailed one
+
+    Returns
+    -------
+    counts: DataFrame
+            index: terms, columns: level_options -> number of lipids with a normalized name
+    rows: DataFrame
+          index: terms, columns: level_options -> number of rows, zero for terms absent at that step
+    '''
+
+    df = df.loc[df['Level'].isin(level_options)]
+    keys = level if isinstance(level, list) else [level]
+    grouped = df.groupby(by=keys + ['Level'])['Normalized Name'].agg(['count', 'size'])
+
+    def cumulate(column):
+        table = grouped[column].unstack('Level').reindex(columns=level_options).fillna(0).astype(np.int64)
+        table = table[level_options[::-1]].cumsum(axis=1)[level_options]
+        return drop_missing_terms(table)
+
+    return cumulate('count'), cumulate('size')
+
+
+
+UNDEFINED_CATEGORY = 'Undefined lipid category [UNDEFINED]'
+
+
+
+def prepare_within(df, by):
+
+    '''
+    Drop undefined lipids and '0:0' fields once for all categories, the categories keep their original values
+
+    Param
+    -------
+    df: DataFrame
+    by: string
+        column with the categories
+
+    Returns
+    -------
+    df: DataFrame
+    '''
+
+    mask = (df['Lipid Maps Category'] != UNDEFINED_CATEGORY).to_numpy()
+    keys = df[by].to_numpy()[mask]
+
+    df = df[mask].replace('0:0', np.nan)
+    df[by] = keys
+
+    return df
+
+
+
+UNIVERSE_INDEX_CACHE = OrderedDict()
+UNIVERSE_INDEX_CACHE_SIZE = 8
+UNIVERSE_INDEX_CACHE_LOCK = threading.Lock()
+
+
+
+class UniverseIndex:
+
+    '''
+    Universe side of the enrichment of one reference table: term counts of the levels, term membership
+    bitsets over the rows and acyl bucket masks, every member is computed on first use and then shared
+    by all queries against the table
+    '''
+
+    def __init__(self, universe):
+        self.universe = universe
+        self.members = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def cached(self, key, compute):
+        if key not in self.members:
+            with self.lock:
+                key_lock = self.locks.setdefault(key, threading.Lock())
+            with key_lock:
+                if key not in self.members:
+                    self.members[key] = compute()
+
+        return self.members[key]
+
+    def defined(self):
+        return self.cached('defined', lambda: self.universe[self.universe['Lipid Maps Category'] != UNDEFINED_CATEGORY])
+
+    def general(self):
+        # universe of the general enrichment, '0:0' fields are missing
+        return self.cached('general', lambda: self.defined().replace('0:0', np.nan))
+
+    def grandtotal(self):
+        return self.cached('grandtotal', lambda: int(self.general()['Normalized Name'].count()))
+
+    def term_counts(self, level):
+        return self.cached(('term_counts', level), lambda: drop_missing_terms(self.general().groupby(by=level)['Normalized Name'].count()))
+
+    def cascade(self, level):
+        def compute():
+            counts, rows = count_terms_cascade(self.general(), level)
+            return counts, rows, self.general().groupby(by=level).size()
+
+        return self.cached(('cascade', level), compute)
+
+    def bitsets(self, level):
+        def compute():
+            column = pd.Categorical(self.general()[level])
+            member = np.flatnonzero(column.codes >= 0)
+            bits = np.zeros((len(column.categories), len(column)), dtype=bool)
+            bits[column.codes[member], member] = True
+            return column.categories, np.packbits(bits, axis=1)
+
+        return self.cached(('bitsets', level), compute)
+
+    def membership(self, level, terms):
+
+        '''
+        Membership of the rows of general() in the terms of a level, unpacked from the bitsets
+
+        Param
+        -------
+        level: string
+        terms: list
+
+        Returns
+        -------
+        membership: numpy.ndarray
+                    rows x terms
+        '''
+
+        categories, packed = self.bitsets(level)
+        n_rows = len(self.general().index)
+
+        positions = categories.get_indexer(terms) if len(terms) > 0 else np.array([], dtype=np.int64)
+        found = np.flatnonzero(positions >= 0)
+
+        membership = np.zeros((n_rows, len(terms)), dtype=bool)
+        membership[:, found] = np.unpackbits(packed[positions[found]], axis=1, count=n_rows).T.astype(bool)
+
+        return membership
+
+    def within(self, by):
+        def compute():
+            categories = drop_missing_terms(self.universe.groupby(by=by).size()).index
+            universe_within = prepare_within(self.universe, by)
+            return categories, universe_within, universe_within.groupby(by=by)['Normalized Name'].count()
+
+        return self.cached(('within', by), compute)
+
+    def within_counts(self, by, level):
+        def compute():
+            universe_within = self.within(by)[1]
+            return dict(list(universe_within.groupby(by=[by, level])['Normalized Name'].count().groupby(level=0)))
+
+        return self.cached(('within_counts', by, level), compute)
+
+    def within_cascade(self, by, level):
+        def compute():
+            universe_within = self.within(by)[1]
+            counts, rows = count_terms_cascade(universe_within, [by, level])
+            return counts, rows, universe_within.groupby(by=[by, level]).size()
+
+        return self.cached(('within_cascade', by, level), compute)
+
+    def bucket_rows(self):
+        # the same lipid found through two chains is counted once, as are the duplicate rows
+        return self.cached('bucket_rows', lambda: ~self.defined().duplicated().to_numpy() & self.defined()['Normalized Name'].notna().to_numpy())
+
+    def bucket_mask(self, filter, columns):
+        return self.cached(('bucket_mask', filter, tuple(columns)), lambda: acyl_bucket_masks(self.defined(), columns, filter) & self.bucket_rows())
+
+    def bucket_categories(self, level):
+        def compute():
+            defined = self.defined()
+            return drop_missing_terms(defined.groupby(by=level).size()).index, defined.groupby(by=level)['Normalized Name'].count()
+
+        return self.cached(('bucket_categories', level), compute)
+
+    def bucket_totals(self, filter, columns, level):
+        def compute():
+            defined = self.defined()
+            return pd.Series(self.bucket_mask(filter, columns), index=defined.index).groupby(defined[level]).sum()
+
+        return self.cached(('bucket_totals', filter, tuple(columns), level), compute)
+
+
+
+def get_universe_index(universe, fingerprint=None):
+
+    '''
+    Get the index of a reference table, cached by the content of the table
+
+    Param
+    -------
+    universe: DataFrame
+    fingerprint: string
+                 content hash of the table, e.g. the one of its session store handle; hashed here by default
+
+    Returns
+    -------
+    universe_index: UniverseIndex
+    '''
+
+    if fingerprint is None:
+        fingerprint = table_fingerprint(universe)
+
+    with UNIVERSE_INDEX_CACHE_LOCK:
+        if fingerprint in UNIVERSE_INDEX_CACHE:
+            UNIVERSE_INDEX_CACHE.move_to_end(fingerprint)
+            return UNIVERSE_INDEX_CACHE[fingerprint]
+
+        # the index outlives the request, keep it apart from the caller's frame
+        universe_index = UniverseIndex(universe.copy())
+        UNIVERSE_INDEX_CACHE[fingerprint] = universe_index
+        while len(UNIVERSE_INDEX_CACHE) > UNIVERSE_INDEX_CACHE_SIZE:
+            UNIVERSE_INDEX_CACHE.popitem(last=False)
+
+    return universe_index
+
+
+
+def general_blocks(levels, query, universe_index, filter_count):
+
+    '''
+    Count the terms of the general enrichment, the blocks are the ones calculate_enrichment_* tests: one for
+    every level, or for every level and round of the shorthand level cascade with 'Acyls'
+
+    Param
+    -------
+    levels: list
+            options: 'Lipid Maps Category', 'Lipid Maps Main Class', 'Acyls'
+    query: DataFrame
+    universe_index: UniverseIndex
+    filter_count: int
+
+    Returns
+    -------
+    blocks: list
+            dict for every block with the 'Term (Group)' label, the terms passing filter_count and their counts;
+            'Step' is the cascade step the terms of an 'Acyls' block are counted at
+    '''
+
+    query = query[query['Lipid Maps Category'] != UNDEFINED_CATEGORY]
+    query = query.replace('0:0', np.nan)
+
+    universe = universe_index.general()
+
+    universe_grandtotal = universe_index.grandtotal()
+    query_grandtotal = int(query['Normalized Name'].count())
+
+    blocks = []
+
+    if 'Acyls' not in levels:
+
+        for level in levels:
+
+            if level in universe.columns and level in query.columns:
+
+                counts = count_terms(query, universe_index, level)
+                level_name = get_level_name(level)
+
+                block = {'Term (Group)': level, 'Term (Classifier)': [], 'Level': [], 'Query': [], 'Universe': [],
+                         'Query Grandtotal': query_grandtotal, 'Universe Grandtotal': universe_grandtotal}
+
+                for category, query_total, universe_total in counts.itertuples():
+
+                    # columns without a shorthand level give no terms
+                    if query_total > filter_count and universe_total > filter_count and level_name is not None:
+                        block['Term (Classifier)'].append(category)
+                        block['Level'].append(level_name)
+                        block['Query'].append(query_total)
+                        block['Universe'].append(universe_total)
+
+                blocks.append(block)
+
+        return blocks
+
+    # counts of every level are computed once for the whole cascade
+    cascades = {}
+
+    # one round per cascade step, every level is counted and labelled at the step
+    for step in ACYL_LEVEL_OPTIONS:
+
+        for level in levels:
+
+            if level not in cascades:
+                universe_counts, universe_rows, universe_n_all = universe_index.cascade(level)
+                query_counts, query_rows = count_terms_cascade(query, level)
+                cascades[level] = (universe_counts, universe_rows, query_counts, query_rows, universe_n_all, query.groupby(by=level).size())
+
+            universe_counts, universe_rows, query_counts, query_rows, universe_n_all, query_n_all = cascades[level]
+
+            categories = universe_rows.index[universe_rows[step] > 0]
+            query_present = query_rows[step].reindex(categories, fill_value=0).to_numpy() > 0
+
+            terms = zip(categories,
+                        query_counts[step].reindex(categories, fill_value=0).where(query_present, 0).tolist(),
+                        universe_counts.loc[categories, step].tolist(),
+                        query_n_all.reindex(categories, fill_value=0).tolist(),
+                        universe_n_all.reindex(categories, fill_value=0).tolist())
+
+            block = {'Term (Group)': level, 'Term (Classifier)': [], 'Level': [], 'Query': [], 'Universe': [],
+                     'Query Grandtotal': query_grandtotal, 'Universe Grandtotal': universe_grandtotal, 'Query All': [], 'Universe All': [], 'Step': step}
+
+            for category, query_total, universe_total, query_total_all, universe_total_all in terms:
+                if query_total > filter_count and universe_total > filter_count:
+                    block['Term (Classifier)'].append(category)
+                    block['Level'].append(step)
+                    block['Query'].append(query_total)
+                    block['Universe'].append(universe_total)
+                    block['Query All'].append(query_total_all)
+                    block['Universe All'].append(universe_total_all)
+
+            blocks.append(block)
+
+    return blocks
+
+
+
+def within_subset_blocks(levels, subsets, query, universe, filter_count, universe_index=None):
+
+    '''
+    Count the terms of the subsets within every category of the levels in one grouped pass, the blocks are
+    the same as the ones of calculate_enrichment_* run on every category separately
+
+    Param
+    -------
+    levels: list
+            columns with the categories
+    subsets: list
+             columns with the terms, or 'Acyls' for the shorthand level cascade
+    query: DataFrame
+    universe: DataFrame
+    filter_count: int
+    universe_index: UniverseIndex
+                    index of the universe, built for this call by default
+
+    Returns
+    -------
+    blocks: list
+            dict for every (category, subset) with the 'Term (Group)' label, the terms and their counts;
+            the terms passing filter_count, in the order of the terms within the category
+    '''
+
+    if universe_index is None:
+        universe_index = UniverseIndex(universe)
+
+    blocks = []
+
+    for by in levels:
+
+        universe_categories, universe_within, universe_grandtotals = universe_index.within(by)
+        query_categories = query.groupby(by=by).size().index
+
+        query_within = prepare_within(query, by)
+
+        query_grandtotals = query_within.groupby(by=by)['Normalized Name'].count()
+
+        # categories missing from the query are compared with the universe group
+        fallback = ~universe_categories.isin(query_categories)
+
+        if 'Acyls' not in subsets:
+            counts = {}
+            for level in subsets:
+                if level in universe_within.columns:
+                    query_counts = query_within.groupby(by=[by, level])['Normalized Name'].count() if level in query_within.columns else None
+                    counts[level] = (universe_index.within_counts(by, level), query_counts)
+
+            for category, category_fallback in zip(universe_categories, fallback):
+                universe_grandtotal = int(universe_grandtotals.get(category, 0))
+                query_grandtotal = universe_grandtotal if category_fallback else int(query_grandtotals.get(category, 0))
+
+                for level in subsets:
+                    if level not in counts or (counts[level][1] is None and not category_fallback):
+                        continue
+
+                    universe_level_counts, query_counts = counts[level]
+                    level_name = get_level_name(level)
+
+                    if category not in universe_level_counts:
+                        terms, universe_totals, query_totals = [], [], []
+                    else:
+                        universe_terms = universe_level_counts[category]
+                        universe_terms = universe_terms[~universe_terms.index.get_level_values(1).isin(['nan', 'None'])]
+                        terms = universe_terms.index.get_level_values(1).tolist()
+                        universe_totals = universe_terms.tolist()
+                        query_totals = universe_totals if category_fallback else query_counts.reindex(universe_terms.index, fill_value=0).tolist()
+
+                    block = {'Term (Group)': str(level) + ' within ' + str(category), 'Term (Classifier)': [], 'Level': [], 'Query': [], 'Universe': [],
+                             'Query Grandtotal': query_grandtotal, 'Universe Grandtotal': universe_grandtotal}
+
+                    for term, query_total, universe_total in zip(terms, query_totals, universe_totals):
+                        if query_total > filter_count and universe_total > filter_count and level_name is not None:
+                            block['Term (Classifier)'].append(term)
+                            block['Level'].append(level_name)
+                            block['Query'].append(query_total)
+                            block['Universe'].append(universe_total)
+
+                    blocks.append(block)
+
+        else:
+            cascades = {}
+            for level in subsets:
+                universe_counts, universe_rows, universe_n_all = universe_index.within_cascade(by, level)
+                query_counts, query_rows = count_terms_cascade(query_within, [by, level])
+                query_n_all = query_within.groupby(by=[by, level]).size()
+                cascades[level] = (universe_counts, universe_rows, query_counts, query_rows, universe_n_all, query_n_all)
+
+            for category, category_fallback in zip(universe_categories, fallback):
+                universe_grandtotal = int(universe_grandtotals.get(category, 0))
+                query_grandtotal = universe_grandtotal if category_fallback else int(query_grandtotals.get(category, 0))
+
+                for step in ACYL_LEVEL_OPTIONS:
+
+                    for level in subsets:
+                        universe_counts, universe_rows, query_counts, query_rows, universe_n_all, query_n_all = cascades[level]
+
+                        block = {'Term (Group)': str(level) + ' within ' + str(category), 'Term (Classifier)': [], 'Level': [], 'Query': [], 'Universe': [],
+                                 'Query Grandtotal': query_grandtotal, 'Universe Grandtotal': universe_grandtotal, 'Query All': [], 'Universe All': []}
+
+                        if category in universe_rows.index.get_level_values(0):
+                            category_rows = universe_rows.xs(category, level=0, drop_level=False)
+                            index = category_rows.index[category_rows[step] > 0]
+                            universe_totals = universe_counts.loc[index, step].tolist()
+                            universe_totals_all = universe_n_all.reindex(index, fill_value=0).tolist()
+
+                            if category_fallback:
+                                query_totals, query_totals_all = universe_totals, universe_totals_all
+                            else:
+                                query_present = query_rows[step].reindex(index, fill_value=0).to_numpy() > 0
+                                query_totals = query_counts[step].reindex(index, fill_value=0).where(query_present, 0).tolist()
+                                query_totals_all = query_n_all.reindex(index, fill_value=0).tolist()
+
+                            terms = zip(index.get_level_values(1).tolist(), query_totals, universe_totals, query_totals_all, universe_totals_all)
+                        else:
+                            terms = []
+
+                        for term, query_total, universe_total, query_total_all, universe_total_all in terms:
+                            if query_total > filter_count and universe_total > filter_count:
+                                block['Term (Classifier)'].append(term)
+                                block['Level'].append(step)
+                                block['Query'].append(query_total)
+                                block['Universe'].append(universe_total)
+                                block['Query All'].append(query_total_all)
+                                block['Universe All'].append(universe_total_all)
+
+                        blocks.append(block)
+
+    return blocks
+
+
+
+ACYL_BUCKETS = {
+    'acyls containing less than 16 carbon atoms': ('CARBONS', lambda v: (v < 16) & (v != 0)),
+    'acyls containing 16-18 carbon atoms': ('CARBONS', lambda v: (v >= 16) & (v <= 18)),
+    'acyls containing more than 18 carbon atoms': ('CARBONS', lambda v: v > 18),
+    'acyls containing 0 double bonds (saturated)': ('DOUBLE BONDS', lambda v: v == 0),
+    'acyls containing 1 double bonds (monounsaturated)': ('DOUBLE BONDS', lambda v: v == 1),
+    'acyls containing 2 or more double bonds (polyunsaturated)': ('DOUBLE BONDS', lambda v: v >= 2),
+}
+
+ACYL_BUCKET_COLUMNS = {'CARBONS': r'FA\d #C', 'DOUBLE BONDS': r'FA\d #DB'}
+
+
+
+def acyl_bucket_masks(df, columns, filter):
+
+    '''
+    Rows of df with at least one acyl chain in the bucket of the filter
+
+    Param
+    -------
+    df: DataFrame
+    columns: list
+             'FAi #C' or 'FAi #DB' columns of the chains
+    filter: string
+            key of ACYL_BUCKETS
+
+    Returns
+    -------
+    mask: numpy.ndarray
+    '''
+
+    specific, condition = ACYL_BUCKETS[filter]
+    mask = np.zeros(len(df.index), dtype=bool)
+
+    for column in columns:
+        values = pd.to_numeric(df[column], errors='coerce').to_numpy(dtype=float, na_value=np.nan)
+        chain = condition(values)
+
+        if specific == 'DOUBLE BONDS':
+            # missing chains are filled with 0, a saturated chain needs its carbons
+            carbons = column.replace('#DB', '#C')
+            if carbons in df.columns:
+                carbon_values = pd.to_numeric(df[carbons], errors='coerce').to_numpy(dtype=float, na_value=np.nan)
+                chain &= ~np.isnan(carbon_values) & (carbon_values != 0)
+
+        mask |= chain
+
+    return mask
+
+
+
+def acyl_bucket_blocks(levels, query, universe, filters, filter_count, universe_index=None):
+
+    '''
+    Count the lipids with acyls in every bucket of the filters within every category of the levels, the
+    rows are scanned once and every bucket is a mask over them
+
+    Param
+    -------
+    levels: list
+            columns with the categories
+    query: DataFrame
+    universe: DataFrame
+    filters: list
+             keys of ACYL_BUCKETS
+    filter_count: int
+    universe_index: UniverseIndex
+                    index of the universe, built for this call by default
+
+    Returns
+    -------
+    blocks: list
+            dict for every (filter, level) with the categories passing filter_count, in the order of
+            the categories, and their grand totals
+    '''
+
+    if universe_index is None:
+        universe_index = UniverseIndex(universe)
+
+    query = query[query['Lipid Maps Category'] != UNDEFINED_CATEGORY]
+    universe = universe_index.defined()
+
+    # the same lipid found through two chains is counted once, as are the duplicate rows
+    query_rows = ~query.duplicated().to_numpy() & query['Normalized Name'].notna().to_numpy()
+
+    def chain_columns(df, filter):
+        matches = re.findall(ACYL_BUCKET_COLUMNS[ACYL_BUCKETS[filter][0]], ' '.join(map(str, df.columns)))
+        return [column for column in matches if column in universe.columns]
+
+    bucket_columns = {}
+    for filter in filters:
+        # the chains are looked up in the query, categories missing from the query fall back to the universe
+        bucket_columns[filter] = (chain_columns(query, filter), chain_columns(universe, filter))
+
+    blocks = []
+
+    for filter in filters:
+        query_columns, universe_columns = bucket_columns[filter]
+        query_bucket = acyl_bucket_masks(query, query_columns, filter) & query_rows
+
+        for level in levels:
+            universe_categories, universe_grandtotals = universe_index.bucket_categories(level)
+            query_categories = query.groupby(by=level).size().index
+            fallback = ~universe_categories.isin(query_categories)
+
+            query_grandtotals = query.groupby(by=level)['Normalized Name'].count()
+
+            universe_totals = universe_index.bucket_totals(filter, query_columns, level)
+            fallback_totals = universe_index.bucket_totals(filter, universe_columns, level)
+            query_totals = pd.Series(query_bucket, index=query.index).groupby(query[level]).sum()
+
+            block = {'Term (Group)': [], 'Term (Classifier)': [], 'Level': [], 'Query': [], 'Universe': [],
+                     'Query Grandtotal': [], 'Universe Grandtotal': []}
+
+            for category, category_fallback in zip(universe_categories, fallback):
+                universe_grandtotal = int(universe_grandtotals.get(category, 0))
+                universe_total = int(universe_totals.get(category, 0))
+
+                if category_fallback:
+                    query_grandtotal = universe_grandtotal
+                    universe_total = query_total = int(fallback_totals.get(category, 0))
+                else:
+                    query_grandtotal = int(query_grandtotals.get(category, 0))
+                    query_total = int(query_totals.get(category, 0))
+
+                if query_total > filter_count and universe_total > filter_count:
+                    abbr_match = re.search(r'(?<=\[).*?(?=\])', category)
+                    abbr = abbr_match.group() if abbr_match else category
+
+                    block['Term (Group)'].append(category)
+                    block['Term (Classifier)'].append('[' + abbr + ']' + ' with ' + filter)
+                    block['Level'].append('MOLECULAR_SPECIES')
+                    block['Query'].append(query_total)
+                    block['Universe'].append(universe_total)
+                    block['Query Grandtotal'].append(query_grandtotal)
+                    block['Universe Grandtotal'].append(universe_grandtotal)
+
+            blocks.append(block)
+
+    return blocks
+
+
+
+def per_row(value, rows):
+    # block values are either shared by the block or given for every term
+    return [value[r] for r in rows] if isinstance(value, list) else [value] * len(rows)
+
+
+
+def terms_table(blocks, p_values, statistical_method, alpha_level, odds_ratios=None, odds_ratio_text=True, dropna=True):
+
+    '''
+    Assemble the result table of term blocks, every block is sorted and corrected for multiple testing on its
+    own like a separate call of calculate_enrichment_*
+
+    Param
+    -------
+    blocks: list
+            returned by general_blocks, within_subset_blocks or acyl_bucket_blocks
+    p_values: list
+              numpy.ndarray of p-values for every block
+    statistical_method: string
+    alpha_level: float
+    odds_ratios: list
+                 numpy.ndarray of odds ratios for every block, none for the hypergeometric test
+    odds_ratio_text: bool
+                     odds ratios written as text instead of numbers
+    dropna: bool
+            drop terms without p-value or with a False classifier
+
+    Returns
+    -------
+    df_final: DataFrame
+    '''
+
+    from utils.hypothesis_correction import multiple_test_correction
+
+    acyls = len(blocks) > 0 and 'Query All' in blocks[0]
+
+    columns = ['Term (Group)', 'Term (Classifier)', 'Level', 'No Query', 'No Reference', 'p-value']
+    if odds_ratios is not None:
+        columns.append('Odds Ratio')
+    if acyls:
+        columns += ['Missing Query', 'Missing Reference', 'Missing Query Val', 'Missing Reference Val']
+    columns += ['FDR', 'Hypothesis Correction Result']
+
+    if len(blocks) == 0:
+        return pd.DataFrame()
+
+    table = {column: [] for column in columns}
+
+    for i, block in enumerate(blocks):
+        p_value = np.asarray(p_values[i], dtype=float)
+
+        if dropna:
+            keep = ~np.isnan(p_value) & np.array([term != False for term in block['Term (Classifier)']], dtype=bool)
+        else:
+            keep = np.ones(len(p_value), dtype=bool)
+
+        # same order as sort_values: quicksort of the p-values, missing ones last
+        rows = np.flatnonzero(keep & ~np.isnan(p_value))
+        rows = np.concatenate([rows[np.argsort(p_value[rows], kind='quicksort')], np.flatnonzero(keep & np.isnan(p_value))]).astype(np.int64)
+
+        if len(rows) == 0:
+            continue
+
+        p_sorted = p_value[rows]
+        n = len(rows)
+
+        table['Term (Group)'] += per_row(block['Term (Group)'], rows)
+        table['Term (Classifier)'] += [block['Term (Classifier)'][r] for r in rows]
+        table['Level'] += [block['Level'][r] for r in rows]
+        table['No Query'] += [str(block['Query'][r]) + '/' + str(total) for r, total in zip(rows, per_row(block['Query Grandtotal'], rows))]
+        table['No Reference'] += [str(block['Universe'][r]) + '/' + str(total) for r, total in zip(rows, per_row(block['Universe Grandtotal'], rows))]
+        table['p-value'] += p_sorted.tolist()
+
+        if odds_ratios is not None:
+            if odds_ratio_text:
+                table['Odds Ratio'] += [str(round(oddsr, 4)) for oddsr in np.asarray(odds_ratios[i])[rows]]
+            else:
+                table['Odds Ratio'] += [round(oddsr, 4) for oddsr in np.asarray(odds_ratios[i])[rows]]
+
+        if acyls:
+            for r in rows:
+                query_total, universe_total = block['Query'][r], block['Universe'][r]
+                query_total_all, universe_total_all = block['Query All'][r], block['Universe All'][r]
+                table['Missing Query'].append(str(query_total) + '/' + str(query_total_all))
+                table['Missing Reference'].append(str(universe_total) + '/' + str(universe_total_all))
+                table['Missing Query Val'].append(str(query_total != query_total_all))
+                table['Missing Reference Val'].append(str(universe_total != universe_total_all))
+
+        # adjusted p-values and rejections come from one pass over the sorted p-values, single terms are not corrected
+        if n > 1:
+            pvals_corrected, reject = multiple_test_correction(p_sorted, statistical_method, alpha_level)
+            table['FDR'] += [round(x, 4) for x in pvals_corrected.tolist()]
+            table['Hypothesis Correction Result'] += reject.tolist()
+        else:
+            table['FDR'] += ['N.D.'] * n
+            table['Hypothesis Correction Result'] += [False] * n
+
+    df_final = pd.DataFrame(table, columns=columns)
+
+    if odds_ratios is not None:
+        df_final['Odds Ratio'] = df_final['Odds Ratio'].apply(lambda x: 'N.D.' if (x=='nan') else x)
+
+    return df_final
@@ -1,154 +1,306 @@
-import plotly.express as px
-import pandas as pd
-
 import plotly.graph_objects as go
 import pandas as pd
-import itertools
 import numpy as np
 from plotly.subplots import make_subplots
 import plotly.express as px
+from collections import OrderedDict
+import threading
 
 import textwrap
 
-def dict_intersect_multi(dict_inter, dict_exter):
-    common_items =  dict_inter[0].items()
-    for d in dict_inter[1:]:
-        common_items &= d.items()
-    for et in dict_exter[0:]:
-        common_items -= et.items()
-    return common_items
-
-def upset_filter_df(df, filter_values):
-    """Filter df by matching targets for multiple columns.
-
-    Args:
-        df (pd.DataFrame): dataframe
-        filter_values (None or dict): Dictionary of the form:
-                `{<field>: <target_values_list>}`
-            used to filter columns data.
-    """
-    import numpy as np
-    if filter_values is None or not filter_values:
-        return df
-    return df[
-        np.logical_and.reduce([
-            df[column].isin(target_values) 
-            for column, target_values in filter_values.items()
-        ])
-    ]
-
-def plotly_upset_plot_pivot(df, limit):
-    df_with_names = df.copy(deep=True)  
-    df = df.drop(['Names'], axis=1)
-    df = (df <= limit) * 1
-
-    df_minima = df.min().sort_values(ascending = True)
-    min_list = df_minima.index.to_list()
-    if len(min_list) > 13:
-        df = df[min_list[:13]]
+from utils.session_store import table_fingerprint
+
+# number of terms plotted, the most significant ones
+UPSET_MAX_TERMS = 13
+
+# up to this many terms the intersection sizes are counted with one bincount over all masks
+UPSET_BINCOUNT_BITS = 20
+
+# intersections on one page of the top-k mode
+UPSET_TOP_K = 20
+
+# rows on one page of the table of a clicked intersection
+UPSET_TABLE_PAGE_SIZE = 20
+
+# order of the intersections in the top-k mode, 'size': largest first, 'p-value': the weakest term most significant first
+UPSET_RANKS = ['size', 'p-value']
+
+# intersections and pivots of recent upset tables, a new page or mode of the same table reuses them
+UPSET_CACHE = OrderedDict()
+UPSET_CACHE_SIZE = 16
+UPSET_CACHE_LOCK = threading.Lock()
+
+
+
+def upset_cache(key, compute):
+
+    '''
+    Memoise a result of the upset plot on a key built from the content fingerprint of its table
+
+    Param
+    -------
+    key: tuple
+    compute: function
+             called without arguments on a miss
+
+    Returns
+    -------
+    result: the cached object, shared by all callers
+    '''
+
+    with UPSET_CACHE_LOCK:
+        if key in UPSET_CACHE:
+            UPSET_CACHE.move_to_end(key)
+            return UPSET_CACHE[key]
+
+    result = compute()
+
+    with UPSET_CACHE_LOCK:
+        UPSET_CACHE[key] = result
+        while len(UPSET_CACHE) > UPSET_CACHE_SIZE:
+            UPSET_CACHE.popitem(last=False)
+
+    return result
+
+
+def exclusive_intersections(df):
+
+    '''
+    Exclusive intersection sizes of the terms, the terms of every row are encoded as the bits of one
+    integer mask and the rows are counted per mask
+
+    Param
+    -------
+    df: DataFrame
+        rows x terms, 1 for the terms the row belongs to
+
+    Returns
+    -------
+    row_subset: numpy.ndarray
+                position of the row's intersection in subsets, -1 for the rows without any term
+    subsets: list
+             term combinations with at least one row, ordered by the number of terms and then as
+             itertools.combinations enumerates them
+    subset_sizes: list
+                  number of rows with exactly the terms of the combination
+    '''
+
+    d = len(df.columns)
+    membership = df.to_numpy() >= 1
+
+    if d <= UPSET_BINCOUNT_BITS:
+        masks = membership.astype(np.int64) @ (np.int64(1) << np.arange(d, dtype=np.int64))
+        counts = np.bincount(masks, minlength=2)
+        nonempty = np.flatnonzero(counts[1:]) + 1
+        sizes = counts[nonempty]
+        members = [[j for j in range(d) if mask >> j & 1] for mask in nonempty.tolist()]
+        pattern = np.full(len(counts), -1)
+        pattern[nonempty] = np.arange(len(nonempty))
+        row_pattern = pattern[masks]
     else:
-        pass  
-    
-    df_header_list = list(df.columns.values)
-    dict_of_dict = {}
-    for name in df_header_list:
-        temp_dict = df[name].to_dict()
-        temp_filtered = {key : val for key, val in temp_dict.items() if val >= 1}
-        dict_of_dict[name] = temp_filtered
-
-    subsets = []
-    d = len(df_header_list)
-    for i in range(1, d + 1):
-        subsets = subsets + [list(x) for x in list(itertools.combinations(df_header_list, i))]
-    subset_sizes = []
-
-    for s in subsets:
-        inter = []
-        for term in s:
-            inter.append(dict_of_dict[term])
-        exter = []
-        others_list = [ele for ele in df_header_list if ele not in s]
-        for term in others_list:
-            exter.append(dict_of_dict[term])
-
-        tmp = dict_intersect_multi(inter, exter)
-
-        subset_sizes.append(len(tmp))
+        # more terms than bincount bins, the bit-packed masks of the rows are counted with unique instead
+        patterns, row_pattern, sizes = np.unique(np.packbits(membership, axis=1), axis=0, return_inverse=True, return_counts=True)
+        members = [np.flatnonzero(bits).tolist() for bits in np.unpackbits(patterns, axis=1, count=d)]
+        if len(members) > 0 and len(members[0]) == 0:
+            row_pattern = row_pattern - 1
+            members, sizes = members[1:], sizes[1:]
+
+    # only the combinations that occur are materialised
+    order = sorted(range(len(members)), key=lambda i: (len(members[i]), members[i]))
+    position = np.empty(len(order) + 1, dtype=np.int64)
+    position[order] = np.arange(len(order))
+    position[-1] = -1
+
+    subsets = [[df.columns[j] for j in members[i]] for i in order]
+    subset_sizes = [int(sizes[i]) for i in order]
+
+    return position[row_pattern], subsets, subset_sizes
+
+
+
+def term_intersections(df, limit, max_terms=None, fingerprint=None):
+
+    '''
+    Terms of every lipid at the p-value limit and their exclusive intersections, memoised on the content of df
+
+    Param
+    -------
+    df: DataFrame
+        table for the upset plot, returned by table_for_upset
+    limit: float
+           largest significant p-value
+    max_terms: int
+               only the most significant terms are kept, none for all terms
+    fingerprint: string
+                 table_fingerprint of df if already known
+
+    Returns
+    -------
+    membership: DataFrame
+                rows x terms, 1 for the terms the row belongs to
+    term_p_values: Series
+                   p-value of every term
+    row_subset, subsets, subset_sizes: returned by exclusive_intersections for membership
+    '''
+
+    def compute():
+        terms = df.drop(['Names'], axis=1)
+        term_p_values = terms.min()
+        membership = (terms <= limit) * 1
+
+        min_list = membership.min().sort_values(ascending = True).index.to_list()
+        if max_terms is not None and len(min_list) > max_terms:
+            membership = membership[min_list[:max_terms]]
+
+        return (membership, term_p_values) + exclusive_intersections(membership)
+
+    key = ('intersections', fingerprint or table_fingerprint(df), float(limit), max_terms)
+
+    return upset_cache(key, compute)
+
+def top_intersections(subsets, subset_sizes, term_p_values, top_k, page=0, rank='size'):
+
+    '''
+    One page of the exclusive intersections of at least two terms, ranked by size or significance
+
+    Param
+    -------
+    subsets: list
+    subset_sizes: list
+                  returned by exclusive_intersections
+    term_p_values: Series
+                   p-value of every term
+    top_k: int
+           intersections on one page
+    page: int
+          first page is 0
+    rank: string
+          options: UPSET_RANKS
+
+    Returns
+    -------
+    selected: list
+              positions in subsets of the intersections on the page
+    '''
+
+    if rank not in UPSET_RANKS:
+        raise ValueError('Unknown rank ' + str(rank) + ', options: ' + ', '.join(UPSET_RANKS) + '.')
+
+    candidates = [i for i, s in enumerate(subsets) if len(s) > 1]
+
+    if rank == 'size':
+        candidates.sort(key=lambda i: -subset_sizes[i])
+    else:
+        weakest = [term_p_values[subsets[i]].max() for i in candidates]
+        candidates = [i for _, i in sorted(zip(weakest, candidates), key=lambda x: (x[0], -subset_sizes[x[1]]))]
+
+    return candidates[page*top_k:(page+1)*top_k]
+
+def upset_page_count(df, limit, top_k):
+
+    '''
+    Number of pages of the top-k mode
+
+    Param
+    -------
+    df: DataFrame
+        table for the upset plot, returned by table_for_upset
+    limit: float
+           largest significant p-value
+    top_k: int
+           intersections on one page
+
+    Returns
+    -------
+    pages: int
+           0 if no lipid is in more than one term
+    '''
+
+    membership, term_p_values, row_subset, subsets, subset_sizes = term_intersections(df, limit)
+
+    return -(-sum(len(s) > 1 for s in subsets) // top_k)
+
+def plotly_upset_plot_pivot(df, limit, top_k=None, page=0, rank='size'):
+
+    # the pivot of a table is computed once for every mode and page, callers get copies of the frames
+    fingerprint = table_fingerprint(df)
+    df, plot_df, subsets, dict_of_tables, VIL = upset_cache(('pivot', fingerprint, float(limit), top_k, page, rank),
+                                                            lambda: upset_pivot(df, limit, top_k, page, rank, fingerprint))
+
+    return df.copy(), plot_df.copy(), list(subsets), dict_of_tables, VIL
+
+def upset_pivot(df, limit, top_k, page, rank, fingerprint):
+    df_with_names = df
+    df, term_p_values, row_subset, subsets, subset_sizes = term_intersections(df, limit, None if top_k is not None else UPSET_MAX_TERMS, fingerprint)
+    all_terms = list(df.columns)
+    selected = list(range(len(subsets)))
+
+    if top_k is not None:
+        # top-k mode: a page of intersections among all terms, only the terms of its intersections are plotted
+        selected = top_intersections(subsets, subset_sizes, term_p_values, top_k, page, rank)
+        subsets = [subsets[i] for i in selected]
+        subset_sizes = [subset_sizes[i] for i in selected]
+        df = df[[term for term in all_terms if any(term in s for s in subsets)]]
                    
-    plot_df = pd.DataFrame({'Intersection': subsets, 'Size':subset_sizes,'Counts':'1','Values':subsets})  ### delete lipids
-   
-    for index, row in plot_df.iterrows():
-        temp_row = row['Intersection']
-        plot_df.at[index,'Counts'] = len(temp_row)
+    plot_df = pd.DataFrame({'Intersection': subsets, 'Size':subset_sizes,'Counts':[len(x) for x in subsets],'Values':subsets}, index=selected)  ### delete lipids
 
     plot_df = plot_df.sort_values(['Counts','Size'], ascending = [True,True])
-    plot_df.reset_index(drop=True, inplace=True)
 
     plot_df = plot_df[(plot_df['Size']>0) & (plot_df['Counts']>1)]      
+    bar_subsets = plot_df.index.to_list()
     plot_df.reset_index(drop=True, inplace=True)
     max_y = max(plot_df['Size'])+0.1*max(plot_df['Size'])
 
     ## GENERATE TABLES for intersections > 1 and counts > 0
-    selected_overlap = plot_df[(plot_df['Counts']>1) & (plot_df['Size']>0)].sort_values(by = 'Counts', ascending = False)
-    selected_overlap = plot_df.copy(deep=True)
-    selected_overlap = selected_overlap['Intersection']
-    
-    for index, row in plot_df.iterrows():
-        plot_df.at[index,'Bar'] = 'Bar'+str(index) 
-    
+    # the lipids of a bar are the rows with exactly its terms, assigned once for all bars by exclusive_intersections
+    plot_df['Bar'] = ['Bar'+str(index) for index in plot_df.index]
+
+    bar_rows = pd.Series(np.arange(len(row_subset))).groupby(row_subset).indices
+    term_columns = {term: j for j, term in enumerate(all_terms)}
+    p_values = df_with_names[all_terms].to_numpy()
+    names = df_with_names['Names'].to_numpy(dtype=object)
+    table_names = df_with_names['Names'].str.replace(r'\(.*\)$', '', regex=True).to_numpy(dtype=object)
+    labels = df_with_names.index.to_list()
+
     dict_of_tables = {}
-    dict_of_table_keys = plot_df['Bar']
-    
-    for index, list_in_row in selected_overlap.items():
-        search_list = list(list_in_row)
-        full_list = list(df.columns) 
-        temp_s = set(search_list)
-        difference = [x for x in full_list if x not in temp_s]
-        temp_df = df_with_names
-        
-        float_columns_search = [c for c in temp_df.columns.intersection(search_list) if pd.api.types.is_float_dtype(temp_df[c].dtype)]
-        float_columns_difference = [c for c in temp_df.columns.intersection(difference) if pd.api.types.is_float_dtype(temp_df[c].dtype)]
-
-        mask_search = (temp_df[float_columns_search] <= limit).all(axis=1)
-        mask_difference = (temp_df[float_columns_difference] >= limit).all(axis=1)
-
-        final_df = temp_df[mask_search & mask_difference]
-
-        temp_melted = final_df.melt(id_vars=['Names'], value_vars=list(list_in_row))
-        if(final_df.empty):
-            plot_df.at[index, 'Values']= []
-        else:
-            plot_df.at[index, 'Values']= list(temp_melted['value'])
-            search_list.insert(0, "Names")
-            table_df=final_df[search_list] 
-            table_df = table_df.applymap(lambda x: np.nan if x == 1.0000 else x)
-            table_df.dropna(inplace=True)
-
-            table_df = table_df.drop_duplicates(subset='Names', keep='first')
-            table_df['Names'] = table_df['Names'].str.replace(r'\(.*\)$', '', regex=True)
-
-            temp_key = 'Bar'+str(index)
-            dict_of_tables[temp_key] = table_df.to_dict()
+    values = []
+
+    for index, (subset, list_in_row) in enumerate(zip(bar_subsets, plot_df['Intersection'])):
+        rows = bar_rows[subset]
+        columns = [term_columns[term] for term in list_in_row]
+        bar_values = p_values[np.ix_(rows, columns)]
+
+        values.append(bar_values.T.ravel().tolist())
+
+        # rows with a p-value of 1 are left out of the table, and every lipid is listed once
+        rows = rows[~(bar_values == 1.0).any(axis=1)]
+        first = {}
+        for row in rows.tolist():
+            first.setdefault(names[row], row)
+        rows = list(first.values())
+
+        table = {'Names': {labels[row]: table_names[row] for row in rows}}
+        for term, column in zip(list_in_row, columns):
+            table[term] = dict(zip([labels[row] for row in rows], p_values[rows, column].tolist()))
+
+        dict_of_tables['Bar'+str(index)] = table
+
+    plot_df['Values'] = pd.Series(values, index=plot_df.index, dtype=object)
 
     VIL = dict_of_tables['Bar'+str(len(dict_of_tables)-1)]
-    
-    for index, row in plot_df.iterrows():
-        temp_row = row['Values']
-        plot_df.at[index,'Counts_pval'] = len(temp_row) 
-    
+
+    plot_df['Counts_pval'] = [float(len(x)) for x in values]
+
     return df, plot_df, subsets, dict_of_tables, VIL
 
 def plotly_upset_figure(plot_df, original_df, subsets, limit):
-    plot_df = plot_df
     df = original_df
 
-    subsets = subsets
-    limit = limit
     max_y = max(plot_df['Size'])+0.1*max(plot_df['Size'])
     d = len(df.columns)
 
     ## DEFINE FIG PARAMETERS
-    base = (d*(-3.5))+160
+    base = max((d*(-3.5))+160, 30)
     part = base/(d*base)
     height_row_1 = part
     height_row_2 = 1-(2*part)
@@ -163,11 +315,12 @@ def plotly_upset_figure(plot_df, original_df, subsets, limit):
         horizontal_spacing=0.01,
         vertical_spacing=0.01,
         subplot_titles=('','','','','','','','',''),
-        print_grid=True,
+        print_grid=False,
         )   
 
     ## GLOBAL PLOT OPTIONS 
-    dot_size = {2:14,3:13,4:12,5:11,6:10,7:10,8:10,9:10,10:10,11:10,12:10,13:10,14:10,15:10}
+    # 14 for two terms down to 10 from six terms on, smaller for more than 15 terms
+    dot_size = max(16 - d, 10) if d <= 15 else max(4, 150 // d)
     subsets = list(plot_df['Intersection'])
     n_colors = len(subsets)
     colors = px.colors.sample_colorscale("turbo", [n/(n_colors) for n in range(n_colors)])  
@@ -177,9 +330,7 @@ def plotly_upset_figure(plot_df, original_df, subsets, limit):
         itemstring = '<br>'.join([str(elem) for elem in item])        
         intersections_wrap.append(itemstring)     
     template =  [f'<extra><br><b>{lab}</b><br><b>Cardinality count</b>: {n}</extra>' for  lab, n in zip(intersections_wrap, plot_df['Size'])]
-    dot_template = [f'<extra><br>{lab}<br><b>Intersections</b>: {n}</extra>' for  lab, n in zip(intersections_wrap, plot_df['Counts'])]
-    pval_template = [f'<extra><br>{lab}</extra>' for  lab in intersections_wrap]
-    subsets = list(plot_df['Intersection'])
+    bars = plot_df['Bar'].tolist()
 
     ## WHITE DOTPLOT row=2 col=1   
     scatter_x = []
@@ -188,29 +339,36 @@ def plotly_upset_figure(plot_df, original_df, subsets, limit):
         for j in range(d):
             scatter_x.append(i)
             scatter_y.append(-j*max_y/d-0.1*max_y)   
-    fig.add_trace(go.Scatter(x = scatter_y, y = scatter_x, mode = 'markers', hoverinfo='none', showlegend=False, marker=dict(size=dot_size[d],color='#C9C9C9')), row=2, col=1)
+    fig.add_trace(go.Scattergl(x = scatter_y, y = scatter_x, mode = 'markers', hoverinfo='none', showlegend=False, marker=dict(size=dot_size,color='#C9C9C9')), row=2, col=1)
     fig.update_yaxes(showticklabels=False, title='Terms combination matrix', showgrid=True, gridcolor='white', tick0=0, dtick=100, range=[scatter_x[0]-1,scatter_x[-1]+1], row=2, col=1)
     fig.update_xaxes(visible=False, showticklabels=False, showgrid=True, row=2, col=1)
 
-    ## BLACK DOTPLOT row=2 col=1
-    for i, s in enumerate(subsets):
-        scatter_x_has = []
-        scatter_y_has = []
-        for j in range(d):
-            if df.columns[j] in s:
-                scatter_x_has.append(i)
-                scatter_y_has.append(-j*max_y/d-0.1*max_y)
-                fig.add_trace(go.Scatter(x = scatter_y_has, y = scatter_x_has, mode = 'markers+lines', showlegend=False, hovertemplate=dot_template[i], marker=dict(size=dot_size[d],color='#000000',showscale=False)), row=2, col=1)
+    ## BLACK DOTPLOT row=2 col=1, the dots and lines of all intersections in one trace, intersections separated by None
+    ## a dot is labelled with its own term, the whole intersection is on the cardinality bar of the row
+    dots_x, dots_y, dots_text, dots_bar = [], [], [], []
+    for i, (s, n) in enumerate(zip(subsets, plot_df['Counts'])):
+        has = [j for j in range(d) if df.columns[j] in s]
+        dots_x += [-j*max_y/d-0.1*max_y for j in has] + [None]
+        dots_y += [i]*len(has) + [None]
+        dots_text += [f'<br>{df.columns[j]}<br><b>Intersections</b>: {n}' for j in has] + [None]
+        dots_bar += [bars[i]]*len(has) + [None]
+    fig.add_trace(go.Scattergl(x = dots_x, y = dots_y, mode = 'markers+lines', showlegend=False, text=dots_text, customdata=dots_bar, hovertemplate='<extra>%{text}</extra>', marker=dict(size=dot_size,color='#000000'), line=dict(color='#000000')), row=2, col=1)
     
     ## STAT PLOT scatter graph row=2, col=3
-    fig.add_trace(go.Scatter(x=scatter_x, y=[0.1]*len(scatter_x), mode = 'markers', showlegend=False, marker=dict(size=12,color='rgba(0, 0, 0, 0.0)')), row=2, col=3)   ## add transparent WHITE DOT plot to align X axes
-    for i,s in enumerate(subsets):
-        fig_stat=go.Scatter(x=plot_df['Values'][i], y=[i]*len(plot_df['Values'][i]), mode='markers', marker=dict(size=4, symbol='diamond', color=colors[i]), hovertemplate=pval_template[i], showlegend=False,)        
-        fig.add_trace(fig_stat, row=2, col=3)
+    fig.add_trace(go.Scattergl(x=scatter_x, y=[0.1]*len(scatter_x), mode = 'markers', showlegend=False, marker=dict(size=12,color='rgba(0, 0, 0, 0.0)')), row=2, col=3)   ## add transparent WHITE DOT plot to align X axes
+    ## p-values of all intersections in one trace, coloured per point; the lipids of a term share its p-value, one marker per distinct value
+    pval_x, pval_y, pval_colors, pval_bar = [], [], [], []
+    for i, s in enumerate(subsets):
+        values = list(dict.fromkeys(plot_df['Values'][i]))
+        pval_x += values
+        pval_y += [i]*len(values)
+        pval_colors += [colors[i]]*len(values)
+        pval_bar += [bars[i]]*len(values)
+    fig.add_trace(go.Scattergl(x=pval_x, y=pval_y, mode='markers', marker=dict(size=4, symbol='diamond', color=pval_colors), customdata=pval_bar, hovertemplate='<extra><br><em>p</em>-value: %{x}</extra>', showlegend=False), row=2, col=3)
     fig.update_yaxes(showticklabels=False, gridcolor='white', tick0=0, dtick=1, showline=True, linewidth=1, linecolor='#696969', ticks="outside", tickwidth=0.5, tickcolor='#696969', ticklen=2, range=[scatter_x[0]-1,scatter_x[-1]+1], row=2, col=3)
     fig.update_xaxes(title='<em>p</em>-values within<br>term intersections', range=[-0.001,limit*1.1], ticks="outside", showline=True, linewidth=1, linecolor='#696969', title_font_size=font_size*0.8, row=2, col=3)    
-    ## STAT PLOT ADD SECONDARY TOP X AXIS
-    fig.data[1].update(xaxis='x3')
+    ## STAT PLOT ADD SECONDARY TOP X AXIS, drawn once an invisible point is placed on it
+    fig.add_trace(go.Scatter(x=[0], y=[0], xaxis='x3', yaxis='y4', mode='markers', marker=dict(opacity=0), hoverinfo='skip', showlegend=False))
     fig.update_layout(xaxis3=dict(range=[-0.001,limit*1.1], side="top", position=height_row_2+height_row_3, tick0=0))
     fig.update_xaxes(title='<em>p</em>-values within<br>term intersections', range=[-0.001,limit*1.1], ticks="inside", showline=True, linewidth=1, linecolor='#696969', title_font_size=font_size*0.8, row=1, col=3)    
 
@@ -221,7 +379,7 @@ def plotly_upset_figure(plot_df, original_df, subsets, limit):
     fig.update_yaxes(showticklabels=False, gridcolor='white', tick0=0, dtick=1, showline=True, linewidth=1, linecolor='#696969', ticks="outside", tickwidth=0.5, tickcolor='#696969', range=[scatter_x[0]-1,scatter_x[-1]+1], ticklen=2, row=2, col=2)
     fig.update_xaxes(title='Cardinality [n]<br>term intersection size', gridcolor='white', range=[0,max_y], ticks="outside", showline=True, linewidth=1, linecolor='#696969', title_font_size=font_size*0.8, row=2, col=2)
     ## CARDINALITY ADD SECONDARY TOP X AXIS
-    fig.data[3].update(xaxis='x2')
+    fig.add_trace(go.Scatter(x=[0], y=[0], xaxis='x2', yaxis='y4', mode='markers', marker=dict(opacity=0), hoverinfo='skip', showlegend=False))
     fig.update_layout(xaxis2=dict(range=[0,max_y], side="top", position=height_row_2+height_row_3, tick0=0))       
     fig.update_xaxes(title='Cardinality [n]<br>term intersection size', gridcolor='white', range=[0,max_y], ticks="inside", showline=True, linewidth=1, linecolor='#696969', title_font_size=font_size*0.8, row=1, col=2)
 
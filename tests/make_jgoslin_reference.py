@@ -0,0 +1,40 @@
+'''
+Write the jgoslin-cli output for the names of the bundled demo files to tests/data/jgoslin, the
+reference test_parser_backends.py compares the pygoslin backend against without java
+
+Run from the repository root with java installed and the jgoslin-cli jar in src/assets:
+
+    python tests/make_jgoslin_reference.py
+
+Re-run it and commit the files when the jar is updated.
+'''
+
+import os
+import subprocess
+import tempfile
+
+from conftest import SRC_PATH
+from test_parser_backends import DEMO_FILES, REFERENCE_PATH, demo_names, reference_file
+from utils.convert_batch import get_java_cli, jgoslin_command
+
+
+
+if __name__ == '__main__':
+
+    java_cli = get_java_cli(os.path.join(SRC_PATH, 'assets'))
+    os.makedirs(REFERENCE_PATH, exist_ok=True)
+
+    with tempfile.TemporaryDirectory() as path:
+        for filename in DEMO_FILES:
+            input_file = os.path.join(path, 'names.txt')
+            with open(input_file, 'w', encoding='utf-8') as f:
+                f.write('\n'.join(demo_names(filename)) + '\n')
+
+            output = subprocess.run(jgoslin_command(java_cli, 'LIPID', input_file), stdout=subprocess.PIPE, check=True).stdout
+            with open(reference_file(filename), 'wb') as f:
+                f.write(output)
+
+            print(f'{filename}: {len(output.splitlines()) - 1} rows')
+
+    with open(os.path.join(REFERENCE_PATH, 'VERSION'), 'w', encoding='utf-8') as f:
+        f.write(os.path.basename(java_cli) + '\n')
@@ -0,0 +1,53 @@
+import pandas as pd
+import pytest
+
+import utils.convert_batch as convert_batch
+from utils.convert_batch import PygoslinBackend, UNMATCHED_NAME_MESSAGE, convert_tables
+from utils.parse_cache import ParseCache
+
+
+NAMES = ['PC 16:0/18:1', 'PE 18:0/20:4', 'Cer 18:1;O2/16:0', 'TG 16:0_18:1_18:2']
+
+
+
+class DroppingBackend(PygoslinBackend):
+
+    '''
+    pygoslin backend that returns no row for one name, as jgoslin-cli can when its output rows do not
+    match the input lines
+    '''
+
+    name = 'dropping'
+
+    def __init__(self, dropped):
+        super().__init__()
+        self.dropped = dropped
+
+    def parse(self, names, grammar, path, progress=None):
+        table = super().parse(names, grammar, path, progress)
+        return table[table.index != self.dropped]
+
+
+@pytest.fixture
+def backend(monkeypatch, tmp_path):
+    backend = DroppingBackend(NAMES[1])
+    monkeypatch.setattr(convert_batch, '_parser_backend', backend)
+    monkeypatch.setattr(convert_batch, '_parse_cache', ParseCache(str(tmp_path)))
+    return backend
+
+
+
+def test_one_row_per_input_name(backend, tmp_path):
+    query, universe = convert_tables([pd.Series(NAMES[:2]), pd.Series(NAMES)], 'LIPID', str(tmp_path))
+
+    assert query['Original Name'].tolist() == NAMES[:2]
+    assert universe['Original Name'].tolist() == NAMES
+
+
+def test_unmatched_name_is_not_parsed(backend, tmp_path):
+    table, = convert_tables([pd.Series(NAMES)], 'LIPID', str(tmp_path))
+    unmatched = table[table['Original Name'] == NAMES[1]].iloc[0]
+
+    assert unmatched['Message'] == UNMATCHED_NAME_MESSAGE
+    assert unmatched.isna()['Normalized Name']
+    assert table['Normalized Name'].notna().sum() == len(NAMES) - 1
@@ -0,0 +1,22 @@
+import importlib.util
+import os
+
+import pytest
+
+
+# the previous row-wise implementation and the synthetic names live next to the benchmark
+BENCHMARK_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks', 'bench_name_cleaning.py')
+
+spec = importlib.util.spec_from_file_location('bench_name_cleaning', BENCHMARK_PATH)
+bench_name_cleaning = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(bench_name_cleaning)
+
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_same_output_as_row_wise(seed):
+    bench_name_cleaning.check_equivalence(bench_name_cleaning.synthetic_names(5000, seed))
+
+
+def test_empty_frame():
+    bench_name_cleaning.check_equivalence(bench_name_cleaning.synthetic_names(10).iloc[:0])
@@ -0,0 +1,102 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import SRC_PATH
+from utils.common_functions import character_exchange_df
+from utils.convert_batch import PygoslinBackend, index_by_name, infer_column, read_jgoslin_output
+
+
+DATA_PATH = os.path.join(SRC_PATH, 'assets', 'data')
+
+# jgoslin-cli output for the demo names, written by make_jgoslin_reference.py where java is available
+REFERENCE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'jgoslin')
+
+# bundled demo files and the header row they are read with by the demo buttons
+DEMO_FILES = {
+    'demo_janovska_query.csv': 0,
+    'demo_janovska_universe.csv': 0,
+    'adipoatlas_query.csv': None,
+    'adipoatlas_universe.csv': None,
+    'Query_Human_Lung_Endothelial_Cells.txt': 0,
+    'Universe_Human_Lung_Endothelial_Cells.txt': 0,
+    'Goslin_oxPEq.txt': None,
+    'Goslin_oxPE.txt': None,
+}
+
+
+
+def demo_names(filename):
+    df = pd.read_csv(os.path.join(DATA_PATH, filename), sep='\t', header=DEMO_FILES[filename])
+    names = character_exchange_df(df).iloc[:, 0].str.rstrip(' ')
+    return list(dict.fromkeys(name.replace('"', '') for name in names))
+
+
+def reference_file(filename):
+    return os.path.join(REFERENCE_PATH, os.path.splitext(filename)[0] + '.tsv')
+
+
+def typed_rows(table, names):
+    rows = table.reindex(names).reset_index(drop=True)
+    return pd.DataFrame({column: infer_column(rows[column]) for column in rows.columns})
+
+
+def read_reference(filename, names):
+    # read as the jgoslin backend reads the output stream of jgoslin-cli
+    with open(reference_file(filename), encoding='utf-8') as stream:
+        table = read_jgoslin_output(stream)
+    return typed_rows(index_by_name(table, names), names)
+
+
+@pytest.fixture(scope='module')
+def pygoslin():
+    backend = PygoslinBackend()
+    yield backend
+    backend.shutdown()
+
+
+@pytest.fixture(scope='module')
+def parsed_tables(pygoslin, tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('goslin'))
+    tables = {}
+
+    def parse(filename):
+        if not os.path.exists(reference_file(filename)):
+            pytest.skip(f'no jgoslin reference for {filename}, run tests/make_jgoslin_reference.py with java and the jar in assets')
+        if filename not in tables:
+            names = demo_names(filename)
+            tables[filename] = (names, read_reference(filename, names), typed_rows(pygoslin.parse(names, 'LIPID', path), names))
+        return tables[filename]
+
+    return parse
+
+
+
+@pytest.mark.parametrize('filename', list(DEMO_FILES))
+def test_column_schema(parsed_tables, filename):
+    names, jgoslin, pygoslin = parsed_tables(filename)
+
+    assert list(pygoslin.columns) == list(jgoslin.columns)
+
+
+@pytest.mark.parametrize('filename', list(DEMO_FILES))
+def test_dtypes(parsed_tables, filename):
+    names, jgoslin, pygoslin = parsed_tables(filename)
+
+    columns = jgoslin.columns.intersection(pygoslin.columns)
+    assert pygoslin[columns].dtypes.astype(str).to_dict() == jgoslin[columns].dtypes.astype(str).to_dict()
+
+
+@pytest.mark.parametrize('filename', list(DEMO_FILES))
+def test_values(parsed_tables, filename):
+    names, jgoslin, pygoslin = parsed_tables(filename)
+
+    differences = []
+    for column in jgoslin.columns.intersection(pygoslin.columns):
+        a, b = jgoslin[column].astype(object), pygoslin[column].astype(object)
+        differ = ~((a == b) | (a.isna() & b.isna()))
+        differences += [(names[i], column, a.iloc[i], b.iloc[i]) for i in np.flatnonzero(differ.to_numpy())]
+
+    assert differences == []